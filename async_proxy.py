@@ -0,0 +1,380 @@
+#######################################
+#		Created by Gilad Savoray
+#               May 2021
+#######################################
+
+# asyncio server mode: one listening socket, many concurrent clients.
+# Every connection gets its own Session (instead of the shared Game object),
+# and the frame -> unpack -> handle -> pack pipeline runs as coroutines on one event loop.
+
+import asyncio
+import itertools
+
+from mc_proxy import *
+
+
+class AsyncProxy:
+    # [reuse_port] : listen with SO_REUSEPORT, so several processes accept on the same port (see workers.py)
+    def __init__(self, settings, proxy_ip, proxy_port, server_ip, server_port=25565, reuse_port=False):
+        self.settings = settings  # shared Game, holds the mods preferences
+        self.server_ip = server_ip
+        self.server_port = server_port
+
+        self.proxy_ip = proxy_ip
+        self.proxy_port = proxy_port
+        self.reuse_port = reuse_port
+
+        self.connections = set()
+        self._session_ids = itertools.count(1)
+        self._loop = None
+        self._server = None
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self.settings.preference_update_queue = PreferenceBroadcast(self)
+        start_metrics(self.settings)
+        router = get_router(self.settings, self.server_ip, self.server_port)
+        for backend in router.backends():  # warm connections to the backends
+            get_backend_pool(self.settings, *backend.address)
+        self._server = await asyncio.start_server(self._handle_client, self.proxy_ip, self.proxy_port,
+                                                  reuse_port=self.reuse_port or None)
+        print(f"Listening on {self.proxy_ip}:{self.proxy_port} -> {self.server_ip}:{self.server_port}")
+        self.settings.change_status(0)  # waiting for connection
+        async with self._server:
+            try:
+                await self._server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+        for connection in list(self.connections):
+            connection.close()
+
+    '''
+    Stops accepting clients and closes all the connections (thread safe)
+    '''
+
+    def stop(self):
+        if self._loop is not None and self._server is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+
+    async def _handle_client(self, client_reader, client_writer):
+        # The first frame decides: the backend (by the hostname the client dialed),
+        # and whether it's a server list ping that may be answered from the status cache
+        frames = FrameReader(legacy_ping=True)
+        try:
+            first_frame = await asyncio.wait_for(self._read_frame(client_reader, frames), FIRST_FRAME_TIMEOUT)
+        except (OSError, IndexError, asyncio.TimeoutError):
+            first_frame = None
+        if first_frame is None:
+            client_writer.close()
+            return
+        try:
+            router = get_router(self.settings, self.server_ip, self.server_port)
+            hostname = None if istype(first_frame, LegacyPing) else handshake_hostname(first_frame[1])
+            cache = None
+            if hostname is not None and is_status_handshake(first_frame[1]):
+                cache = get_status_cache(self.settings, *router.primary(hostname).address)
+                if cache is not None and not await self._status_ready(cache):
+                    cache = None
+        except Exception as e:  # a bad first frame drops this client only
+            print(f"Error: Bad first frame from {client_writer.get_extra_info('peername')} ({e!r})")
+            client_writer.close()
+            return
+        if cache is not None:
+            self.settings.change_status(1)  # ping
+            await self._serve_status(client_reader, client_writer, frames, cache)
+            return
+
+        connected = await self._connect_backend(router, hostname)
+        if connected is None:
+            print("Error: Can't connect to original server.")
+            self.settings.change_status(-1)  # server offline
+            client_writer.close()
+            return
+        backend, server_reader, server_writer = connected
+
+        session = Session(self.settings, next(self._session_ids))
+        connection = AsyncConnection(session, client_reader, client_writer, server_reader, server_writer,
+                                     client_frames=frames, first_frames=[first_frame])
+        self.connections.add(connection)
+        try:
+            await connection.run()
+        finally:
+            self.connections.discard(connection)
+            router.released(backend)
+
+    '''
+    Connects to a backend of [hostname]'s route (a warm connection if there is one),
+    returns (Backend, reader, writer), or None if none of them could be reached
+    '''
+
+    async def _connect_backend(self, router, hostname):
+        tried = []
+        while True:
+            backend = router.pick(hostname, tried)
+            if backend is None:
+                return None
+            try:
+                pool = get_backend_pool(self.settings, *backend.address)
+                server_socket = pool.take() if pool is not None else None
+                if server_socket is not None:
+                    server_reader, server_writer = await asyncio.open_connection(sock=server_socket)
+                else:
+                    server_reader, server_writer = await asyncio.open_connection(*backend.address)
+            except OSError:
+                router.failed(backend)
+                tried.append(backend)
+                continue
+            router.connected(backend)
+            return backend, server_reader, server_writer
+
+    '''
+    Returns the next frame of [reader], or None if the connection was closed
+    '''
+
+    @staticmethod
+    async def _read_frame(reader, frames):
+        frame = frames.next_frame()
+        while frame is None:
+            data = await reader.read(FrameReader.RECV_SIZE)
+            if len(data) == 0:
+                return None
+            frames.feed(data)
+            frame = frames.next_frame()
+        return frame
+
+    '''
+    Does [cache] have a Status Response? (the first one is fetched on a worker thread, not on the event loop)
+    '''
+
+    async def _status_ready(self, cache):
+        if cache.ready():
+            return True
+        return await self._loop.run_in_executor(None, cache.response) is not None
+
+    async def _serve_status(self, client_reader, client_writer, frames, cache):
+        try:
+            done = False
+            while not done:
+                frame = await asyncio.wait_for(self._read_frame(client_reader, frames), FIRST_FRAME_TIMEOUT)
+                if frame is None:
+                    break
+                reply, done = status_reply(cache, frame[1])
+                if reply is not None:
+                    client_writer.write(reply)
+                    await client_writer.drain()
+        except (OSError, IndexError, asyncio.TimeoutError):
+            pass
+        finally:
+            client_writer.close()
+
+    '''
+    Called on the event loop when the GUI changes a preference
+    '''
+
+    def broadcast_preference(self, mod_name):
+        for connection in list(self.connections):
+            connection.preference_update(mod_name)
+
+
+class PreferenceBroadcast:
+    # Replaces Game.preference_update_queue of the shared settings:
+    # the GUI thread appends PreferenceUpdateMessages, and every connection handles them on the event loop
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    def append_one(self, obj):
+        if istype(obj, PreferenceUpdateMessage):
+            self.proxy._loop.call_soon_threadsafe(self.proxy.broadcast_preference, obj.mod_name)
+        else:
+            raise ValueError
+
+
+class AsyncConnection:
+    # [client_frames] : the FrameReader of client_reader & [first_frames] : frames already read from it
+    def __init__(self, session, client_reader, client_writer, server_reader, server_writer, client_frames=None,
+                 first_frames=()):
+        self.session = session
+        self.client_frames = client_frames
+        self.first_frames = list(first_frames)
+        self.readers = {'c2s': client_reader, 's2c': server_reader}
+        self.writers = {'c2s': server_writer, 's2c': client_writer}  # packets of [side] are written to writers[side]
+        # the options of the leg each side reads from / writes to (c2s: reads the client, writes the server)
+        self.in_options = {'c2s': leg_options(session, 'client'), 's2c': leg_options(session, 'server')}
+        out_options = {'c2s': self.in_options['s2c'], 's2c': self.in_options['c2s']}
+        self.outputs = {side: CoalescingWriter(self.writers[side], FlushPolicy.for_leg(out_options[side]))
+                        for side in self.writers}
+        for side in self.readers:
+            tune_socket(self.writers[side].get_extra_info('socket'), out_options[side])
+        self._held_moves_timer = None  # sends the held entity moves when they are due (see send_held_moves)
+
+    async def run(self):
+        client_writer = self.writers['s2c']
+        server_writer = self.writers['c2s']
+        print("Open {0} <-> {1} \t\t {3} <-> {2}".format(client_writer.get_extra_info('peername')[1],
+                                                         client_writer.get_extra_info('sockname')[1],
+                                                         server_writer.get_extra_info('peername')[1],
+                                                         server_writer.get_extra_info('sockname')[1]))
+        tasks = [asyncio.ensure_future(self.forward('c2s')), asyncio.ensure_future(self.forward('s2c'))]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.close()
+            print(f"Closed session {self.session.session_id}")
+
+    def close(self):
+        if self._held_moves_timer is not None:
+            self._held_moves_timer.cancel()
+        for output in self.outputs.values():
+            output.flush()
+        for writer in self.writers.values():
+            writer.close()
+
+    '''
+    Receive -> unpack -> handle -> pack loop of one side
+    '''
+
+    async def forward(self, side):
+        reader = self.readers[side]
+        frames = FrameReader(legacy_ping=side == 'c2s')
+        first_frames = []
+        if side == 'c2s' and self.client_frames is not None:
+            frames = self.client_frames
+            first_frames = self.first_frames
+        capture = get_capture(self.session)
+        in_socket = self.writers['s2c' if side == 'c2s' else 'c2s'].get_extra_info('socket')
+        in_options = self.in_options[side]
+        try:
+            while True:
+                if first_frames:
+                    frame = first_frames.pop(0)
+                else:
+                    data = await reader.read(FrameReader.RECV_SIZE)
+                    if len(data) == 0:  # connection closed
+                        break
+                    quick_ack(in_socket, in_options)
+                    frames.feed(data)
+                    frame = frames.next_frame()
+
+                packets = []
+                while frame is not None:
+                    if istype(frame, LegacyPing):
+                        print("IGNORED LEGACY PING")
+                    else:
+                        next_packet_length, next_packet_data = frame
+                        if capture is not None:
+                            capture.record(side, self.session.state, self.session.with_compression,
+                                           next_packet_data, self.session.session_id)
+                        packet = MCPacket(game=self.session, length=next_packet_length,
+                                          data=Buffer(next_packet_data), side=side)
+                        packet.process(self.session.with_compression)
+                        packets.append(packet)
+                    frame = first_frames.pop(0) if first_frames else frames.next_frame()
+                self.session.flush_entity_moves()
+                if side == 's2c':
+                    packets += held_movement_packets(self.session)
+                    self.schedule_held_moves()
+
+                if packets:
+                    for written_side in self.send(packets, side):  # children may go to the other side's writer
+                        await self.writers[written_side].drain()
+        except (OSError, IndexError):
+            pass
+
+    '''
+    Packs [packets] and writes them to their sides (children of the other side included)
+    Returns the sides that were written to
+    '''
+
+    def send(self, packets, side):
+        written = set()
+        while packets:
+            urgent = any(is_urgent(packet, side) for packet in packets
+                         if type(packet) is MCPacket and packet.side == side)
+            buffers, packets, stop_flag = pack_packets(packets, side)
+            if buffers:
+                self.outputs[side].write(buffers, urgent)
+                written.add(side)
+            side = 's2c' if side == 'c2s' else 'c2s'
+        return written
+
+    def preference_update(self, mod_name):
+        if self.session.state != 3:  # preference packets are only relevant while playing
+            return
+        msg = PreferenceUpdateMessage(mod_name)
+        try:
+            msg.handle(self.session)
+        except ValueError:  # missing data (e.g. abilities were not received yet)
+            return
+        self.send(msg.payload + held_movement_packets(self.session), 's2c')
+
+    '''
+    Sets the timer of the next held entity move, for when no packets come from the server until it's due
+    '''
+
+    def schedule_held_moves(self):
+        due = held_movement_due(self.session)
+        loop = asyncio.get_running_loop()
+        when = None if due is None else loop.time() + max(0.0, due - time.monotonic())
+        timer = self._held_moves_timer
+        if timer is not None:
+            if when is not None and timer.when() <= when:  # goes off first
+                return
+            timer.cancel()
+        self._held_moves_timer = None if when is None else loop.call_at(when, self.send_held_moves)
+
+    def send_held_moves(self):
+        self._held_moves_timer = None
+        packets = held_movement_packets(self.session)
+        if packets:
+            self.send(packets, 's2c')
+        self.schedule_held_moves()
+
+
+class CoalescingWriter:
+    # Writes of one side: a small write is held back for the flush budget of [policy] (see FlushPolicy),
+    # and is sent with the writes that come meanwhile, in one transport write
+    def __init__(self, writer, policy):
+        self.writer = writer
+        self.policy = policy
+        self._buffers = []
+        self._size = 0
+        self._timer = None  # the flush of the held write
+        self._gained = False  # more was written while holding
+
+    def write(self, buffers, urgent):
+        self._buffers += buffers
+        self._size += sum(map(len, buffers))
+        if self._timer is not None:  # already holding
+            self._gained = True
+            if urgent or self._size >= self.policy.min_bytes:
+                self.flush()
+            return
+        if self.policy.hold(self._size, urgent):
+            self._timer = asyncio.get_running_loop().call_later(self.policy.budget, self.flush)
+            return
+        self.flush()
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            self.policy.held(self._gained)
+            self._gained = False
+        if self._buffers and not self.writer.is_closing():
+            self.writer.writelines(self._buffers)  # no joining, the transport gathers the buffers
+        self._buffers = []
+        self._size = 0
+
+
+if __name__ == "__main__":
+    settings = Game()
+    load_preferences(settings)
+    AsyncProxy(settings, *settings.sockets_info()).run()
@@ -0,0 +1,158 @@
+#######################################
+#		Created by Gilad Savoray
+#               May 2021
+#######################################
+
+# Pre-established TCP connections to the backend (the original server), so a new client is paired with a warm
+# connection instead of waiting for connect(). A background thread keeps <BackendPoolSize> idle connections per
+# backend, health checks them, and replaces the ones that were closed or idle for too long
+# (a vanilla server drops a connection that doesn't send a handshake within 30 seconds).
+import select
+import socket
+import threading
+import time
+
+CONNECT_TIMEOUT = 3.0  # seconds
+MAX_IDLE = 20.0  # seconds an idle connection is kept before it's replaced
+CHECK_INTERVAL = 1.0  # seconds between health checks
+RETRY_DELAY = 1.0  # seconds between dials while the backend is offline
+
+
+class BackendPool(threading.Thread):
+    def __init__(self, server_ip, server_port, size=2, max_idle=MAX_IDLE):
+        super().__init__(daemon=True)
+        self.server_ip = server_ip
+        self.server_port = server_port
+        self.size = size
+        self.max_idle = max_idle
+        self._idle = []  # [(socket, time.monotonic() of connect)], oldest first
+        self._changed = threading.Condition()
+        self._closed = False
+        self.last_error = None  # the last dial error, None while the backend is reachable
+        self.dials = 0
+        self.hits = 0  # connections handed out from the pool
+        self.misses = 0  # connections dialed on demand (the pool was empty)
+        self.start()
+
+    def _dial(self):
+        sock = socket.create_connection((self.server_ip, self.server_port), timeout=CONNECT_TIMEOUT)
+        sock.settimeout(None)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.dials += 1
+        return sock
+
+    '''
+    Is an idle connection still usable? (the server sends nothing before the handshake, so a readable socket
+    was closed or is broken)
+    '''
+
+    @staticmethod
+    def _healthy(sock):
+        try:
+            readable, writable, errors = select.select([sock], [], [sock], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable and not errors
+
+    def run(self):
+        while True:
+            with self._changed:
+                if self._closed:
+                    break
+                now = time.monotonic()
+                keep = []
+                for sock, connected in self._idle:
+                    if now - connected < self.max_idle and self._healthy(sock):
+                        keep.append((sock, connected))
+                    else:
+                        sock.close()
+                self._idle = keep
+                missing = self.size - len(self._idle)
+
+            for i in range(missing):
+                try:
+                    sock = self._dial()
+                except OSError as e:
+                    self.last_error = e
+                    break
+                self.last_error = None
+                with self._changed:
+                    if self._closed:
+                        sock.close()
+                        break
+                    self._idle.append((sock, time.monotonic()))
+
+            with self._changed:
+                if not self._closed:
+                    self._changed.wait(RETRY_DELAY if self.last_error is not None else CHECK_INTERVAL)
+
+    '''
+    Returns a warm connection, or None if there is none ready (the caller dials on its own)
+    '''
+
+    def take(self):
+        with self._changed:
+            while self._idle:
+                sock, connected = self._idle.pop()  # the newest, the least likely to be timed out
+                if self._healthy(sock):
+                    self.hits += 1
+                    self._changed.notify()  # replace it
+                    return sock
+                sock.close()
+            self.misses += 1
+            self._changed.notify()
+        return None
+
+    '''
+    Returns a connection to the backend: a warm one, or a new one (raises OSError if the backend is offline)
+    '''
+
+    def connect(self):
+        sock = self.take()
+        if sock is None:
+            sock = self._dial()
+        return sock
+
+    def close(self):
+        with self._changed:
+            self._closed = True
+            for sock, connected in self._idle:
+                sock.close()
+            self._idle = []
+            self._changed.notify_all()
+
+
+_pools = {}  # (server ip, server port) => BackendPool
+_pools_lock = threading.Lock()
+
+'''
+    Returns the BackendPool of the backend at (server_ip, server_port),
+    or None if the preference BackendPoolSize of [settings] is 0 (dial on every client)
+'''
+
+
+def get_backend_pool(settings, server_ip, server_port):
+    try:
+        size = settings.get_mod('BackendPoolSize')
+    except ValueError:
+        return None
+    if not size or size <= 0:
+        return None
+    with _pools_lock:
+        pool = _pools.get((server_ip, server_port))
+        if pool is None:
+            pool = _pools[(server_ip, server_port)] = BackendPool(server_ip, server_port, size)
+        pool.size = size
+        return pool
+
+
+'''
+    Opens a connection to (server_ip, server_port) for a new client, warm if there is a pool
+'''
+
+
+def connect_backend(settings, server_ip, server_port):
+    pool = get_backend_pool(settings, server_ip, server_port)
+    if pool is None:
+        return socket.create_connection((server_ip, server_port))
+    return pool.connect()
@@ -0,0 +1,240 @@
+#######################################
+#		Created by Gilad Savoray
+#               May 2021
+#######################################
+
+# Micro-benchmarks of the codecs (dataTypes) and of the unpack -> handle -> pack pipeline (MCPacket),
+# on synthetic 1.15.2 packets.
+#   python benchmark.py --save results.json                  # run & save
+#   python benchmark.py --baseline results.json             # run & compare, exit code 1 on a regression
+#   python benchmark.py --filter pipeline                    # only the benchmarks whose name contains 'pipeline'
+import argparse
+import json
+import platform
+import struct
+import sys
+import time
+import timeit
+import tracemalloc
+
+from mc_proxy import *
+
+
+def vi(value):
+    return varint_bytes(value)
+
+
+def st(value):
+    return vi(len(value)) + value
+
+
+POSITION = PositionT(x=-12, y=70, z=33).to_long()
+METADATA = vi(55) + b'\x00' + vi(0) + b'\x21' + b'\x02' + vi(5) + b'\x00' + b'\x07' + vi(7) + b'\x01' + b'\xff'
+
+# Encoded sample of every schema the handlers use
+SCHEMA_SAMPLES = {
+    'JSON': st(b'{"description": {"text": "A Minecraft Server"}, "players": {"max": 20, "online": 0}}'),
+    'HANDSHAKE': vi(578) + st(b'localhost') + struct.pack('>H', 25565) + vi(2),
+    'JOIN_GAME': struct.pack('>iBiqB', 7, 1, -1, -123456789, 10) + st(b'default') + vi(8) + b'\x00\x01',
+    'CHANGE_GAME_STATE': struct.pack('>Bf', 7, 1.5),
+    'BLOCK_PLACEMENT': vi(0) + struct.pack('>Q', POSITION) + vi(1) + struct.pack('>fff', 0.5, 0.25, 1.0) + b'\x00',
+    'ABILITIES': struct.pack('>bff', 0, 0.05, 0.1),
+    'ENTITY_PROPERTIES': vi(7) + struct.pack('>i', 2),
+    'ENTITY_PROPERTY': st(b'generic.movementSpeed') + struct.pack('>d', 0.1) + vi(1) +
+                       struct.pack('>ddd', 1.5, 2.5, 0.3) + b'\x01',
+    'INTERACT_ENTITY': vi(55) + vi(2),
+    'TARGET': struct.pack('>fff', 1, 2, 3),
+    'ENTITY_METADATA': METADATA,
+    'VEHICLE_MOVE': struct.pack('>dddff', 1, 2, 3, 4, 5),
+    'SPAWN_ENTITY': vi(9) + struct.pack('>dd', 1.0, 2.0) + vi(50) + struct.pack('>ddd', 1, 2, 3) + bytes([10, 200, 3]) +
+                    struct.pack('>hhh', -1, 2, -3),
+    'ENTITY_POSITION': vi(9) + struct.pack('>hhh?', 1, 2, 3, True),
+    'ENTITY_POSITION_ROTATION': vi(9) + struct.pack('>hhhBB?', 1, 2, 3, 4, 5, True),
+    'ENTITY_TELEPORT': vi(9) + struct.pack('>dddBB?', 1, 2, 3, 4, 5, True),
+    'TAB_HEADER': st(b'{"text": "Python MC Proxy"}') + st(b'{"translate": ""}'),
+}
+
+'''
+    Returns the data of a full Chunk Data packet (16 sections of 4 bits per block, a 16 entries palette)
+'''
+
+
+def chunk_data_sample():
+    section = struct.pack('>hB', 4096, 4) + vi(16) + b''.join([vi(block_id) for block_id in range(1, 17)])
+    longs = [sum([((i + j) % 16) << (4 * j) for j in range(16)]) for i in range(256)]  # 16 blocks per long
+    section += vi(256) + b''.join([struct.pack('>Q', long) for long in longs])
+    data = section * 16
+    heightmaps = b'\x0a\x00\x00' + b'\x0c\x00\x0fMOTION_BLOCKING' + struct.pack('>i', 36) + b'\x00' * 288 + b'\x00'
+    return (struct.pack('>ii?', 3, -2, True) + vi(0xFFFF) + heightmaps + b'\x00' * 4096 + st(data) + vi(0))
+
+
+# (name, side, packet ID, data, mods) of the pipeline benchmarks (all in the PLAY state)
+PIPELINE_PACKETS = [
+    ('chat', 'c2s', 0x03, st(b'hello there'), {}),
+    ('join_game', 's2c', 0x26, SCHEMA_SAMPLES['JOIN_GAME'], {}),
+    ('abilities', 's2c', 0x32, SCHEMA_SAMPLES['ABILITIES'], {'EnableFlying': True}),
+    ('entity_metadata', 's2c', 0x44, METADATA, {}),
+    ('block_placement', 'c2s', 0x2c, SCHEMA_SAMPLES['BLOCK_PLACEMENT'], {'BuildingRadio': 1}),
+    ('entity_move', 's2c', 0x29, SCHEMA_SAMPLES['ENTITY_POSITION'], {'TrackEntities': True}),
+    ('entity_move_pass_through', 's2c', 0x29, SCHEMA_SAMPLES['ENTITY_POSITION'], {'TrackEntities': False}),
+    ('chunk_data', 's2c', 0x22, None, {'TrackBlocks': True}),
+    ('chunk_data_pass_through', 's2c', 0x22, None, {'TrackBlocks': False}),
+]
+COMPRESSION_THRESHOLD = 256
+
+
+class Benchmark:
+    # [func] : runs one operation
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+
+    '''
+    Returns {'ops_per_sec': ..., 'peak_alloc_bytes': ...}
+    ops/sec is the best of [repeat] timings of about [duration] seconds each
+    '''
+
+    def run(self, repeat=3, duration=0.2):
+        timer = timeit.Timer(self.func)
+        number, elapsed = timer.autorange()  # at least 0.2 seconds
+        number = max(1, int(number * duration / max(elapsed, 1e-9)))
+        best = min(timer.repeat(repeat=repeat, number=number)) / number
+
+        tracemalloc.start()
+        try:
+            self.func()  # warm (caches)
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            self.func()
+            peak = tracemalloc.get_traced_memory()[1] - before
+        finally:
+            tracemalloc.stop()
+        return {'ops_per_sec': 1 / best, 'peak_alloc_bytes': peak}
+
+
+def primitive_benchmarks():
+    encoded_varint = vi(25565)
+    encoded_position = struct.pack('>Q', POSITION)
+    position = PositionT(value=POSITION)
+    return [
+        Benchmark('varint_encode', lambda: VarInt(value=25565).to_bytes()),
+        Benchmark('varint_encode_table', lambda: varint_bytes(300)),
+        Benchmark('varint_decode', lambda: VarInt(buffer=Buffer(encoded_varint))),
+        Benchmark('position_pack', lambda: position.pack()),
+        Benchmark('position_unpack', lambda: PositionT(buffer=Buffer(encoded_position))),
+        Benchmark('buffer_next_bytes', lambda: Buffer(encoded_position).next_bytes(8)),
+    ]
+
+
+def schema_benchmarks():
+    benchmarks = []
+    for name, sample in SCHEMA_SAMPLES.items():
+        codec = globals()[name]
+        value = codec.parse(Buffer(sample))
+        benchmarks.append(Benchmark(f'schema_{name}_parse', lambda codec=codec, sample=sample:
+                                    codec.parse(Buffer(sample))))
+        benchmarks.append(Benchmark(f'schema_{name}_serialize', lambda codec=codec, value=value:
+                                    codec.serialize(value)))
+    return benchmarks
+
+
+'''
+    A frame of [packet_id] + [data], as received ([compression]: threshold, or None)
+'''
+
+
+def make_frame(packet_id, data, compression=None):
+    load = vi(packet_id) + data
+    if compression is not None:
+        if len(load) >= compression:
+            load = vi(len(load)) + zlib.compress(load)
+        else:
+            load = vi(0) + load
+    return VarInt(value=len(load)), load
+
+
+def pipeline_benchmarks():
+    benchmarks = []
+    chunk_data = chunk_data_sample()
+    for compression in [None, COMPRESSION_THRESHOLD]:
+        for name, side, packet_id, data, mods in PIPELINE_PACKETS:
+            game = Game()
+            load_preferences(game, path='')
+            for mod_name, mod_value in mods.items():
+                game.set_mod(mod_name, mod_value)
+            game.set_mod('Camera', {})
+            game.state = 3
+            if compression is not None:
+                game.compression_size = compression
+            length, frame = make_frame(packet_id, chunk_data if data is None else data, compression)
+
+            def func(game=game, length=length, frame=frame, side=side):
+                packet = MCPacket(game=game, length=length, data=Buffer(frame), side=side)
+                packet.process(game.with_compression)
+                game.flush_entity_moves()
+                pack_packets([packet], side)
+
+            suffix = '' if compression is None else '_compressed'
+            benchmarks.append(Benchmark(f'pipeline_{name}{suffix}', func))
+    return benchmarks
+
+
+def all_benchmarks():
+    return primitive_benchmarks() + schema_benchmarks() + pipeline_benchmarks()
+
+
+def run_benchmarks(name_filter=None):
+    results = {}
+    for benchmark in all_benchmarks():
+        if name_filter and name_filter not in benchmark.name:
+            continue
+        results[benchmark.name] = benchmark.run()
+        print(f"{benchmark.name:<48} {results[benchmark.name]['ops_per_sec']:>14,.0f} ops/s "
+              f"{results[benchmark.name]['peak_alloc_bytes']:>10,} B")
+    return {'meta': {'python': platform.python_version(), 'platform': platform.platform(), 'time': time.time()},
+            'results': results}
+
+
+'''
+    Compares [current] to [baseline] (both as returned by run_benchmarks)
+    Returns the names of the benchmarks that are slower by more than [threshold] (0.1 = 10%)
+'''
+
+
+def compare(current, baseline, threshold=0.1):
+    regressions = []
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            continue
+        ratio = result['ops_per_sec'] / baseline['results'][name]['ops_per_sec']
+        flag = ''
+        if ratio < 1 - threshold:
+            flag = '  <-- REGRESSION'
+            regressions.append(name)
+        print(f"{name:<48} {ratio:>7.2f}x{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Codec & pipeline micro-benchmarks")
+    parser.add_argument('--save', help="save the results to this JSON file")
+    parser.add_argument('--baseline', help="compare the results to this JSON file")
+    parser.add_argument('--threshold', type=float, default=0.1, help="slowdown that counts as a regression")
+    parser.add_argument('--filter', help="only run the benchmarks whose name contains this")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.filter)
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        print("\nCompared to", args.baseline)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+#######################################
+#		Created by Gilad Savoray
+#               May 2021
+#######################################
+
+# Packet capture: every received frame, with its direction, connection state and a monotonic timestamp,
+# appended to a binary file by a background thread (capturing never blocks the receiving thread).
+# Captures are read back with mmap, one record at a time, and can be replayed into the
+# unpack -> handle -> pack pipeline:
+#   python capture.py <capture file> [preferences file]
+#
+# File: MAGIC, then records of  [RECORD header] [frame data (Packet ID + Data, maybe compressed)]
+import mmap
+import queue
+import struct
+import sys
+import threading
+import time
+
+MAGIC = b'MCPCAP\x00\x01'
+# data length, direction (0 = c2s, 1 = s2c), state, compressed frame?, connection ID, timestamp (monotonic seconds)
+RECORD = struct.Struct('>IBBBHd')
+SIDES = ['c2s', 's2c']
+WRITE_SIZE = 1 << 20  # the writer joins records up to this size into a single write
+
+
+class CaptureRecord:
+    __slots__ = ['side', 'state', 'with_compression', 'connection', 'timestamp', 'data']
+
+    def __init__(self, side, state, with_compression, connection, timestamp, data):
+        self.side = side
+        self.state = state
+        self.with_compression = with_compression
+        self.connection = connection
+        self.timestamp = timestamp
+        self.data = data  # frame data, without the length VarInt
+
+    def __repr__(self):
+        return f'CaptureRecord[{self.side}, state={self.state}, {self.timestamp:.6f}, {len(self.data)} bytes]'
+
+
+class CaptureWriter(threading.Thread):
+    # record() only puts the frame in a queue, the thread encodes and writes it
+    def __init__(self, path):
+        super().__init__(daemon=True)
+        self.path = path
+        self._queue = queue.SimpleQueue()
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self.start()
+
+    '''
+    Queues a frame: [side] c2s/s2c, [data] frame data (bytes, without the length VarInt)
+    '''
+
+    def record(self, side, state, with_compression, data, connection=0):
+        self._queue.put((side, state, with_compression, connection, time.monotonic(), data))
+
+    def run(self):
+        closing = False
+        while not closing:
+            items = [self._queue.get()]
+            size = 0
+            while size < WRITE_SIZE:  # take whatever else is already waiting
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+                size += len(items[-1][5]) if items[-1] is not None else 0
+
+            chunks = []
+            for item in items:
+                if item is None:  # close()
+                    closing = True
+                    continue
+                side, state, with_compression, connection, timestamp, data = item
+                chunks.append(RECORD.pack(len(data), SIDES.index(side), state, bool(with_compression),
+                                          connection & 0xFFFF, timestamp))
+                chunks.append(data)
+            self._file.write(b''.join(chunks))
+            self._file.flush()  # on disk even if the process is killed
+        self._file.close()
+
+    '''
+    Writes what was recorded so far and closes the file
+    '''
+
+    def close(self):
+        self._queue.put(None)
+        self.join()
+
+
+class CaptureReader:
+    # Iterates the records of a capture file through mmap, only the current record is copied out of the file
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, 'rb') as capture_file:
+            if capture_file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{self.path} is not a capture file")
+            size = capture_file.seek(0, 2)
+            if size == len(MAGIC):  # no records (mmap can't map an empty range)
+                return
+            with mmap.mmap(capture_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset = len(MAGIC)
+                while offset + RECORD.size <= size:
+                    length, side, state, with_compression, connection, timestamp = RECORD.unpack_from(data, offset)
+                    offset += RECORD.size
+                    if offset + length > size:  # the capture was cut in the middle of a record
+                        break
+                    yield CaptureRecord(SIDES[side], state, bool(with_compression), connection, timestamp,
+                                        data[offset:offset + length])
+                    offset += length
+
+
+_capture = None
+_capture_lock = threading.Lock()
+
+'''
+    Returns the process' CaptureWriter if the preference CaptureFile of [game] is set ('' = no capture), else None
+'''
+
+
+def get_capture(game):
+    global _capture
+    try:
+        path = game.get_mod('CaptureFile')
+    except ValueError:
+        return None
+    if not path:
+        return None
+    with _capture_lock:
+        if _capture is None:
+            _capture = CaptureWriter(path)
+            print(f"Capturing to {path}")
+        return _capture
+
+
+'''
+    Writes what the process' CaptureWriter has left & closes it, if there is one
+'''
+
+
+def close_capture():
+    global _capture
+    with _capture_lock:
+        capture, _capture = _capture, None
+    if capture is not None:
+        capture.close()
+
+
+'''
+    Feeds the records of the capture at [path] through MCPacket.process & pack_packets, in the recorded order,
+    with a fresh Session per connection (mods from the preferences file at [preferences_path])
+    Returns (number of packets, seconds)
+'''
+
+
+def replay(path, preferences_path='gui/preferences.gui'):
+    from mc_proxy import Game, Session, MCPacket, pack_packets, load_preferences
+    from dataTypes import Buffer, VarInt
+
+    settings = Game()
+    load_preferences(settings, preferences_path)
+    games = {}
+    count = 0
+    start = time.perf_counter()
+    for record in CaptureReader(path):
+        game = games.get(record.connection)
+        if game is None:
+            game = games[record.connection] = Session(settings, record.connection)
+        packet = MCPacket(game=game, length=VarInt(value=len(record.data)), data=Buffer(record.data),
+                          side=record.side)
+        packet.process(game.with_compression)
+        pending = [packet]
+        side = record.side
+        while pending:  # pack both sides, like the send threads do
+            send_buffers, pending, stop_flag = pack_packets(pending, side)
+            side = 's2c' if side == 'c2s' else 'c2s'
+        count += 1
+        game.flush_entity_moves()
+    return count, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    packets, seconds = replay(*sys.argv[1:3])
+    print(f"Replayed {packets} packets in {seconds:.3f}s ({packets / max(seconds, 1e-9):.0f} packets/s)")
@@ -0,0 +1,197 @@
+#######################################
+#		Created by Gilad Savoray
+#               May 2021
+#######################################
+
+# The blocks around the player, decoded from Chunk Data (0x22) and kept up to date by
+# Block Change (0x0C) & Multi Block Change (0x10)
+# https://wiki.vg/index.php?title=Chunk_Format&oldid=15901
+import numpy as np
+
+from dataTypes import *
+
+SECTIONS = 16  # 16 sections of 16x16x16 blocks in a chunk column (y 0-255)
+SECTION_VOLUME = 4096
+GLOBAL_BITS = 14  # bits per block of the direct (global) palette in 1.15.2
+
+CHUNK_HEADER = compile_types(['int', 'int', 'boolean'])  # chunk x, chunk z, full chunk
+SECTION_HEADER = compile_types(['short', 'ubyte'])  # non-air block count, bits per block
+CHUNK_POSITION = compile_types(['int', 'int'])
+BLOCK_CHANGE = compile_types(['position', 'varint'])
+MULTI_BLOCK_RECORD = compile_types(['ubyte', 'ubyte', 'varint'])  # horizontal position (x << 4 | z), y, block ID
+
+# NBT payload sizes of the fixed-width tags
+NBT_FIXED_SIZES = {1: 1, 2: 2, 3: 4, 4: 8, 5: 4, 6: 8}
+NBT_ARRAY_SIZES = {7: 1, 11: 4, 12: 8}  # byte / int / long array item sizes
+
+'''
+    Skips a named NBT tag (the tag ID, its name and its payload) in buff
+'''
+
+
+def skip_nbt(buff):
+    tag_id = buff.next_byte()
+    if tag_id != 0:  # not TAG_End
+        buff.skip(int.from_bytes(buff.next_bytes(2), byteorder='big'))  # name
+        _skip_nbt_payload(buff, tag_id)
+
+
+def _skip_nbt_payload(buff, tag_id):
+    if tag_id in NBT_FIXED_SIZES:
+        buff.skip(NBT_FIXED_SIZES[tag_id])
+    elif tag_id in NBT_ARRAY_SIZES:
+        buff.skip(NBT_ARRAY_SIZES[tag_id] * int.from_bytes(buff.next_bytes(4), byteorder='big', signed=True))
+    elif tag_id == 8:  # string
+        buff.skip(int.from_bytes(buff.next_bytes(2), byteorder='big'))
+    elif tag_id == 9:  # list
+        item_id = buff.next_byte()
+        length = int.from_bytes(buff.next_bytes(4), byteorder='big', signed=True)
+        if item_id in NBT_FIXED_SIZES:
+            buff.skip(NBT_FIXED_SIZES[item_id] * max(length, 0))
+        else:
+            for i in range(length):
+                _skip_nbt_payload(buff, item_id)
+    elif tag_id == 10:  # compound, named tags up to TAG_End
+        item_id = buff.next_byte()
+        while item_id != 0:
+            buff.skip(int.from_bytes(buff.next_bytes(2), byteorder='big'))
+            _skip_nbt_payload(buff, item_id)
+            item_id = buff.next_byte()
+    else:
+        raise ValueError(f"Unknown NBT tag {tag_id}")
+
+
+'''
+    Unpacks [bits] bits per entry, 4096 entries, from the compacted long array [longs] (1.15.2: entries may span
+    two longs) into an array of uint16, all the entries at once
+'''
+
+
+def unpack_bits(longs, bits):
+    words = np.empty(len(longs) + 1, dtype=np.uint64)
+    words[:-1] = longs.view(np.uint64)
+    words[-1] = 0  # an entry that ends exactly at the last bit reads a harmless 0 from the padding
+
+    starts = np.arange(SECTION_VOLUME, dtype=np.uint64) * np.uint64(bits)
+    index = (starts >> np.uint64(6)).astype(np.intp)
+    offset = starts & np.uint64(63)
+    values = words[index] >> offset
+    spans = offset + np.uint64(bits) > 64  # the entry continues in the next long
+    high = words[index + 1] << ((np.uint64(64) - offset) & np.uint64(63))
+    values |= np.where(spans, high, np.uint64(0))
+    return (values & np.uint64((1 << bits) - 1)).astype(np.uint16)
+
+
+'''
+    Reads one chunk section from buff, returns a (16, 16, 16) uint16 array of the block state IDs, indexed [y, z, x]
+'''
+
+
+def read_section(buff):
+    block_count, bits = SECTION_HEADER.parse(buff)
+    palette = None
+    if bits <= 8:  # indirect palette
+        bits = max(bits, 4)
+        palette = read_array(buff, 'varint', VARINT.parse(buff).value).astype(np.uint16)
+    else:
+        bits = GLOBAL_BITS
+
+    longs = read_array(buff, 'long', VARINT.parse(buff).value)
+    if len(longs) * 64 < SECTION_VOLUME * bits:
+        raise ValueError("Chunk section data is too short")
+    blocks = unpack_bits(longs, bits)
+    if palette is not None:
+        blocks = palette[blocks]
+    return blocks.reshape((16, 16, 16))
+
+
+class Chunk:
+    __slots__ = ['x', 'z', 'sections']
+
+    def __init__(self, x, z):
+        self.x = x
+        self.z = z
+        self.sections = [None] * SECTIONS  # None is an empty (all air) section
+
+
+class World:
+    # The loaded chunk columns of one connection, by (chunk x, chunk z)
+    def __init__(self):
+        self.chunks = {}
+
+    '''
+    Reads a Chunk Data packet (without the packet ID) from buff
+    '''
+
+    def load_chunk(self, buff):
+        chunk_x, chunk_z, full_chunk = CHUNK_HEADER.parse(buff)
+        bit_mask = VARINT.parse(buff).value
+        skip_nbt(buff)  # heightmaps
+        if full_chunk:
+            buff.skip(1024 * 4)  # biomes
+
+        data = Buffer(buff.next_bytes(VARINT.parse(buff).value))
+        chunk = self.chunks.get((chunk_x, chunk_z))
+        if full_chunk or chunk is None:
+            chunk = Chunk(chunk_x, chunk_z)
+        for section_y in range(SECTIONS):
+            if bit_mask & (1 << section_y):
+                chunk.sections[section_y] = read_section(data)
+        self.chunks[(chunk_x, chunk_z)] = chunk
+        return chunk
+
+    def unload_chunk(self, buff):
+        chunk_x, chunk_z = CHUNK_POSITION.parse(buff)
+        self.chunks.pop((chunk_x, chunk_z), None)
+
+    def clear(self):
+        self.chunks = {}
+
+    '''
+    Reads a Block Change packet (without the packet ID) from buff
+    '''
+
+    def block_change(self, buff):
+        location, block_id = BLOCK_CHANGE.parse(buff)
+        self.set_block(location.x, location.y, location.z, block_id.value)
+
+    '''
+    Reads a Multi Block Change packet (without the packet ID) from buff
+    '''
+
+    def multi_block_change(self, buff):
+        chunk_x, chunk_z = CHUNK_POSITION.parse(buff)
+        chunk = self.chunks.get((chunk_x, chunk_z))
+        for i in range(VARINT.parse(buff).value):
+            horizontal, y, block_id = MULTI_BLOCK_RECORD.parse(buff)
+            if chunk is not None:
+                self.__set(chunk, horizontal >> 4, y, horizontal & 0xF, block_id.value)
+
+    def set_block(self, x, y, z, block_id):
+        chunk = self.chunks.get((x >> 4, z >> 4))
+        if chunk is not None and 0 <= y < 256:
+            self.__set(chunk, x & 0xF, y, z & 0xF, block_id)
+
+    def __set(self, chunk, x, y, z, block_id):  # x & z inside the chunk
+        section = chunk.sections[y >> 4]
+        if section is None:
+            if block_id == 0:  # still air
+                return
+            section = np.zeros((16, 16, 16), dtype=np.uint16)
+            chunk.sections[y >> 4] = section
+        section[y & 0xF, z, x] = block_id
+
+    '''
+    Returns the block state ID at (x, y, z), or None if the chunk isn't loaded
+    '''
+
+    def block_at(self, x, y, z):
+        chunk = self.chunks.get((x >> 4, z >> 4))
+        if chunk is None:
+            return None
+        if not 0 <= y < 256:
+            return 0  # air
+        section = chunk.sections[y >> 4]
+        if section is None:
+            return 0
+        return int(section[y & 0xF, z & 0xF, x & 0xF])
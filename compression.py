@@ -0,0 +1,97 @@
+#######################################
+#		Created by Gilad Savoray
+#               May 2021
+#######################################
+
+# zlib compression of the packets, configured per direction (see Game.compressor)
+# c2s packets are compressed for the server, s2c packets for the client
+import zlib
+
+# Largest (Packet ID + Data) a compressed packet may declare, as the vanilla server checks it
+MAX_UNCOMPRESSED_SIZE = 2097152
+
+DEFAULT_LEVEL = -1  # zlib's default (6)
+FASTEST_LEVEL = 1  # for LAN clients, where bandwidth is cheap and CPU is not
+OFFLOAD_SIZE = 64 * 1024  # payloads from this size are compressed by the worker pool (if there is one)
+
+
+class DecompressionError(zlib.error):
+    pass
+
+
+class Compressor:
+    # [level] : zlib level, -1 (default) or 0-9
+    # [max_size] : decompressed payloads that declare a bigger length are rejected before decompressing
+    # [pool] : optional executor that compresses payloads of at least [offload_size] bytes
+    def __init__(self, level=DEFAULT_LEVEL, max_size=MAX_UNCOMPRESSED_SIZE, pool=None, offload_size=OFFLOAD_SIZE):
+        if type(level) != int or not -1 <= level <= 9:
+            raise ValueError
+        self.level = level
+        self.max_size = max_size
+        self.pool = pool
+        self.offload_size = offload_size
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    '''
+    Starts compressing [data] on the worker pool
+    Returns a Future of the compressed bytes, or None if [data] is not worth offloading
+    '''
+
+    def submit(self, data):
+        if self.pool is None or len(data) < self.offload_size:
+            return None
+        return self.pool.submit(zlib.compress, data, self.level)
+
+    '''
+    Decompresses [data] that declares [uncompressed_length] bytes
+    The output is allocated once at that size; payloads over max_size, or that don't decompress
+    to exactly the declared length, raise DecompressionError
+    '''
+
+    def decompress(self, data, uncompressed_length):
+        if not 0 < uncompressed_length <= self.max_size:
+            raise DecompressionError(f"Declared length {uncompressed_length} is out of bounds")
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, uncompressed_length)
+        if len(result) != uncompressed_length or decompressor.unconsumed_tail or not decompressor.eof:
+            raise DecompressionError(f"Payload doesn't match its declared length {uncompressed_length}")
+        return result
+
+    def __str__(self):
+        return f'Compressor[level={self.level}, pool={self.pool is not None}]'
+
+
+_pools = {}
+
+'''
+    Returns the (shared) worker pool with [workers] threads, or None if workers < 1
+    zlib releases the GIL while (de)compressing, so threads compress in parallel
+'''
+
+
+def get_pool(workers):
+    if workers < 1:
+        return None
+    if workers not in _pools:
+        from concurrent.futures import ThreadPoolExecutor  # only imported if there is a pool (faster start)
+        _pools[workers] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='compression')
+    return _pools[workers]
+
+
+'''
+    Builds the compressors of both directions from the preferences of [game]:
+    CompressionLevelC2S / CompressionLevelS2C : zlib levels
+    LANCompression : the client is on the LAN, compress its side (s2c) with the fastest level
+    CompressionWorkers : size of the worker pool for big payloads (0 = compress in place)
+'''
+
+
+def compressors_from_preferences(game):
+    pool = get_pool(game.get_mod('CompressionWorkers'))
+    s2c_level = game.get_mod('CompressionLevelS2C')
+    if game.get_mod('LANCompression'):
+        s2c_level = FASTEST_LEVEL
+    return {'c2s': Compressor(game.get_mod('CompressionLevelC2S'), pool=pool),
+            's2c': Compressor(s2c_level, pool=pool)}
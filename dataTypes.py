@@ -3,62 +3,77 @@
 #               May 2021
 #######################################
 
-import numpy as np
+# Primitives are plain Python ints / floats.
+# NumPy is imported only when it pays off: bulk decoding / encoding of long arrays (see read_array & write_array)
 import zlib
 import struct
 import json
+from abc import ABC, abstractmethod
 
 
 def rshift(val, n): return val >> n if val >= 0 else (val + 0x100000000) >> n
 
 
-def sign_extend32(binary, lsb=0, msb=32):  # returns binary[lsb:msb]
-    new = np.int32(0)
-    binary >>= lsb
-    mask = 0b1
-    for i in range(32):
-        new |= mask & binary
-        mask *= 2
-        if (msb - lsb - 2 < i):
-            binary <<= 1
-    return np.int32(new)
+def sign_extend32(binary, lsb=0, msb=32):  # returns binary[lsb:msb], sign extended
+    bits = msb - lsb
+    value = (binary >> lsb) & ((1 << bits) - 1)
+    return value - ((value >> (bits - 1)) << bits)
+
+
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1
+
+# VarInt encodings of 0 .. 0x3FFF (one or two bytes)
+_VARINT_TABLE = [bytes([v]) for v in range(0x80)] + \
+                [bytes([(v & 0x7F) | 0x80, v >> 7]) for v in range(0x80, 0x4000)]
+
+
+def varint_bytes(value):
+    if 0 <= value < 0x4000:
+        return _VARINT_TABLE[value]
+    value &= 0xFFFFFFFF  # negative numbers are sent as unsigned 32 bit
+    result = bytearray()
+    while value > 0x7F:
+        result.append((value & 0x7F) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
 
 
 class VarInt:
     def __init__(self, **kwargs):
         if 'buffer' in kwargs and type(kwargs['buffer']) == Buffer:
             buffer = kwargs['buffer']
-            num_read = 0
-            result = np.int32(0)
+            result = 0
+            shift = 0
             read = 0b10000000
-            while (read & 0b10000000) != 0b0:
-                if num_read > 5:
+            while read & 0b10000000:
+                if shift > 28:
                     raise Exception("VarInt is too big")
                 read = buffer.next_byte()
-                value = read & 0b01111111
-                result |= value << (7 * num_read)
-                num_read += 1
-            self.value = np.int32(result)
+                result |= (read & 0b01111111) << shift
+                shift += 7
+            if result > INT32_MAX:  # int32 sign
+                result -= 1 << 32
+            self.value = result
 
         elif 'value' in kwargs:
-            if np.iinfo(np.int32).min <= kwargs['value'] <= np.iinfo(np.int32).max:
-                self.value = np.int32(kwargs['value'])
+            value = int(kwargs['value'])
+            if INT32_MIN <= value <= INT32_MAX:
+                self.value = value
             else:
                 raise Exception("Reached max int32")
 
     def to_bytes(self):
-        bytes_ = bytearray()
-        value = np.int32(self.value)
-        while len(bytes_) == 0 or value != 0:
-            tmp = np.byte(value & 0b01111111)
-            value = (np.right_shift(value, 7)) & (2 ** (np.iinfo(np.int32).bits - 7) - 1)  # shift LOGICAL right
-            if value != 0:
-                tmp |= 0b10000000
-            bytes_.append(tmp)
-        return bytes_
+        return varint_bytes(self.value)
 
     def to_int32(self):
-        return np.int32(self.value)
+        return self.value
+
+    def __int__(self):
+        return self.value
+
+    def __index__(self):
+        return self.value
 
     def __str__(self):
         return str(self.value)
@@ -70,10 +85,12 @@ class VarInt:
 class PositionT:
     # https://wiki.vg/Protocol#Position
     def __init__(self, **kwargs):
-        if 'buffer' in kwargs and type(kwargs['buffer']) == Buffer:
-            buffer = kwargs['buffer']
-            value = int.from_bytes(buffer.next_bytes(8), byteorder='big',
-                                   signed=False)  # 64 bit, as unsigned long (int)
+        if ('buffer' in kwargs and type(kwargs['buffer']) == Buffer) or 'value' in kwargs:
+            if 'value' in kwargs:
+                value = kwargs['value']
+            else:
+                value = int.from_bytes(kwargs['buffer'].next_bytes(8), byteorder='big',
+                                       signed=False)  # 64 bit, as unsigned long (int)
 
             self.y = sign_extend32(value, lsb=0, msb=12)
             self.z = sign_extend32(value, lsb=12, msb=38)
@@ -84,18 +101,20 @@ class PositionT:
             self.y = 0
             self.z = 0
             if 'x' in kwargs and kwargs['x']:
-                self.x = sign_extend32(kwargs['x'], msb=26)
+                self.x = sign_extend32(int(kwargs['x']), msb=26)
             if 'y' in kwargs and kwargs['y']:
-                self.y = sign_extend32(kwargs['y'], msb=12)
+                self.y = sign_extend32(int(kwargs['y']), msb=12)
             if 'z' in kwargs and kwargs['z']:
-                self.z = sign_extend32(kwargs['z'], msb=26)
+                self.z = sign_extend32(int(kwargs['z']), msb=26)
 
     def __str__(self):
         return "({0}, {1}, {2})".format(self.x, self.y, self.z)
 
     def pack(self):
-        tmp = np.int64(self.x & 0x3FFFFFF) << 38 | (np.int64(self.z & 0x3FFFFFF) << 12) | (self.y & 0xFFF)
-        return tmp.byteswap()  # change to big endian
+        return self.to_long().to_bytes(8, byteorder='big')
+
+    def to_long(self):  # 64 bit, as unsigned long (int)
+        return (int(self.x) & 0x3FFFFFF) << 38 | (int(self.z) & 0x3FFFFFF) << 12 | (int(self.y) & 0xFFF)
 
     def __repr__(self):
         return f'(x={self.x}, y={self.y}, z={self.z})'
@@ -108,18 +127,18 @@ class AngleT:
     def __init__(self, **kwargs):
         if 'buffer' in kwargs and type(kwargs['buffer']) == Buffer:
             buffer = kwargs['buffer']
-            self.angle = parse_types('byte', buffer)  # unsigned 8 bit
+            self.angle = parse_types('ubyte', buffer)  # unsigned 8 bit
         elif 'degrees' in kwargs:
             degrees = kwargs['degrees']
             self.angle = int((degrees % 360) * (255.0 / 360))  # int from 0 to 255
         elif 'angle' in kwargs:
             angle = kwargs['angle']
-            self.angle = int(angle % 255)  # int from 0 to 255
+            self.angle = int(angle) % 256  # int from 0 to 255
         else:
             self.angle = 0
 
     def pack(self):
-        return serialize_types('byte', self.angle)
+        return serialize_types('ubyte', self.angle)
 
     def __str__(self):
         return str(self.angle)
@@ -154,20 +173,50 @@ class SlotT:
 
 
 class Buffer:
+    # The bytes are read with a cursor over a memoryview:
+    # reading a field costs O(field size), no matter how much payload is left after it
     def __init__(self, _bytes=None):
-        self.__bytes = bytearray()
+        self.__view = memoryview(b'')
+        self.__pos = 0  # read offset
         self.add_bytes(_bytes)
 
     def next_byte(self):
-        return self.next_bytes(1)[0]
+        if self.__pos >= len(self.__view):
+            raise Exception("No bytes left in buffer:", bytes(self.to_bytes()))
+        self.__pos += 1
+        return self.__view[self.__pos - 1]
 
     def next_bytes(self, size):
         if self.length() < size:  # if there isn't enough data
-            raise Exception("No bytes left in buffer:", self.to_bytes())
+            raise Exception("No bytes left in buffer:", bytes(self.to_bytes()))
 
-        tmp = self.__bytes[:size]
-        self.__bytes = self.__bytes[size:]
-        return bytes(tmp)
+        tmp = self.__view[self.__pos:self.__pos + size]
+        self.__pos += size
+        return tmp.tobytes()
+
+    '''
+    Reads the next fixed-width values with a precompiled struct.Struct
+    '''
+
+    def next_struct(self, struct_):
+        if self.length() < struct_.size:  # if there isn't enough data
+            raise Exception("No bytes left in buffer:", bytes(self.to_bytes()))
+
+        values = struct_.unpack_from(self.__view, self.__pos)
+        self.__pos += struct_.size
+        return values
+
+    '''
+    Returns a view of the next [size] bytes (or less, if there aren't enough), without reading them
+    '''
+
+    def peek_view(self, size):
+        return self.__view[self.__pos:self.__pos + size]
+
+    def skip(self, size):
+        if self.length() < size:  # if there isn't enough data
+            raise Exception("No bytes left in buffer:", bytes(self.to_bytes()))
+        self.__pos += size
 
     def add_byte(self, byte):
         tmp = bytearray()
@@ -176,236 +225,509 @@ class Buffer:
 
     def add_bytes(self, byte_arr):
         if byte_arr is not None:
-            self.__bytes += byte_arr
+            if self.length() == 0:  # nothing to keep, bytes and memoryviews are used as they are (not copied)
+                if type(byte_arr) not in [bytes, memoryview]:
+                    byte_arr = bytes(byte_arr)
+                self.__set(byte_arr)
+            else:
+                self.__set(b''.join((self.to_bytes(), byte_arr)))
+
+    def __set(self, _bytes):
+        self.__view = memoryview(_bytes)
+        if self.__view.format != 'B' or self.__view.ndim != 1:
+            self.__view = self.__view.cast('B')
+        self.__pos = 0
 
     def length(self):
-        return len(self.__bytes)
+        return len(self.__view) - self.__pos
 
     def empty(self):
-        return self.next_bytes(self.length())
+        tmp = self.to_bytes()
+        self.__pos = len(self.__view)
+        return tmp
+
+    '''
+    Returns a new Buffer over the unread bytes (shared, not copied)
+    '''
 
     def copy(self):
-        return Buffer(self.__bytes)
+        return Buffer(self.to_bytes())
+
+    '''
+    Returns the unread bytes as a memoryview (not copied)
+    '''
 
     def to_bytes(self):
-        return self.__bytes
+        return self.__view[self.__pos:]
 
     def var_int_length(self):
         return VarInt(value=self.length())
 
     def __str__(self):
-        return f'Buffer[{self.to_bytes()}]'
+        return f'Buffer[{bytes(self.to_bytes())}]'
 
     '''
     Uncompress with zlib
     '''
 
     def uncompress(self):
-        tmp = zlib.decompress(self.to_bytes())
-        self.__bytes = tmp
+        self.__set(zlib.decompress(self.to_bytes()))
 
 
 TYPES = ['byte', 'varint', 'float', 'string', 'chat', 'opt|chat', 'slot', 'boolean', [3, 'float'], 'position',
          'opt|position', 'varint', 'opt|string', 'opt|varint', None, None, [3, 'varint'], 'opt|varint', 'varint']
 
+# Fixed-width types and their struct format
+FIXED_FORMATS = {'byte': 'b', 'ubyte': 'B', 'boolean': 'B', 'short': 'h', 'ushort': 'H', 'int': 'i', 'long': 'q',
+                 'float': 'f', 'double': 'd', 'uuid': 'dd', 'angle': 'B', 'position': 'Q'}
 
-def parse_types(types_obj, buff):
-    if type(types_obj) == str:
-        type_str = types_obj
-        if type_str.startswith('opt|'):  # optional type (Boolean + type)
-            opt = parse_types('boolean', buff)
-            if opt == 0x1:
-                return parse_types(type_str[4:], buff)
-            else:
-                return None
+'''
+    Type descriptors (like ['varint', 'position', 'varint', [3, 'float'], 'boolean']) are compiled once
+    into a codec object with parse(buff) and serialize(value), and cached per descriptor.
+    Runs of fixed-width types are read / written with a single precompiled struct.Struct.
+'''
 
 
-        elif type_str == 'varint':
-            return VarInt(buffer=buff)
-        elif type_str == 'position':
-            return PositionT(buffer=buff)
-        elif type_str == 'angle':
-            return AngleT(buffer=buff)
-
-
-        elif type_str == 'boolean':
-            tmp = buff.next_bytes(1)
-            return np.int8(int.from_bytes(tmp, byteorder='big', signed=False))
-        elif type_str == 'byte':
-            tmp = buff.next_bytes(1)
-            return np.int8(int.from_bytes(tmp, byteorder='big', signed=True))
-        elif type_str == 'ubyte':
-            tmp = buff.next_bytes(1)
-            return np.int8(int.from_bytes(tmp, byteorder='big', signed=False))
-        elif type_str == 'short':
-            tmp = buff.next_bytes(2)
-            return np.short(int.from_bytes(tmp, byteorder='big', signed=True))
-        elif type_str == 'ushort':
-            tmp = buff.next_bytes(2)
-            return np.ushort(int.from_bytes(tmp, byteorder='big', signed=False))
-        elif type_str == 'int':
-            tmp = buff.next_bytes(4)
-            return np.int32(int.from_bytes(tmp, byteorder='big', signed=True))
-        elif type_str == 'long':
-            tmp = buff.next_bytes(8)
-            return np.int64(int.from_bytes(tmp, byteorder='big', signed=True))
-        elif type_str == 'double':
-            tmp = buff.next_bytes(8)
-            return np.float64(struct.unpack('!d', tmp)[0])
-        elif type_str == 'float':
-            tmp = buff.next_bytes(4)
-            return np.float32(struct.unpack('!f', tmp)[0])
+class Codec(ABC):
+    fixed = None  # struct format, if the codec is fixed-width
 
+    # Reads a value from buff (advances its cursor)
+    @abstractmethod
+    def parse(self, buff):
+        pass
 
-        elif type_str == 'string':
-            length = VarInt(buffer=buff).value
-            return buff.next_bytes(length)
-        elif type_str == 'json':
-            str_ = parse_types('string', buff)
-            return json.loads(str_)
-        elif type_str == 'uuid':
-            tmp = parse_types(['double', 'double'], buff)
-            return tmp
-        elif type_str == 'chat':  # basically json
-            return parse_types('json', buff)
-        elif type_str == 'slot':
-            return SlotT(buffer=buff)
-
-        elif type_str == "entity_metadata":
-            arr = [None] * 7  # an array of [[data_type_index(varint), value(sometype)] of the 7 first metadata values,
-            # otherwise, None
-            leftover = None
-
-            index = None
-            while index is None or 0 <= index < 7:  # index limit (currently 7 TYPES)
-                index = parse_types('ubyte', buff)
-                if 0 <= index < 0x7:
-                    data_type_index = parse_types('varint', buff)
-                    data_type = TYPES[data_type_index.value]
-                    arr[index] = [data_type_index, parse_types([data_type], buff)[0]]
-                else:
-                    leftover = serialize_types('ubyte',
-                                               index) + buff.to_bytes()  # leftover, undecoded metadata as bytes
-            return [arr, leftover]
+    # Returns the bytes of value
+    @abstractmethod
+    def serialize(self, value):
+        pass
 
-        else:
-            raise ValueError("Unidentified type to parse")
-            return None
-
-    elif type(types_obj) == list and len(types_obj) > 0:
-        if type(types_obj[0]) == int or type(types_obj[0]) == np.int16:  # first item is pre-known array length / the length is the first VarInt in buff
-            record_count = 0
-            if types_obj[0] < 1:  # means that the array's length is not known. decode it from the first VarInt
-                record_count = VarInt(buffer=buff).value
-            else:
-                record_count = types_obj[0]  # get the length from that int (pre-known length)
-            types_obj.pop(0)
 
-            result_array = []
-            for i in range(record_count):
-                result_array += parse_types(types_obj, buff)
-            return result_array
+class FixedCodec(Codec):
+    # [build] : struct values -> value;  [flatten] : value -> struct values
+    # [number] : a single number (the value is the only struct value)
+    # [plain] : a list of numbers (the value is the list of struct values)
+    def __init__(self, fmt, build, flatten, number=False, plain=False):
+        self.fixed = fmt
+        self.struct = struct.Struct('>' + fmt)
+        self.n_values = len(fmt)
+        self.build = build
+        self.flatten = flatten
+        self.number = number
+        self.plain = plain
 
-        else:  # not an actual array, just a couple of types
-            # ['varint', 'varint', 'byte']   =>   [45, 50, 0x5a]
-            result_array = []
-            for item_type in types_obj:
-                result_array.append(parse_types(item_type[:], buff))
-            return result_array
-    else:
-        raise ValueError("Unidentified type to parse")
+    def parse(self, buff):
+        return self.build(buff.next_struct(self.struct))
 
+    def serialize(self, value):
+        return self.struct.pack(*self.flatten(value))
 
-def serialize_types(types_obj, variables_tup):
-    result = b''
-    if type(types_obj) == str:
-        type_str = types_obj
-        single_value = variables_tup
 
-        if type_str.startswith('opt|'):  # optional type (Boolean + type)
-            if single_value is None:
-                result += serialize_types('boolean', 0x0)  # False
-            else:
-                result += serialize_types('boolean', 0x1)  # True
-                result += serialize_types(type_str[4:], single_value)  # type
+class VarIntCodec(Codec):
+    def parse(self, buff):
+        return VarInt(buffer=buff)
 
-        elif type_str == 'varint':
-            if type(single_value) == int:
-                result += VarInt(value=single_value).to_bytes()
+    def serialize(self, value):
+        if type(value) == VarInt:
+            return value.to_bytes()
+        return VarInt(value=value).to_bytes()
+
+
+class StringCodec(Codec):
+    def parse(self, buff):
+        length = VarInt(buffer=buff).value
+        return buff.next_bytes(length)
+
+    def serialize(self, value):
+        if type(value) == str:
+            value = value.encode()
+        return varint_bytes(len(value)) + value
+
+
+class JsonCodec(Codec):  # json, chat
+    def parse(self, buff):
+        return json.loads(STRING.parse(buff))
+
+    def serialize(self, value):
+        return STRING.serialize(json.dumps(value))
+
+
+class SlotCodec(Codec):
+    def parse(self, buff):
+        return SlotT(buffer=buff)
+
+    def serialize(self, value):
+        return value.to_bytes()
+
+
+class OptionalCodec(Codec):  # optional type (Boolean + type)
+    def __init__(self, codec):
+        self.codec = codec
+
+    def parse(self, buff):
+        if buff.next_byte() == 0x1:
+            return self.codec.parse(buff)
+        return None
+
+    def serialize(self, value):
+        if value is None:
+            return b'\x00'  # False
+        return b'\x01' + self.codec.serialize(value)  # True + type
+
+
+class EntityMetadataCodec(Codec):
+    # [[data_type_index(varint), value(sometype)] of the 7 first metadata values (otherwise None), leftover bytes]
+    def parse(self, buff):
+        arr = [None] * 7
+        leftover = None
+
+        index = None
+        while index is None or 0 <= index < 7:  # index limit (currently 7 TYPES)
+            index = buff.next_byte()  # ubyte
+            if 0 <= index < 0x7:
+                data_type_index = VarInt(buffer=buff)
+                arr[index] = [data_type_index, compile_types(TYPES[data_type_index.value]).parse(buff)]
+            else:
+                leftover = bytes([index]) + buff.empty()  # leftover, undecoded metadata as bytes
+        return [arr, leftover]
+
+    def serialize(self, value):
+        arr_values, leftover = value
+        result = b''
+        for index, item in enumerate(arr_values):
+            if item is not None:
+                data_type_index = item[0]  # index from VarInt
+                result += bytes([index]) + VARINT.serialize(data_type_index)
+                result += compile_types(TYPES[data_type_index.value]).serialize(item[1])
+        return result + leftover
+
+
+class SequenceCodec(Codec):
+    # ['varint', 'varint', 'byte']   =>   [45, 50, 0x5a]
+    # [parts] : list of (codec, [width] number of values, or None for a codec of a single value)
+    def __init__(self, parts):
+        self.parts = parts
+
+    def parse(self, buff):
+        result_array = []
+        for codec, width in self.parts:
+            if width is None:
+                result_array.append(codec.parse(buff))
+            else:  # fixed-width run
+                result_array += codec.parse(buff)
+        return result_array
+
+    def serialize(self, value):
+        result = []
+        index = 0
+        for codec, width in self.parts:
+            if width is None:
+                result.append(codec.serialize(value[index]))
+                index += 1
             else:
-                result += single_value.to_bytes()
-        elif type_str == 'position':
-            result += single_value.pack()
-        elif type_str == 'angle':
-            result += single_value.pack()
-
-
-        elif type_str == 'boolean':
-            result += np.int8(single_value).tobytes()
-        elif type_str == 'byte':
-            result += np.int8(single_value).tobytes()
-        elif type_str == 'ubyte':
-            result += np.int8(single_value).tobytes()
-        elif type_str == 'short':
-            result += np.short(single_value).tobytes()
-        elif type_str == 'ushort':
-            result += np.ushort(single_value).tobytes()
-        elif type_str == 'int':
-            result += struct.pack('>i', single_value)
-        elif type_str == 'long':
-            result += np.int64(single_value).tobytes()
-        elif type_str == 'double':
-            result += struct.pack('>d', single_value)
-        elif type_str == 'float':
-            result += struct.pack('>f', single_value)
+                result.append(codec.serialize(value[index:index + width]))
+                index += width
+        return b''.join(result)
+
+
+class ArrayCodec(Codec):
+    # [record_count] : pre-known array length, or < 1 if the length is the first VarInt in buff
+    # [record] : codec of one record, [width] : number of values in a record
+    # [array_type] : type of a single-type record that long arrays of it are decoded with NumPy (see read_array)
+    def __init__(self, record_count, record, width, array_type=None):
+        self.record_count = record_count
+        self.record = record
+        self.width = width
+        self.array_type = array_type
+
+    def parse(self, buff):
+        record_count = self.record_count
+        if record_count < 1:  # the array's length is not known, decode it from the first VarInt
+            record_count = VarInt(buffer=buff).value
+
+        if self.array_type is not None and record_count >= VECTORIZE_MIN:
+            return array_to_list(self.array_type, read_array(buff, self.array_type, record_count))
+
+        result_array = []
+        if self.record.fixed is not None:  # all the records at once, with the record's precompiled struct
+            size = self.record.struct.size * max(record_count, 0)
+            if buff.length() < size:  # checked before reading: the count comes from the wire
+                raise Exception("No bytes left in buffer:", bytes(buff.to_bytes()))
+            records = self.record.struct.iter_unpack(buff.peek_view(size))
+            buff.skip(size)
+            if self.record.plain:  # nothing to build, the values are the records
+                for values in records:
+                    result_array += values
+            else:
+                for values in records:
+                    result_array += self.record.build(values)
+            return result_array
+
+        for i in range(record_count):
+            result_array += self.record.parse(buff)
+        return result_array
+
+    def serialize(self, value):
+        if self.array_type is not None and len(value) >= VECTORIZE_MIN:
+            result = b''
+            if self.record_count < 1:
+                result += varint_bytes(len(value))
+            return result + write_array(self.array_type, value)
+
+        width = self.width
+        separated_items = [value[x:x + width] for x in range(0, len(value), width)]
+        result = b''
+        if self.record_count < 1:  # the array's length is not known, prefix VarInt length
+            result += VARINT.serialize(len(separated_items))
+        return result + b''.join([self.record.serialize(item) for item in separated_items])
+
+
+# Long arrays (at least VECTORIZE_MIN records) of these types are decoded / encoded with NumPy
+VECTORIZE_MIN = 32
+ARRAY_DTYPES = {'byte': '>i1', 'ubyte': 'u1', 'boolean': 'u1', 'short': '>i2', 'ushort': '>u2', 'int': '>i4',
+                'long': '>i8', 'float': '>f4', 'double': '>f8', 'position': '>i8', 'varint': None}
+
+'''
+    Reads [record_count] values of [type_str] from buff into a NumPy array, in one np.frombuffer call
+    'position' arrays are read into a (record_count, 3) array of x, y, z
+'''
+
+
+def read_array(buff, type_str, record_count):
+    import numpy as np
+    if type_str == 'varint':
+        return _read_varint_array(buff, record_count)
+
+    dtype = np.dtype(ARRAY_DTYPES[type_str])
+    size = dtype.itemsize * record_count
+    if buff.length() < size:
+        raise Exception("No bytes left in buffer:", bytes(buff.to_bytes()))
+    values = np.frombuffer(buff.peek_view(size), dtype=dtype).astype(dtype.newbyteorder('='))
+    buff.skip(size)
+
+    if type_str == 'position':  # x: 26 MSBs, z: 26 middle bits, y: 12 LSBs
+        positions = np.empty((record_count, 3), dtype=np.int32)
+        positions[:, 0] = values >> 38
+        positions[:, 1] = (values << 52) >> 52
+        positions[:, 2] = (values << 26) >> 38
+        return positions
+    return values
+
+
+def _read_varint_array(buff, record_count):
+    import numpy as np
+    data = np.frombuffer(buff.peek_view(record_count * 5), dtype=np.uint8)
+    ends = np.flatnonzero(data < 0x80)[:record_count]  # the last byte of every VarInt
+    if len(ends) < record_count:
+        raise Exception("No bytes left in buffer:", bytes(buff.to_bytes()))
+    if record_count == 0:
+        return np.zeros(0, dtype=np.int32)
+    total = int(ends[-1]) + 1
+
+    starts = np.empty(record_count, dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+    if lengths.max() > 5:
+        raise Exception("VarInt is too big")
+    shifts = (np.arange(total) - np.repeat(starts, lengths)) * 7
+    parts = (data[:total].astype(np.uint64) & 0x7F) << shifts.astype(np.uint64)
+    values = np.add.reduceat(parts, starts)  # the parts don't overlap, so adding is OR-ing
+    buff.skip(total)
+    return values.astype(np.uint32).view(np.int32)
+
+
+'''
+    Encodes [values] (a list or a NumPy array) of [type_str], in one call
+'''
+
+
+def write_array(type_str, values):
+    import numpy as np
+    if type_str == 'varint':
+        return _write_varint_array(np.asarray(values, dtype=np.int64))
+    if type_str == 'position':
+        if len(values) and type(values[0]) == PositionT:
+            values = [(p.x, p.y, p.z) for p in values]
+        positions = np.asarray(values, dtype=np.int64).reshape(-1, 3)
+        values = (positions[:, 0] & 0x3FFFFFF) << 38 | (positions[:, 2] & 0x3FFFFFF) << 12 | (positions[:, 1] & 0xFFF)
+    return np.asarray(values).astype(ARRAY_DTYPES[type_str]).tobytes()
+
+
+def _write_varint_array(values):
+    import numpy as np
+    values = values.astype(np.uint32)  # negative numbers are sent as unsigned 32 bit
+    lengths = np.ones(len(values), dtype=np.int64)
+    for bits in (7, 14, 21, 28):
+        lengths += values >= (1 << bits)
+    starts = np.cumsum(lengths) - lengths
+    result = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for i in range(5):
+        has_byte = lengths > i
+        byte = (values[has_byte] >> (7 * i)) & 0x7F
+        byte |= (lengths[has_byte] > i + 1).astype(np.uint32) << 7  # more bytes follow
+        result[starts[has_byte] + i] = byte
+    return result.tobytes()
+
+
+'''
+    Converts an array from read_array to the values parse_types returns for the same type
+'''
+
+
+def array_to_list(type_str, array):
+    if type_str == 'varint':
+        return [VarInt(value=value) for value in array.tolist()]
+    elif type_str == 'position':
+        return [PositionT(x=x, y=y, z=z) for x, y, z in array.tolist()]
+    return array.tolist()
+
+
+def _fixed_scalar(type_str):
+    if type_str == 'uuid':
+        return FixedCodec('dd', list, tuple)
+    elif type_str == 'angle':
+        return FixedCodec('B', lambda values: AngleT(angle=values[0]), lambda value: (value.angle,))
+    elif type_str == 'position':
+        return FixedCodec('Q', lambda values: PositionT(value=values[0]), lambda value: (value.to_long(),))
+    return FixedCodec(FIXED_FORMATS[type_str], lambda values: values[0], lambda value: (value,), number=True)
+
+
+'''
+    A fixed-width codec of a sequence of fixed-width codecs, builds the list of their values
+'''
+
+
+def _fixed_run(codecs):
+    fmt = ''.join([codec.fixed for codec in codecs])
+    if all([codec.number for codec in codecs]):
+        return FixedCodec(fmt, list, tuple, plain=True)  # the struct values are the result
+
+    bounds = []
+    start = 0
+    for codec in codecs:
+        bounds.append((codec, start, start + codec.n_values))
+        start += codec.n_values
+
+    def build(values):
+        return [codec.build(values[start:end]) for codec, start, end in bounds]
+
+    def flatten(value):
+        result = []
+        for codec, item in zip(codecs, value):
+            result += codec.flatten(item)
+        return result
+
+    return FixedCodec(fmt, build, flatten)
+
+
+'''
+    A fixed-width codec of [record_count] records (each [width] values), builds the records' values one after another
+'''
+
+
+def _fixed_array(record, width, record_count):
+    fmt = record.fixed * record_count
+    if record.plain:
+        return FixedCodec(fmt, list, tuple, plain=True)
+
+    n_values = record.n_values
+
+    def build(values):
+        result_array = []
+        for i in range(record_count):
+            result_array += record.build(values[i * n_values:(i + 1) * n_values])
+        return result_array
+
+    def flatten(value):
+        result = []
+        for x in range(0, len(value), width):
+            result += record.flatten(value[x:x + width])
+        return result
+
+    return FixedCodec(fmt, build, flatten)
+
+
+def _sequence(types_list):
+    codecs = [_compile(item_type) for item_type in types_list]
+    parts = []
+    run = []
+    for codec in codecs + [None]:
+        if codec is not None and codec.fixed is not None:
+            run.append(codec)
+            continue
+        if run:  # close the fixed-width run
+            parts.append((_fixed_run(run), len(run)))
+            run = []
+        if codec is not None:
+            parts.append((codec, None))
 
+    if len(parts) == 1 and parts[0][1] is not None:
+        return parts[0][0]  # a fixed-width sequence
+    return SequenceCodec(parts)
 
+
+def _compile(types_obj):
+    if type(types_obj) == str:
+        type_str = types_obj
+        if type_str.startswith('opt|'):
+            return OptionalCodec(compile_types(type_str[4:]))
+        elif type_str in FIXED_FORMATS:
+            return _fixed_scalar(type_str)
+        elif type_str == 'varint':
+            return VarIntCodec()
         elif type_str == 'string':
-            if type(single_value) != bytes:
-                single_value = single_value.encode()
-            length = VarInt(value=len(single_value))
-            result += length.to_bytes() + single_value
-        elif type_str == 'json':
-            result += serialize_types('string', json.dumps(single_value))
-        elif type_str == 'uuid':
-            result += serialize_types(['double', 'double'], single_value)
-        elif type_str == 'chat':
-            result += serialize_types('json', single_value)
+            return StringCodec()
+        elif type_str in ['json', 'chat']:
+            return JsonCodec()
         elif type_str == 'slot':
-            result += single_value.to_bytes()
+            return SlotCodec()
+        elif type_str == 'entity_metadata':
+            return EntityMetadataCodec()
 
+    elif type(types_obj) in [list, tuple] and len(types_obj) > 0:
+        if type(types_obj[0]) == int:  # first item is pre-known array length / the length is the first VarInt in buff
+            record = _sequence(types_obj[1:])
+            width = len(types_obj) - 1
+            if types_obj[0] >= 1 and record.fixed is not None:  # fixed-width array
+                return _fixed_array(record, width, types_obj[0])
+            array_type = types_obj[1] if width == 1 and type(types_obj[1]) == str and types_obj[1] in ARRAY_DTYPES \
+                else None
+            return ArrayCodec(types_obj[0], record, width, array_type)
+        else:  # not an actual array, just a couple of types
+            return _sequence(types_obj)
 
-        elif type_str == "entity_metadata":
-            arr_values = single_value[0]
-            leftover = single_value[1]
+    raise ValueError("Unidentified type to parse")
 
-            for index, item in enumerate(arr_values):
-                if item is not None:
-                    data_type_index = item[0]  # index from VarInt
-                    result += serialize_types(['ubyte', 'varint'], (index, data_type_index))
-                    item_value = item[1]
-                    data_type = TYPES[data_type_index.value]
-                    result += serialize_types([data_type], [item_value])
-            result += leftover
 
-        else:
-            raise ValueError("Unidentified type to parse")
+def _schema_key(types_obj):
+    if type(types_obj) in [list, tuple]:
+        return tuple([_schema_key(item) for item in types_obj])
+    return types_obj
 
-    elif type(types_obj) == list and len(types_obj) > 0:
-        if type(types_obj[0]) == int:  # first item is pre-known array length / the length is the first VarInt in buff
 
-            sub_list_len = len(types_obj[1:])  # without the int at the beginning
-            separated_items = [variables_tup[x:x + sub_list_len] for x in range(0, len(variables_tup), sub_list_len)]
-            record_count = len(separated_items)
-            if types_obj[0] < 1:  # means that the array's length is not known. encode it to a VarInt
-                result += serialize_types('varint', record_count)  # prefix VarInt length
+_codecs = {}
 
-            types_obj.pop(0)
-            for item in separated_items:
-                result += serialize_types(types_obj, item)
+'''
+    Returns the (cached) codec of the type descriptor [types_obj]
+'''
 
-        else:  # not an actual array, just a couple of types
-            # ['varint', 'varint', 'byte']   =>   [45, 50, 0x5a]
-            for item_type, item_value in zip(types_obj, variables_tup):
-                result += serialize_types(item_type[:], item_value)
-    return result
+
+def compile_types(types_obj):
+    key = _schema_key(types_obj)
+    codec = _codecs.get(key)
+    if codec is None:
+        codec = _compile(types_obj)
+        _codecs[key] = codec
+    return codec
+
+
+VARINT = compile_types('varint')
+STRING = compile_types('string')
+
+
+def parse_types(types_obj, buff):
+    return compile_types(types_obj).parse(buff)
+
+
+def serialize_types(types_obj, variables_tup):
+    return compile_types(types_obj).serialize(variables_tup)
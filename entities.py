@@ -0,0 +1,318 @@
+#######################################
+#		Created by Gilad Savoray
+#               May 2021
+#######################################
+
+# The entities the client knows about, by entity ID
+# Records are added by the spawn packets, moved by the movement packets,
+# and removed by Destroy Entities (0x38) & Respawn (0x3B), so the table only holds what the client can see.
+# The positions live in one NumPy array (a row per entity), with a uniform grid over it for the
+# nearest / radius / crosshair queries
+import threading
+import math
+
+import numpy as np
+
+from dataTypes import *
+
+# Only the first fields of the packets are read
+SPAWN_OBJECT = compile_types(['varint', 'uuid', 'varint', [3, 'double']])  # Spawn Entity (0x00), Spawn Mob (0x03)
+SPAWN_PLAYER = compile_types(['varint', 'uuid', [3, 'double']])  # Spawn Player (0x05)
+ENTITY_MOVE = compile_types(['varint', [3, 'short']])  # Entity Position (0x29), Entity Position and Rotation (0x2A)
+ENTITY_TELEPORT_POSITION = compile_types(['varint', [3, 'double']])  # Entity Teleport (0x57)
+
+# The player's own position
+PLAYER_POSITION = compile_types([[3, 'double']])  # c2s Player Position (0x11)
+PLAYER_POSITION_ROTATION = compile_types([[3, 'double'], 'float', 'float'])  # c2s 0x12, s2c 0x36 (+ flags)
+PLAYER_ROTATION = compile_types(['float', 'float'])  # c2s Player Rotation (0x13)
+
+PLAYER_TYPE = 105  # entity type ID of players in 1.15.2
+MOVE_SCALE = 4096  # relative moves are in 1/4096 of a block
+EYE_HEIGHT = 1.62
+
+CELL_SIZE = 16.0  # grid cell edge, in blocks
+_CELL_XZ_BITS = 22  # bits of x & z in a cell key: +-2^21 cells, past the world border (+-30M blocks)
+_CELL_Y_BITS = 19  # 22 + 19 + 22 = 63 bits, the keys are positive int64
+_CELL_LOW = np.array([-(1 << (_CELL_XZ_BITS - 1)), -(1 << (_CELL_Y_BITS - 1)), -(1 << (_CELL_XZ_BITS - 1))])
+_CELL_HIGH = -_CELL_LOW - 1
+MAX_GRID_CELLS = 4096  # a query that covers more cells scans all the rows instead
+
+
+# Cell coordinates of [positions] (n, 3), beyond the keys' range they are the edge cell (queries filter by distance)
+def _cells(positions):
+    return np.clip(np.floor(np.asarray(positions) / CELL_SIZE), _CELL_LOW, _CELL_HIGH).astype(np.int64)
+
+
+def _cell_keys(cx, cy, cz):  # one int64 per cell, z is the lowest part (cells along z are consecutive keys)
+    return (((cx - _CELL_LOW[0]) << (_CELL_Y_BITS + _CELL_XZ_BITS)) | ((cy - _CELL_LOW[1]) << _CELL_XZ_BITS) |
+            (cz - _CELL_LOW[2]))
+
+
+class EntityRecord:
+    __slots__ = ['entity_id', 'type', 'row', 'flags']
+
+    def __init__(self, entity_id, type_, row):
+        self.entity_id = entity_id
+        self.type = type_  # None until the entity was spawned
+        self.row = row  # row in EntityTable.positions, None while the position is unknown (not in the queries)
+        self.flags = 0  # metadata index 0 (bit mask: on fire, crouching, ..., glowing 0x40)
+
+    def __repr__(self):
+        return f'Entity[{self.entity_id}, type={self.type}]'
+
+
+class EntityTable:
+    def __init__(self, capacity=256):
+        self.__lock = threading.RLock()
+        self.entities = {}  # entity ID => EntityRecord
+        self.positions = np.zeros((capacity, 3), dtype=np.float64)
+        self.ids = np.full(capacity, -1, dtype=np.int64)  # entity ID of every row, -1 = free row
+        self._free_rows = list(range(capacity - 1, -1, -1))
+        self._pending_moves = []  # (entity ID, dx, dy, dz) not applied yet, see flush_moves
+        self._grid = None  # (sorted cell keys, their rows), rebuilt on the first query after a change
+
+        self.player = np.zeros(3, dtype=np.float64)  # x, feet y, z of the player himself
+        self.yaw = 0.0
+        self.pitch = 0.0
+
+    def __len__(self):
+        return len(self.entities)
+
+    def get(self, entity_id):
+        return self.entities.get(entity_id)
+
+    def position(self, entity_id):
+        with self.__lock:
+            self.flush_moves()
+            record = self.entities.get(entity_id)
+            if record is None or record.row is None:
+                return None
+            return tuple(self.positions[record.row].tolist())
+
+    def __record(self, entity_id):
+        record = self.entities.get(entity_id)
+        if record is None:  # spawned before the proxy saw it: no row until its position is known
+            record = self.entities[entity_id] = EntityRecord(entity_id, None, None)
+        return record
+
+    def __add(self, entity_id, type_, position):
+        record = EntityRecord(entity_id, type_, None)
+        self.entities[entity_id] = record
+        self.__place(record, position)
+        return record
+
+    # Gives [record] a row at [position]
+    def __place(self, record, position):
+        if not self._free_rows:  # grow
+            capacity = len(self.ids)
+            self.positions = np.concatenate((self.positions, np.zeros((capacity, 3), dtype=np.float64)))
+            self.ids = np.concatenate((self.ids, np.full(capacity, -1, dtype=np.int64)))
+            self._free_rows = list(range(2 * capacity - 1, capacity - 1, -1))
+        record.row = self._free_rows.pop()
+        self.ids[record.row] = record.entity_id
+        self.positions[record.row] = position
+        self._grid = None
+
+    def __remove(self, entity_id):
+        record = self.entities.pop(entity_id, None)
+        if record is not None and record.row is not None:
+            self.ids[record.row] = -1
+            self._free_rows.append(record.row)
+            self._grid = None
+
+    def spawn(self, entity_id, type_, x, y, z):
+        with self.__lock:
+            self.flush_moves()
+            self.__remove(entity_id)
+            self.__add(entity_id, type_, (x, y, z))
+
+    '''
+    Reads a spawn packet (without the packet ID) from buff
+    '''
+
+    def spawn_object(self, buff):
+        entity_id, uuid, type_, (x, y, z) = SPAWN_OBJECT.parse(buff)
+        self.spawn(entity_id.value, type_.value, x, y, z)
+
+    def spawn_player(self, buff):
+        entity_id, uuid, (x, y, z) = SPAWN_PLAYER.parse(buff)
+        self.spawn(entity_id.value, PLAYER_TYPE, x, y, z)
+
+    '''
+    Reads an Entity Position / Entity Position and Rotation packet (without the packet ID) from buff
+    The move is only queued, the queued moves are applied together by flush_moves()
+    '''
+
+    def move(self, buff):
+        entity_id, (dx, dy, dz) = ENTITY_MOVE.parse(buff)
+        with self.__lock:
+            self._pending_moves.append((entity_id.value, dx, dy, dz))
+
+    '''
+    Applies the queued relative moves, all at once
+    '''
+
+    def flush_moves(self):
+        with self.__lock:
+            if not self._pending_moves:
+                return
+            moves = np.array(self._pending_moves, dtype=np.int64)
+            self._pending_moves = []
+
+            entities = self.entities
+            records = [entities.get(entity_id) for entity_id in moves[:, 0].tolist()]
+            rows = np.array([-1 if record is None or record.row is None else record.row for record in records],
+                            dtype=np.intp)
+            known = rows >= 0  # a relative move of an unknown entity has nothing to be relative to
+            np.add.at(self.positions, rows[known], moves[known, 1:] / MOVE_SCALE)  # repeated rows add up
+            self._grid = None
+
+    def teleport(self, buff):
+        entity_id, (x, y, z) = ENTITY_TELEPORT_POSITION.parse(buff)
+        with self.__lock:
+            self.flush_moves()
+            record = self.__record(entity_id.value)
+            if record.row is None:
+                self.__place(record, (x, y, z))
+            else:
+                self.positions[record.row] = (x, y, z)
+                self._grid = None
+
+    def set_flags(self, entity_id, flags):
+        with self.__lock:
+            self.__record(entity_id).flags = flags
+
+    '''
+    Reads a Destroy Entities packet (without the packet ID) from buff
+    '''
+
+    def destroy(self, buff):
+        with self.__lock:
+            self.flush_moves()
+            for i in range(VARINT.parse(buff).value):
+                self.__remove(VARINT.parse(buff).value)
+
+    def clear(self):
+        with self.__lock:
+            self._pending_moves = []
+            for entity_id in list(self.entities.keys()):
+                self.__remove(entity_id)
+
+    #       --- THE PLAYER ---
+
+    def player_position(self, buff):
+        with self.__lock:
+            self.player[:] = PLAYER_POSITION.parse(buff)[0]
+
+    def player_position_rotation(self, buff):
+        position, yaw, pitch = PLAYER_POSITION_ROTATION.parse(buff)
+        with self.__lock:
+            self.player[:] = position
+            self.yaw, self.pitch = yaw, pitch
+
+    def player_rotation(self, buff):
+        yaw, pitch = PLAYER_ROTATION.parse(buff)
+        with self.__lock:
+            self.yaw, self.pitch = yaw, pitch
+
+    '''
+    Reads a s2c Player Position And Look packet (without the packet ID) from buff
+    '''
+
+    def player_teleport(self, buff):
+        position, yaw, pitch = PLAYER_POSITION_ROTATION.parse(buff)
+        flags = buff.next_byte()  # relative fields: x 0x01, y 0x02, z 0x04, yaw 0x08, pitch 0x10
+        with self.__lock:
+            for axis in range(3):
+                if flags & (1 << axis):
+                    self.player[axis] += position[axis]
+                else:
+                    self.player[axis] = position[axis]
+            self.yaw = self.yaw + yaw if flags & 0x08 else yaw
+            self.pitch = self.pitch + pitch if flags & 0x10 else pitch
+
+    #       --- QUERIES ---
+
+    def __grid(self):
+        if self._grid is None:
+            rows = np.flatnonzero(self.ids >= 0)
+            cells = _cells(self.positions[rows])
+            keys = _cell_keys(cells[:, 0], cells[:, 1], cells[:, 2])
+            order = np.argsort(keys, kind='stable')
+            self._grid = (keys[order], rows[order])
+        return self._grid
+
+    '''
+    Returns the rows of the entities in the grid cells that intersect the box center +- radius
+    '''
+
+    def __candidate_rows(self, center, radius):
+        keys, rows = self.__grid()
+        low = _cells(np.asarray(center) - radius)
+        high = _cells(np.asarray(center) + radius)
+        spans = high - low + 1
+        if spans[0] * spans[1] * spans[2] > MAX_GRID_CELLS:
+            return rows
+
+        # cells along z have consecutive keys, one searchsorted range per (x, y) column of cells
+        cx, cy = np.meshgrid(np.arange(low[0], high[0] + 1), np.arange(low[1], high[1] + 1), indexing='ij')
+        starts = np.searchsorted(keys, _cell_keys(cx.ravel(), cy.ravel(), low[2]), side='left')
+        ends = np.searchsorted(keys, _cell_keys(cx.ravel(), cy.ravel(), high[2]), side='right')
+        return np.concatenate([rows[start:end] for start, end in zip(starts.tolist(), ends.tolist())] +
+                              [np.zeros(0, dtype=rows.dtype)])
+
+    '''
+    Returns a list of (entity ID, distance) of the entities within [radius] of [center], nearest first
+    '''
+
+    def within(self, center, radius, exclude=None):
+        with self.__lock:
+            self.flush_moves()
+            rows = self.__candidate_rows(center, radius)
+            distances = np.linalg.norm(self.positions[rows] - np.asarray(center), axis=1)
+            inside = distances <= radius
+            rows, distances = rows[inside], distances[inside]
+            order = np.argsort(distances, kind='stable')
+            return [(entity_id, distance) for entity_id, distance in
+                    zip(self.ids[rows[order]].tolist(), distances[order].tolist()) if entity_id != exclude]
+
+    '''
+    Returns the ID of the entity nearest to [center] (within [max_distance]), or None
+    The search radius grows cell by cell, so only the nearby part of the grid is scanned
+    '''
+
+    def nearest(self, center, max_distance=256.0, exclude=None):
+        radius = CELL_SIZE
+        while True:
+            radius = min(radius, max_distance)
+            found = self.within(center, radius, exclude)
+            if found or radius >= max_distance:
+                return found[0][0] if found else None
+            radius *= 2
+
+    def nearest_to_player(self, max_distance=256.0, exclude=None):
+        return self.nearest(self.player.copy(), max_distance, exclude)
+
+    '''
+    Returns the ID of the entity under the player's crosshair (within [max_distance] blocks), or None
+    An entity is hit if the look ray passes within [hit_radius] of its position (half a block above its feet)
+    '''
+
+    def under_crosshair(self, max_distance=64.0, hit_radius=0.8, exclude=None):
+        exclude = -1 if exclude is None else exclude
+        with self.__lock:
+            eye = self.player + (0.0, EYE_HEIGHT, 0.0)
+            yaw, pitch = math.radians(self.yaw), math.radians(self.pitch)
+        direction = np.array([-math.sin(yaw) * math.cos(pitch), -math.sin(pitch), math.cos(yaw) * math.cos(pitch)])
+
+        with self.__lock:
+            self.flush_moves()
+            rows = self.__candidate_rows(eye, max_distance)
+            offsets = self.positions[rows] + (0.0, 0.5, 0.0) - eye
+            along = offsets @ direction  # distance along the ray
+            across = np.linalg.norm(offsets - np.outer(along, direction), axis=1)  # distance from the ray
+            hits = (along > 0) & (along <= max_distance) & (across <= hit_radius) & (self.ids[rows] != exclude)
+            if not hits.any():
+                return None
+            hit_rows = rows[hits]
+            return int(self.ids[hit_rows[np.argmin(along[hits])]])
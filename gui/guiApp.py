@@ -15,7 +15,8 @@ from dataTypes import *
 class GuiApp:
     names = ['clientIP', 'clientPort', 'serverIP', 'serverPort', 'CustomMOTD', 'CustomHeader', 'EnableFakename',
              'FakenameInput', 'EnableFlying', 'movementSpeed', 'BuildingRadio', 'DropSteering', 'DropEntityMovement',
-             'EnableCamera', "clientIP", "clientPort", "serverIP", "serverPort"]
+             'EnableCamera', 'ThrottleEntityMovement', 'EntityMoveInterval', "clientIP", "clientPort", "serverIP",
+             "serverPort"]
 
     def __init__(self, fake_game):
         self._local_preferences = {}
@@ -41,12 +42,12 @@ class GuiApp:
     '''
 
     def change_game_obj(self, new_game_obj):
+        preferences = dict(self.game.mods())  # the ones without a widget too (see load_preferences_from_file)
         for item in self.names:
-            old_data = self.game.get_mod(item)
-            if old_data is not None:
-                new_game_obj.set_mod(item, old_data)
-            else:
-                new_game_obj.set_mod(item, get_value(item))
+            if preferences.get(item) is None:
+                preferences[item] = get_value(item)
+        new_game_obj.set_mods(preferences)
+        new_game_obj.compressors = self.game.compressors
         self.game = new_game_obj
         self.game.gui_obj = self
 
@@ -60,14 +61,15 @@ class GuiApp:
         except FileNotFoundError:
             pass
         finally:
-            for item_name in self.names:  # in file
-                if item_name in self._local_preferences.keys():
-                    item_value = self._local_preferences[item_name]
-                    set_value(item_name, item_value)
-                    self.game.set_mod(item_name, item_value)
+            # preferences without a widget come from the file or mc_proxy.DEFAULT_PREFERENCES
+            preferences = {**main.DEFAULT_PREFERENCES, **self._local_preferences}
+            for item_name in self.names:
+                if item_name in self._local_preferences.keys():  # in file
+                    set_value(item_name, self._local_preferences[item_name])
                 else:  # not in file
-                    item_value = get_value(item_name)
-                    self.game.set_mod(item_name, item_value)
+                    preferences[item_name] = get_value(item_name)
+            self.game.set_mods(preferences)
+            self.game.compressors = main.compressors_from_preferences(self.game)
 
     def save_preferences_to_file(self):
         with open('gui/preferences.gui', "w+") as json_file:
@@ -144,12 +146,17 @@ class GuiApp:
                     add_checkbox(name="DropSteering", label="Drop horse steer packets", callback=self.update_item)
                     add_checkbox(name="DropEntityMovement", label="Drop other entity movement",
                                  callback=self.update_item)
+                    add_checkbox(name="ThrottleEntityMovement", label="Throttle other entity movement",
+                                 callback=self.update_item)
+                    add_text(name='throttle1', default_value="Entity update interval (seconds)")
+                    add_slider_float(name="EntityMoveInterval", label="", callback=self.update_item, min_value=0.05,
+                                     max_value=1.0, default_value=0.2)
 
     def update_item(self, caller, data_):
+        item_value = get_value(caller)
+        self.game.set_mod(caller, item_value)  # before the message: the proxy may handle it at once
         msg = main.PreferenceUpdateMessage(caller)
         self.game.preference_update_queue.append_one(msg)
-        item_value = get_value(caller)
-        self.game.set_mod(caller, item_value)
         self._local_preferences[caller] = item_value
         self.save_preferences_to_file()
 
@@ -0,0 +1,138 @@
+#######################################
+#		Created by Gilad Savoray
+#               May 2021
+#######################################
+
+# Runs the proxy without the GUI (no DearPyGUI, NumPy is only imported if a mod needs it).
+# The preferences are read from the GUI's preferences file, and can be overridden by flags:
+#   python headless.py
+#   python headless.py --listen 0.0.0.0:25566 --server mc.example.com:25565 --set EnableFlying=true
+#   python headless.py --engine threaded          # the GUI's engine (one client at a time)
+#   python headless.py --workers 4                # 4 processes on the same port (see workers.py), 0 = one per core
+import argparse
+import json
+import sys
+import threading
+import time
+
+from mc_proxy import Game, ProxyController, STATUS_TEXTS, load_preferences, compressors_from_preferences, start_proxy
+
+
+class HeadlessController(ProxyController):
+    # [on_status] : called with (status, text) on every status change, prints by default (None)
+    def __init__(self, game, on_status=None):
+        super().__init__(game)
+        self.on_status = on_status if on_status is not None else print_status
+        self._last_status = None
+
+    def change_status_label(self, status):
+        if status == self._last_status:
+            return
+        self._last_status = status
+        text = STATUS_TEXTS.get(status, str(status))
+        if status == 3 and self.game.login_username is not None:  # threaded engine: the Game of the connection
+            text += f" as {self.game.login_username} (PID {self.game.pid})"
+        self.on_status(status, text)
+
+
+def print_status(status, text):
+    print(f"[{time.strftime('%H:%M:%S')}] {text}", flush=True)
+
+
+'''
+    Splits 'host:port' (the host may be omitted: ':25566')
+'''
+
+
+def address(value):
+    host, sep, port = value.rpartition(':')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected host:port, got {value!r}")
+    return host or 'localhost', int(port)
+
+
+'''
+    NAME=VALUE preference override, VALUE is read as JSON if it can be (true, 0.2, "text"), else as a string
+'''
+
+
+def preference(value):
+    name, sep, raw_value = value.partition('=')
+    if not sep or not name:
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE, got {value!r}")
+    try:
+        return name, json.loads(raw_value)
+    except ValueError:
+        return name, raw_value
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Minecraft 1.15.2 proxy, without the GUI")
+    parser.add_argument('--preferences', default='gui/preferences.gui', help="preferences file (JSON) of the GUI")
+    parser.add_argument('--listen', type=address, help="host:port the proxy listens on (clientIP:clientPort)")
+    parser.add_argument('--server', type=address, help="host:port of the original server (serverIP:serverPort)")
+    parser.add_argument('--set', type=preference, action='append', default=[], metavar='NAME=VALUE',
+                        help="override a preference (repeatable)")
+    parser.add_argument('--engine', choices=['async', 'threaded'], default='async',
+                        help="async: many clients on one event loop, threaded: the GUI's engine (one client)")
+    parser.add_argument('--workers', type=int, metavar='N',
+                        help="run N async engine processes on the same port (0 = one per core), Linux / BSD only")
+    parser.add_argument('--quiet', action='store_true', help="no status lines")
+    return parser.parse_args(argv)
+
+
+'''
+    Returns the settings Game: the preferences file, then the flags
+'''
+
+
+def load_settings(args):
+    settings = Game()
+    load_preferences(settings, args.preferences)
+    overrides = list(args.set)
+    if args.listen:
+        overrides += [('clientIP', args.listen[0]), ('clientPort', args.listen[1])]
+    if args.server:
+        overrides += [('serverIP', args.server[0]), ('serverPort', args.server[1])]
+    for name, value in overrides:
+        settings.set_mod(name, value)
+    if overrides:
+        settings.compressors = compressors_from_preferences(settings)  # the compression preferences may have changed
+    return settings
+
+
+def main(argv=None, on_status=None):
+    args = parse_args(argv)
+    settings = load_settings(args)
+    if args.quiet and on_status is None:
+        on_status = lambda status, text: None
+    controller = HeadlessController(settings, on_status)
+    settings.gui_obj = controller
+
+    if args.workers is not None:
+        if args.engine != 'async':
+            print("--workers runs the async engine only", file=sys.stderr)
+            return 2
+        from workers import Supervisor
+        Supervisor(settings, args.workers, args.quiet).run()
+        return 0
+
+    if args.engine == 'async':
+        from async_proxy import AsyncProxy  # asyncio is only imported by the engine that uses it
+        AsyncProxy(settings, *settings.sockets_info()).run()
+        return 0
+
+    controller.run_proxy = True
+    proxy_thread = threading.Thread(target=start_proxy, args=(controller,), daemon=True)
+    proxy_thread.start()
+    try:
+        while proxy_thread.is_alive():
+            proxy_thread.join(0.5)
+    except KeyboardInterrupt:
+        controller.stop()
+        proxy_thread.join(5)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,481 @@
+#######################################
+#		Created by Gilad Savoray
+#               May 2021
+#######################################
+
+# End-to-end load test without the game: a local stand-in 1.15.2 server and N headless bots that log in
+# through the proxy, walk around and chat, while the server streams chunks, entity moves and keep-alives.
+# Every Keep Alive carries the time it was sent (perf_counter_ns, one process => one clock), which gives the
+# latency of each direction. The proxy runs in its own process (AsyncProxy), unless --proxy points to one.
+#   python load_test.py --bots 50 --duration 30                   # through a spawned AsyncProxy
+#   python load_test.py --bots 50 --direct                        # straight to the server (the baseline)
+#   python load_test.py --bots 50 --compare-direct                # both, and the latency the proxy adds
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import time
+import zlib
+
+from dataTypes import *
+from mc_proxy import FrameReader
+
+PROTOCOL_VERSION = 578
+TICK = 0.05  # seconds, 20 ticks per second like the game
+
+HANDSHAKE = compile_types(['varint', 'string', 'ushort', 'varint'])
+LONG = compile_types('long')
+JOIN_GAME = compile_types(['int', 'ubyte', 'int', 'long', 'ubyte', 'string', 'varint', 'boolean', 'boolean'])
+PLAYER_POSITION_LOOK = compile_types([[3, 'double'], [2, 'float'], 'byte', 'varint'])
+PLAYER_POSITION = compile_types([[3, 'double'], 'boolean'])
+SPAWN_LIVING_ENTITY = compile_types(['varint', 'uuid', 'varint', [3, 'double'], [3, 'angle'], [3, 'short']])
+ENTITY_POSITION = compile_types(['varint', [3, 'short'], 'boolean'])
+CHAT = compile_types(['chat', 'byte'])
+CHUNK_POSITION = compile_types(['int', 'int'])
+
+# Packet IDs (PLAY state unless noted)
+S2C_STATUS_RESPONSE, S2C_PONG = 0x00, 0x01  # STATUS
+S2C_LOGIN_SUCCESS, S2C_SET_COMPRESSION = 0x02, 0x03  # LOGIN
+S2C_SPAWN_LIVING_ENTITY, S2C_CHAT, S2C_CHUNK_DATA, S2C_KEEP_ALIVE = 0x03, 0x0F, 0x22, 0x21
+S2C_JOIN_GAME, S2C_ENTITY_POSITION, S2C_PLAYER_POSITION_LOOK = 0x26, 0x29, 0x36
+C2S_TELEPORT_CONFIRM, C2S_CHAT, C2S_KEEP_ALIVE, C2S_PLAYER_POSITION = 0x00, 0x03, 0x0F, 0x11
+
+
+class PacketStream:
+    # Framing & compression of one asyncio connection
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.frames = FrameReader()
+        self.compression = None  # threshold, None = not compressed
+        self.received = 0  # packets
+        self.received_bytes = 0
+
+    '''
+    Returns the next packet as ([packet ID], [data] Buffer), raises EOFError when the connection was closed
+    '''
+
+    async def read(self):
+        frame = self.frames.next_frame()
+        while frame is None:
+            data = await self.reader.read(FrameReader.RECV_SIZE)
+            if not data:
+                raise EOFError
+            self.frames.feed(data)
+            frame = self.frames.next_frame()
+        length, data = frame
+        self.received += 1
+        self.received_bytes += len(data)
+        buff = Buffer(data)
+        if self.compression is not None and VARINT.parse(buff).value != 0:
+            buff = Buffer(zlib.decompress(bytes(buff.to_bytes())))
+        return VARINT.parse(buff).value, buff
+
+    '''
+    Queues a packet (call drain() to wait for it to be sent)
+    '''
+
+    def write(self, packet_id, data=b''):
+        if self.writer.is_closing():  # a send failed & closed it, drop the rest (asyncio warns on every write)
+            return
+        load = varint_bytes(packet_id) + data
+        if self.compression is not None:
+            if len(load) >= self.compression:
+                load = varint_bytes(len(load)) + zlib.compress(load, 1)
+            else:
+                load = b'\x00' + load
+        self.writer.write(varint_bytes(len(load)) + load)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+
+
+class Stats:
+    # Samples (nanoseconds) & counters of one run, only recorded once [recording] is set (after the warm-up)
+    def __init__(self):
+        self.recording = False
+        self.samples = {'s2c_latency': [], 'c2s_latency': [], 'chat_round_trip': [], 'login': []}
+        self.counters = {'s2c_packets': 0, 's2c_bytes': 0, 'c2s_packets': 0, 'c2s_bytes': 0}
+        self.started = None
+        self.stopped = None
+
+    def sample(self, name, nanoseconds):
+        if self.recording or name == 'login':
+            self.samples[name].append(nanoseconds)
+
+    def count(self, direction, stream):
+        if self.recording:
+            self.counters[direction + '_packets'] += stream.received
+            self.counters[direction + '_bytes'] += stream.received_bytes
+        stream.received = 0
+        stream.received_bytes = 0
+
+    def start(self):
+        self.recording = True
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.recording = False
+        self.stopped = time.perf_counter()
+
+    '''
+    Returns {sample name: {count, p50, p90, p99, max (milliseconds)}, counter name: total, ...per_sec: rate}
+    '''
+
+    def report(self):
+        report = {}
+        for name, values in self.samples.items():
+            report[name] = percentiles(values)
+        seconds = (self.stopped or time.perf_counter()) - (self.started or time.perf_counter())
+        for name, value in self.counters.items():
+            report[name] = value
+            report[name + '_per_sec'] = value / seconds if seconds > 0 else 0.0
+        report['seconds'] = seconds
+        return report
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    result = {'count': len(values)}
+    for name, fraction in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)]:
+        result[name] = values[min(len(values) - 1, int(fraction * len(values)))] / 1e6  # ms
+    return result
+
+
+class StandInServer:
+    # Speaks enough 1.15.2 for the bots: status & ping, login (with Set Compression), Join Game, a spawn teleport,
+    # then per player: [chunks] Chunk Data, [entities] spawned mobs, [entity_moves] Entity Position per second,
+    # a Keep Alive every [keep_alive] seconds, and an echo of every chat message
+    def __init__(self, stats, compression=256, chunks=49, entities=100, entity_moves=400, keep_alive=0.05):
+        self.stats = stats
+        self.compression = compression  # threshold, None = no Set Compression
+        self.chunks = chunks
+        self.entities = entities
+        self.entity_moves = entity_moves
+        self.keep_alive = keep_alive
+        self.port = None
+        self._server = None
+        self._chunk_data = None
+
+    async def start(self, ip='127.0.0.1', port=0):
+        self._server = await asyncio.start_server(self._handle, ip, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def close(self):
+        self._server.close()
+
+    async def _handle(self, reader, writer):
+        stream = PacketStream(reader, writer)
+        try:
+            packet_id, buff = await stream.read()
+            protocol, address, port, next_state = HANDSHAKE.parse(buff)
+            if next_state.value == 1:
+                await self._status(stream)
+            else:
+                await self._play(stream)
+        except (EOFError, OSError, IndexError, asyncio.CancelledError):
+            pass
+        finally:
+            stream.close()
+
+    async def _status(self, stream):
+        await stream.read()  # Request
+        stream.write(S2C_STATUS_RESPONSE, STRING.serialize(json.dumps(
+            {'version': {'name': '1.15.2', 'protocol': PROTOCOL_VERSION},
+             'players': {'max': 1000, 'online': 0}, 'description': {'text': 'Load test server'}})))
+        packet_id, buff = await stream.read()  # Ping
+        stream.write(S2C_PONG, bytes(buff.to_bytes()))
+        await stream.drain()
+
+    async def _play(self, stream):
+        packet_id, buff = await stream.read()  # Login Start
+        name = STRING.parse(buff).decode()
+        entity_id = random.randrange(1, 1 << 30)
+        if self.compression is not None:
+            stream.write(S2C_SET_COMPRESSION, varint_bytes(self.compression))
+            stream.compression = self.compression
+        stream.write(S2C_LOGIN_SUCCESS, STRING.serialize('00000000-0000-0000-0000-%012x' % entity_id) +
+                     STRING.serialize(name))
+        stream.write(S2C_JOIN_GAME, JOIN_GAME.serialize((entity_id, 1, 0, 0, 100, 'default', 10, False, True)))
+        stream.write(S2C_PLAYER_POSITION_LOOK, PLAYER_POSITION_LOOK.serialize(([0.5, 70.0, 0.5], [0.0, 0.0], 0, 1)))
+        side = max(1, int(self.chunks ** 0.5))
+        for i in range(self.chunks):
+            stream.write(S2C_CHUNK_DATA, self.chunk_data(i % side - side // 2, i // side - side // 2))
+        for i in range(self.entities):
+            stream.write(S2C_SPAWN_LIVING_ENTITY, SPAWN_LIVING_ENTITY.serialize(
+                (i + 1, (0, i), 50, [random.uniform(-64, 64), 70, random.uniform(-64, 64)], [AngleT()] * 3, [0, 0, 0])))
+        await stream.drain()
+
+        sender = asyncio.ensure_future(self._send_loop(stream))
+        try:
+            while True:
+                packet_id, buff = await stream.read()
+                if packet_id == C2S_KEEP_ALIVE:  # the bot puts the time it sent the answer in the ID
+                    self.stats.sample('c2s_latency', time.perf_counter_ns() - LONG.parse(buff))
+                elif packet_id == C2S_CHAT:
+                    message = STRING.parse(buff).decode()
+                    stream.write(S2C_CHAT, CHAT.serialize(({'text': message}, 0)))
+                self.stats.count('c2s', stream)
+        finally:
+            sender.cancel()
+
+    async def _send_loop(self, stream):
+        moves = 0.0
+        next_keep_alive = time.perf_counter()
+        while True:
+            await asyncio.sleep(TICK)
+            if stream.writer.is_closing():  # the peer is gone (drain() doesn't raise then)
+                break
+            if self.entities:
+                moves += self.entity_moves * TICK
+                for i in range(int(moves)):
+                    stream.write(S2C_ENTITY_POSITION, ENTITY_POSITION.serialize(
+                        (random.randrange(1, self.entities + 1),
+                         [random.randint(-512, 512), 0, random.randint(-512, 512)], True)))
+                moves -= int(moves)
+            now = time.perf_counter()
+            if now >= next_keep_alive:  # last, so it waits behind the tick's traffic like a real one would
+                stream.write(S2C_KEEP_ALIVE, LONG.serialize(time.perf_counter_ns()))
+                next_keep_alive = now + self.keep_alive
+            await stream.drain()
+
+    def chunk_data(self, chunk_x, chunk_z):
+        if self._chunk_data is None:
+            from benchmark import chunk_data_sample
+            self._chunk_data = chunk_data_sample()
+        return CHUNK_POSITION.serialize((chunk_x, chunk_z)) + self._chunk_data[8:]
+
+
+class Bot:
+    # A headless client: logs in, confirms the spawn teleport, answers keep-alives (with its own send time),
+    # walks [speed] blocks per second in a random direction and sends a chat message every [chat_interval] seconds
+    def __init__(self, name, stats, address, speed=4.3, chat_interval=5.0):
+        self.name = name
+        self.stats = stats
+        self.address = address
+        self.speed = speed
+        self.chat_interval = chat_interval
+        self.position = [0.5, 70.0, 0.5]
+        self.logged_in = asyncio.Event()
+
+    async def run(self):
+        start = time.perf_counter_ns()
+        reader, writer = await asyncio.open_connection(*self.address)
+        stream = PacketStream(reader, writer)
+        stream.write(0x00, HANDSHAKE.serialize((PROTOCOL_VERSION, self.address[0], self.address[1], 2)))
+        stream.write(0x00, STRING.serialize(self.name))  # Login Start
+        await stream.drain()
+        walker = None
+        try:
+            while True:
+                packet_id, buff = await stream.read()
+                if not self.logged_in.is_set():  # LOGIN, until the spawn teleport
+                    if packet_id == S2C_SET_COMPRESSION and stream.compression is None:
+                        stream.compression = VARINT.parse(buff).value
+                    elif packet_id == S2C_PLAYER_POSITION_LOOK:
+                        position, rotation, flags, teleport_id = PLAYER_POSITION_LOOK.parse(buff)
+                        self.position = list(position)
+                        stream.write(C2S_TELEPORT_CONFIRM, varint_bytes(teleport_id.value))
+                        self.stats.sample('login', time.perf_counter_ns() - start)
+                        self.logged_in.set()
+                        walker = asyncio.ensure_future(self._walk(stream))
+                elif packet_id == S2C_KEEP_ALIVE:
+                    now = time.perf_counter_ns()
+                    self.stats.sample('s2c_latency', now - LONG.parse(buff))
+                    stream.write(C2S_KEEP_ALIVE, LONG.serialize(time.perf_counter_ns()))
+                elif packet_id == S2C_CHAT:
+                    text = CHAT.parse(buff)[0].get('text', '')
+                    if text.startswith(self.name + ' '):
+                        self.stats.sample('chat_round_trip', time.perf_counter_ns() - int(text.split(' ')[1]))
+                self.stats.count('s2c', stream)
+        except (EOFError, OSError, IndexError):
+            pass
+        finally:
+            if walker is not None:
+                walker.cancel()
+            stream.close()
+
+    async def _walk(self, stream):
+        direction = random.uniform(0, 6.283)
+        next_chat = time.perf_counter() + random.uniform(0, self.chat_interval)
+        while True:
+            await asyncio.sleep(TICK)
+            if random.random() < 0.05:
+                direction = random.uniform(0, 6.283)
+            self.position[0] += math.cos(direction) * self.speed * TICK
+            self.position[2] += math.sin(direction) * self.speed * TICK
+            stream.write(C2S_PLAYER_POSITION, PLAYER_POSITION.serialize((self.position, True)))
+            if time.perf_counter() >= next_chat:
+                stream.write(C2S_CHAT, STRING.serialize(f'{self.name} {time.perf_counter_ns()}'))
+                next_chat += self.chat_interval
+            await stream.drain()
+
+
+'''
+    Runs an AsyncProxy (in this process) on [proxy_port] to the stand-in server on [server_port]
+'''
+
+
+def _run_proxy(preferences_path, proxy_port, server_port, quiet=True):
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+    from mc_proxy import Game, load_preferences
+    from async_proxy import AsyncProxy
+    settings = Game()
+    load_preferences(settings, preferences_path)
+    AsyncProxy(settings, '127.0.0.1', proxy_port, '127.0.0.1', server_port).run()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_port(address, timeout=10.0):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(*address)
+            writer.close()
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+
+
+'''
+    One load test run, returns the Stats report
+    [proxy]: (ip, port) of a running proxy (that forwards to [server_port]), 'spawn' to start an AsyncProxy
+    process, or None to connect the bots straight to the server
+'''
+
+
+async def run_load_test(bots=10, duration=10.0, warmup=2.0, proxy='spawn', server_port=0, ramp=0.01,
+                        preferences_path='gui/preferences.gui', server_options=None, bot_options=None):
+    stats = Stats()
+    server = StandInServer(stats, **(server_options or {}))
+    await server.start(port=server_port)
+    proxy_process = None
+    try:
+        if proxy == 'spawn':
+            address = ('127.0.0.1', free_port())
+            proxy_process = multiprocessing.get_context('spawn').Process(
+                target=_run_proxy, args=(preferences_path, address[1], server.port), daemon=True)
+            proxy_process.start()
+            await wait_for_port(address)
+        elif proxy is None:
+            address = ('127.0.0.1', server.port)
+        else:
+            address = proxy
+
+        clients = [Bot(f'bot{i}', stats, address, **(bot_options or {})) for i in range(bots)]
+        tasks = []
+        for client in clients:  # ramp up, no connection storm
+            tasks.append(asyncio.ensure_future(client.run()))
+            await asyncio.sleep(ramp)
+        await asyncio.wait([asyncio.ensure_future(client.logged_in.wait()) for client in clients], timeout=30)
+
+        await asyncio.sleep(warmup)
+        stats.start()
+        await asyncio.sleep(duration)
+        stats.stop()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        report = stats.report()
+        report['bots'] = bots
+        report['logged_in'] = sum(client.logged_in.is_set() for client in clients)
+        return report
+    finally:
+        server.close()
+        if proxy_process is not None:
+            proxy_process.terminate()
+            proxy_process.join(5)
+
+
+def print_report(title, report):
+    print(f"\n== {title}: {report['logged_in']}/{report['bots']} bots, {report['seconds']:.1f}s ==")
+    for name in ['login', 's2c_latency', 'c2s_latency', 'chat_round_trip']:
+        values = report[name]
+        if values['count']:
+            print(f"{name:<18} n={values['count']:<8} p50={values['p50']:8.3f}ms  p90={values['p90']:8.3f}ms  "
+                  f"p99={values['p99']:8.3f}ms  max={values['max']:8.3f}ms")
+    for direction in ['s2c', 'c2s']:
+        print(f"{direction} throughput     {report[direction + '_packets_per_sec']:10,.0f} packets/s  "
+              f"{report[direction + '_bytes_per_sec'] / 1e6:8.2f} MB/s")
+
+
+'''
+    Latency the proxy adds: the difference of the percentiles of [proxied] and [direct]
+'''
+
+
+def added_latency(proxied, direct):
+    added = {}
+    for name in ['s2c_latency', 'c2s_latency', 'chat_round_trip']:
+        if proxied[name]['count'] and direct[name]['count']:
+            added[name] = {key: proxied[name][key] - direct[name][key] for key in ['p50', 'p90', 'p99']}
+    return added
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the proxy with a stand-in server and bot clients")
+    parser.add_argument('--bots', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=10.0, help="measured seconds (after the warm-up)")
+    parser.add_argument('--warmup', type=float, default=2.0)
+    parser.add_argument('--proxy', help="ip:port of a running proxy (its server must be --server-port)")
+    parser.add_argument('--server-port', type=int, default=0, help="port of the stand-in server (0 = any)")
+    parser.add_argument('--direct', action='store_true', help="connect the bots straight to the server")
+    parser.add_argument('--compare-direct', action='store_true', help="run direct, then through the proxy")
+    parser.add_argument('--preferences', default='gui/preferences.gui', help="preferences of a spawned proxy")
+    parser.add_argument('--compression', type=int, default=256, help="threshold, -1 = no compression")
+    parser.add_argument('--chunks', type=int, default=49, help="Chunk Data packets per player at login")
+    parser.add_argument('--entities', type=int, default=100, help="mobs around every player")
+    parser.add_argument('--entity-moves', type=float, default=400, help="Entity Position packets/s per player")
+    parser.add_argument('--keep-alive', type=float, default=0.05, help="seconds between Keep Alive packets")
+    parser.add_argument('--chat-interval', type=float, default=5.0)
+    parser.add_argument('--json', help="write the report(s) to this JSON file")
+    args = parser.parse_args(argv)
+
+    server_options = {'compression': None if args.compression < 0 else args.compression, 'chunks': args.chunks,
+                      'entities': args.entities, 'entity_moves': args.entity_moves, 'keep_alive': args.keep_alive}
+    options = {'bots': args.bots, 'duration': args.duration, 'warmup': args.warmup, 'server_port': args.server_port,
+               'preferences_path': args.preferences, 'server_options': server_options,
+               'bot_options': {'chat_interval': args.chat_interval}}
+    if args.proxy:
+        ip, port = args.proxy.rsplit(':', 1)
+        proxy = (ip, int(port))
+    else:
+        proxy = 'spawn'
+
+    reports = {}
+    if args.direct or args.compare_direct:
+        reports['direct'] = asyncio.run(run_load_test(proxy=None, **options))
+        print_report("Direct", reports['direct'])
+    if not args.direct:
+        reports['proxy'] = asyncio.run(run_load_test(proxy=proxy, **options))
+        print_report("Through the proxy", reports['proxy'])
+    if args.compare_direct:
+        reports['added'] = added_latency(reports['proxy'], reports['direct'])
+        print("\n== Added by the proxy ==")
+        for name, values in reports['added'].items():
+            print(f"{name:<18} p50={values['p50']:+8.3f}ms  p90={values['p90']:+8.3f}ms  p99={values['p99']:+8.3f}ms")
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(reports, report_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
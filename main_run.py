@@ -3,12 +3,20 @@
 #               May 2021
 #######################################
 
-from mc_proxy import Game
-from gui import guiApp as ga
+# python main_run.py                    the GUI
+# python main_run.py --headless [...]   no GUI, see headless.py for the flags
+import sys
 
 proxy_obj = None
 gui = None
 
 if __name__ == "__main__":
+    if '--headless' in sys.argv[1:]:
+        import headless
+        sys.exit(headless.main([arg for arg in sys.argv[1:] if arg != '--headless']))
+
+    from mc_proxy import Game
+    from gui import guiApp as ga  # imports DearPyGUI, only needed by the GUI
+
     gui = ga.GuiApp(Game("fake_game_object"))
     gui.run()
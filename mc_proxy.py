@@ -6,20 +6,52 @@
 # Works for Minecraft Java Edition 1.15.2
 # The protocol documentation can be found here: https://wiki.vg/index.php?oldid=15901
 
+import os
 import socket
 from collections import deque
+from collections.abc import Mapping
 import select
 import threading
+import itertools
+import time
 
 from dataTypes import *
+from compression import *
+from metrics import METRICS, start_metrics
+from capture import get_capture
+from status_cache import get_status_cache, is_status_handshake, status_reply
+from backend_pool import get_backend_pool, connect_backend
+from routing import get_router, handshake_hostname
+from socket_tuning import leg_options, tune_socket, quick_ack, is_urgent, FlushPolicy
 
 
 def istype(object_, class_):
     return type(object_).__name__.split('.')[-1] in class_.__name__
 
 
+# Precompiled codecs of the packets' fields (see MCPacket.handle)
+JSON = compile_types('json')
+HANDSHAKE = compile_types(['varint', 'string', 'ushort', 'varint'])
+JOIN_GAME = compile_types(['int', 'ubyte', 'int', 'long', 'ubyte', 'string', 'varint', 'boolean', 'boolean'])
+CHANGE_GAME_STATE = compile_types(['ubyte', 'float'])
+BLOCK_PLACEMENT = compile_types(['varint', 'position', 'varint', [3, 'float'], 'boolean'])
+ABILITIES = compile_types(['byte', 'float', 'float'])
+ENTITY_PROPERTIES = compile_types(['varint', 'int'])  # followed by [int] properties
+ENTITY_PROPERTY = compile_types(['string', 'double', [-1, 'uuid', 'double', 'byte']])
+INTERACT_ENTITY = compile_types(['varint', 'varint'])  # followed by the target and hand (depends on the type)
+TARGET = compile_types([3, 'float'])
+ENTITY_METADATA = compile_types(['varint', 'entity_metadata'])
+VEHICLE_MOVE = compile_types([[3, 'double'], [2, 'float']])
+SPAWN_ENTITY = compile_types(['varint', 'uuid', 'varint', [3, 'double'], [3, 'angle'], [3, 'short']])
+ENTITY_POSITION = compile_types(['varint', [3, 'short'], 'boolean'])
+ENTITY_POSITION_ROTATION = compile_types(['varint', [3, 'short'], 'angle', 'angle', 'boolean'])
+ENTITY_TELEPORT = compile_types(['varint', [3, 'double'], 'angle', 'angle', 'boolean'])
+TAB_HEADER = compile_types(['chat', 'chat'])
+
+
 class Proxy(threading.Thread):
-    def __init__(self, gui_obj, proxy_ip, proxy_port, server_ip, server_port=25565):
+    # [controller] : a ProxyController (or the GUI), gets the status updates & the Game of the connection
+    def __init__(self, controller, proxy_ip, proxy_port, server_ip, server_port=25565):
         super().__init__()
         self.server_ip = server_ip
         self.server_port = server_port
@@ -35,43 +67,105 @@ class Proxy(threading.Thread):
 
         self.c2s = None
         self.s2c = None
-        self.gui_obj = gui_obj
+        self.controller = controller
+        self.server_offline = False  # the last attempt couldn't connect to the original server
 
     def run(self):
         print(self.server_ip, self.server_port)
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if os.name != 'nt':  # listen again while the last client's connection (closed by us) is in TIME_WAIT
+            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        client_socket = None
         try:
-            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            server_socket.connect((self.server_ip, self.server_port))
-        except (ConnectionRefusedError, TimeoutError) as e:
-            print("Error: Can't connect to original server.")
-            self.gui_obj.change_status_label(-1)  # server offline
-        else:
-            self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.s.bind((self.proxy_ip, self.proxy_port))
+
+            self.s.listen()
+            game = self.controller.game
+            router = get_router(game, self.server_ip, self.server_port)
+            for backend in router.backends():  # warm them while waiting
+                get_backend_pool(game, *backend.address)
+            self.controller.change_status_label(0)  # waiting for connection
+            client_socket, (self.client_ip, self.client_port) = self.s.accept()
+            self.s.close()  # one client per Proxy, start_proxy listens again for the next one
+
+            # The first frame decides: the backend (by the hostname the client dialed),
+            # and whether it's a server list ping that may be answered from the status cache
+            frames = FrameReader(legacy_ping=True)
+            client_socket.settimeout(FIRST_FRAME_TIMEOUT)
+            first_frame = frames.next_frame()
+            while first_frame is None:
+                if not frames.recv_from(client_socket):
+                    raise OSError
+                first_frame = frames.next_frame()
             try:
-                self.s.bind((self.proxy_ip, self.proxy_port))
+                hostname = None if istype(first_frame, LegacyPing) else handshake_hostname(first_frame[1])
+                cache = None
+                if hostname is not None and is_status_handshake(first_frame[1]):
+                    cache = get_status_cache(game, *router.primary(hostname).address)
+                    if cache is not None and cache.response() is None:
+                        cache = None
+            except Exception as e:  # a bad first frame drops this client, not the listener
+                print(f"Error: Bad first frame from {self.client_ip}:{self.client_port} ({e!r})")
+                client_socket.close()
+                self.controller.change_status_label(0)
+                return
+            if cache is not None:
+                self.controller.change_status_label(1)  # ping
+                self.serve_status(client_socket, frames, cache)
+                return
+
+            try:
+                backend, server_socket = router.connect(hostname, lambda address: connect_backend(game, *address))
+            except OSError:
+                print("Error: Can't connect to original server.")
+                self.server_offline = True
+                self.controller.change_status_label(-1)  # server offline
+                client_socket.close()
+                return
 
-                self.s.listen()
-                self.gui_obj.change_status_label(0)  # waiting for connection
-                client_socket, (self.client_ip, self.client_port) = self.s.accept()
-                self.c2s_send_queue = MCPacketQueue()
-                self.s2c_send_queue = MCPacketQueue()
+            self.server_ip, self.server_port = backend.address
+            self.c2s_send_queue = MCPacketQueue('c2s_send')
+            self.s2c_send_queue = MCPacketQueue('s2c_send')
 
-                game_obj = Game("Gilad")
-                self.gui_obj.change_game_obj(game_obj)
-                self.s2c = Forward(server_socket, client_socket, 's2c', self.s2c_send_queue, self.c2s_send_queue, game_obj)
-                self.c2s = Forward(client_socket, server_socket, 'c2s', self.c2s_send_queue, self.s2c_send_queue, game_obj)
+            game_obj = Game("Gilad")
+            self.controller.change_game_obj(game_obj)
+            self.s2c = Forward(server_socket, client_socket, 's2c', self.s2c_send_queue, self.c2s_send_queue, game_obj)
+            self.c2s = Forward(client_socket, server_socket, 'c2s', self.c2s_send_queue, self.s2c_send_queue, game_obj,
+                               frames=frames, first_frames=[first_frame])
 
-                self.c2s.start()
-                self.s2c.start()
+            self.c2s.start()
+            self.s2c.start()
 
+            try:
                 with game_obj.game_stop:
                     game_obj.game_stop.wait()
 
                 self.broadcast_stop_all()
-            except OSError:
-                self.gui_obj.change_status_label(0)
+            finally:
+                router.released(backend)
+        except OSError:
+            if client_socket is not None and self.c2s is None:
+                client_socket.close()
+            self.controller.change_status_label(0)
 
+    '''
+    Answers the Status Request & Ping of [client_socket] from [cache], then closes it
+    '''
 
+    def serve_status(self, client_socket, frames, cache):
+        try:
+            done = False
+            while not done:
+                frame = frames.next_frame()
+                if frame is None:
+                    if not frames.recv_from(client_socket):
+                        break
+                    continue
+                reply, done = status_reply(cache, frame[1])
+                if reply is not None:
+                    client_socket.sendall(reply)
+        finally:
+            client_socket.close()
 
     def broadcast_stop_all(self):
         self.c2s.broadcast_stop_all()
@@ -80,7 +174,9 @@ class Proxy(threading.Thread):
 
 #  side == True  =>   s2c;      side == False   =>   c2s
 class Forward(threading.Thread):
-    def __init__(self, in_socket, out_socket, side, my_send_queue, other_send_queue, game_obj):
+    # [frames] : the FrameReader of in_socket & [first_frames] : frames already read from it (see Proxy.run)
+    def __init__(self, in_socket, out_socket, side, my_send_queue, other_send_queue, game_obj, frames=None,
+                 first_frames=()):
         threading.Thread.__init__(self)
 
         self.in_socket = in_socket
@@ -89,7 +185,7 @@ class Forward(threading.Thread):
         if self.side not in ['s2c', 'c2s']:
             raise ValueError
 
-        self.in_queue = MCPacketQueue()
+        self.in_queue = MCPacketQueue(self.side + '_process')
         self.out_queue = my_send_queue
         if self.side.startswith('c2s'):  # צד שרירותי. החבילות מתמיינות בהמשך
             game_obj.preference_update_queue = self.in_queue
@@ -100,6 +196,13 @@ class Forward(threading.Thread):
         self.game = game_obj
 
         self.process_thread = Process(self.in_queue, self.out_queue, self.side, self.game)
+        self.capture = get_capture(game_obj)  # CaptureWriter, or None
+        self.frames = frames
+        self.first_frames = list(first_frames)
+        # c2s reads the client leg & writes the server leg, s2c the other way around
+        self.in_options = leg_options(game_obj, 'client' if self.side == 'c2s' else 'server')
+        self.out_options = leg_options(game_obj, 'server' if self.side == 'c2s' else 'client')
+        tune_socket(in_socket, self.in_options)
 
         self.send_thread = threading.Thread(target=self.send)
 
@@ -110,51 +213,31 @@ class Forward(threading.Thread):
 
     def receive(self):  # Receive to in_buffer
         self.in_socket.setblocking(True)
+        frames = self.frames if self.frames is not None else FrameReader(legacy_ping=self.side == 'c2s')
+        first_frames = self.first_frames
 
         while True:
             try:
-                ready_to_read, ready_to_write, in_error = select.select([self.in_socket, ], [], [])
-            except (select.error, ValueError) as e:
-                self.in_socket.close()
-                with self.game.game_stop:
-                    self.game.game_stop.notify_all()
-                break
-            assert len(ready_to_read) > 0
-
-            # Get next packet, get its length [VarInt]
-            next_packet_length_buff = Buffer()
-            last_byte = [0b10000000]
-            try:
-                while (last_byte[0] & 0b10000000) != 0b0:
-                    last_byte = self.in_socket.recv(1)
-                    if len(last_byte) == 0:
-                        pass  # no bytes were received
+                # Split all the complete packets that were received
+                packets = []
+                frame = first_frames.pop(0) if first_frames else frames.next_frame()
+                while frame is not None:
+                    if istype(frame, LegacyPing):
+                        print(f"IGNORED LEGACY PING")
                     else:
-                        next_packet_length_buff.add_byte(last_byte[0])
-                next_packet_length = VarInt(buffer=next_packet_length_buff)
-
-                if self.side == "c2s" and self.game.state == 0 and next_packet_length.value == 254:
-                    # Legacy PING
-                    lp_data_start_buff = Buffer(
-                        self.in_socket.recv(3))  # Get '0xFA' and length [short]
-                    lp_id, lp_str_len = parse_types(['byte', 'short'], lp_data_start_buff)
-                    lp_data_str_buff = Buffer(
-                        self.in_socket.recv(lp_str_len*2 + 2))  # string and short, should be 'MC|PingHost'
-                                                                    # and the rest of the length
-                    lp_str, lp_rest_len = parse_types([[lp_str_len, 'short'], 'short'], lp_data_str_buff)
-                    lp_data_end_buff = Buffer(self.in_socket.recv(lp_rest_len))
-                    print(f"IGNORED LEGACY PING")
-
-                else:
-                    next_packet_data_buff = Buffer()
-                    recv_left_len = next_packet_length.value
-                    while recv_left_len > 0:  # Get data from next packet
-                        tmp = self.in_socket.recv(recv_left_len)
-                        recv_left_len -= len(tmp)
-                        next_packet_data_buff.add_bytes(tmp)
-                    next_packet = MCPacket(game=self.game, length=next_packet_length, data=next_packet_data_buff,
-                                           side=self.side)
-                    self.in_queue.append_one(next_packet)
+                        next_packet_length, next_packet_data = frame
+                        if self.capture is not None:
+                            self.capture.record(self.side, self.game.state, self.game.with_compression,
+                                                next_packet_data)
+                        packets.append(MCPacket(game=self.game, length=next_packet_length,
+                                                data=Buffer(next_packet_data), side=self.side))
+                    frame = first_frames.pop(0) if first_frames else frames.next_frame()
+                if packets:
+                    self.in_queue.append_all(packets)
+
+                if not frames.recv_from(self.in_socket):  # connection closed
+                    raise OSError
+                quick_ack(self.in_socket, self.in_options)
 
             except (OSError, IndexError) as e:
                 with self.game.game_stop:
@@ -162,36 +245,229 @@ class Forward(threading.Thread):
                 break
 
     def send(self):
+        flush = FlushPolicy.for_leg(self.out_options)
         while not self.__stop:
-            with self.out_queue.new_packet:
-                self.out_queue.new_packet.wait()
-
-            while not self.out_queue.empty():
-                send_data, other_side_packets, stop_flag = self.out_queue.pack_all(self.side)
+            packets = self.out_queue.drain()
+            if not packets:  # the queue was closed
+                break
+            buffers, other_side_packets, stop_flag = pack_packets(packets, self.side)
+            if not stop_flag and flush.hold(sum(map(len, buffers)), self.urgent(packets)):
+                buffers, other_side_packets, stop_flag = self.coalesce(flush, buffers, other_side_packets)
 
-                try:
-                    ready_to_read, ready_to_write, in_error = select.select([], [self.out_socket], [])
-                    self.out_socket.send(send_data)
-                    self.other_out_queue.append_all(other_side_packets)
-                except (select.error, ValueError, OSError) as e:
-                    self.__stop = True
-                    with self.game.game_stop:
-                        self.game.game_stop.notify_all()
-                    break
-                assert len(ready_to_write) > 0
+            try:
+                ready_to_read, ready_to_write, in_error = select.select([], [self.out_socket], [])
+                send_buffers(self.out_socket, buffers)
+                self.other_out_queue.append_all(other_side_packets)
+            except (select.error, ValueError, OSError) as e:
+                self.__stop = True
+                with self.game.game_stop:
+                    self.game.game_stop.notify_all()
+                break
+            assert len(ready_to_write) > 0
 
-                if stop_flag:
-                    self.__stop = True
+            if stop_flag:
+                self.__stop = True
 
         self.out_socket.close()
 
+    # Does [packets] have one of this side that shouldn't wait for coalescing?
+    def urgent(self, packets):
+        return any(is_urgent(packet, self.side) for packet in packets
+                   if type(packet) is MCPacket and packet.side == self.side)
+
+    '''
+    Adds the packets that come within the flush budget to the small write [buffers], until it's big enough
+    or a latency sensitive packet comes
+    '''
+
+    def coalesce(self, flush, buffers, other_side_packets):
+        deadline = flush.deadline()
+        size = sum(map(len, buffers))
+        gained = False
+        stop_flag = False
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            packets = self.out_queue.drain(timeout=timeout)
+            if not packets:  # the budget is over (or the queue was closed)
+                break
+            gained = True
+            more_buffers, more_other_side_packets, stop_flag = pack_packets(packets, self.side)
+            buffers += more_buffers
+            other_side_packets += more_other_side_packets
+            size += sum(map(len, more_buffers))
+            if stop_flag or size >= flush.min_bytes or self.urgent(packets):
+                break
+        flush.held(gained)
+        return buffers, other_side_packets, stop_flag
+
     def broadcast_stop_all(self):
         try:
             self.in_socket.close()
         finally:
             self.in_queue.send_stop_signal()
-            with self.out_queue.new_packet:
-                self.out_queue.new_packet.notify_all()
+            self.out_queue.close()
+
+
+class LegacyPing:
+    pass
+
+
+class FrameReader:
+    # Splits a received byte stream into packet frames ([length] VarInt + [data])
+    # Data is received in big blocks into a reusable buffer, every complete frame in it is split out at once,
+    # and a partial frame is carried over to the next read
+    RECV_SIZE = 65536
+
+    def __init__(self, legacy_ping=False):
+        self._recv_buff = bytearray(self.RECV_SIZE)
+        self._recv_view = memoryview(self._recv_buff)
+        self._pending = bytearray()  # received bytes that weren't split to frames yet
+        self._start = 0  # start of the next frame in _pending
+        self._legacy_ping = legacy_ping  # may the first frame be a legacy ping (client side only)
+
+    '''
+    Receives the next block from [sock] (blocking)
+    Returns False when the connection was closed
+    '''
+
+    def recv_from(self, sock):
+        received = sock.recv_into(self._recv_buff)
+        if received == 0:
+            return False
+        self.feed(self._recv_view[:received])
+        return True
+
+    def feed(self, data):
+        if self._start > 0:  # drop the frames that were already split out
+            del self._pending[:self._start]
+            self._start = 0
+        self._pending += data
+
+    '''
+    Returns the next complete frame as a tuple ([length] VarInt, [data] bytes), LegacyPing,
+    or None if there isn't a complete frame yet
+    '''
+
+    def next_frame(self):
+        pending = self._pending
+        end = len(pending)
+        pos = self._start
+        length = 0
+        shift = 0
+        while True:  # frame length VarInt
+            if pos >= end:
+                return None
+            read = pending[pos]
+            pos += 1
+            length |= (read & 0b01111111) << shift
+            shift += 7
+            if not read & 0b10000000:
+                break
+            if shift >= 35:
+                raise IndexError("VarInt is too big")
+
+        if self._legacy_ping:
+            self._legacy_ping = False  # only the first frame can be a legacy ping
+            if length == 254:
+                legacy_ping_end = self.__legacy_ping_end(pos)
+                if legacy_ping_end is None:
+                    self._legacy_ping = True  # not complete yet, check again on the next call
+                    return None
+                self._start = legacy_ping_end
+                return LegacyPing()
+
+        if end - pos < length:
+            return None
+        self._start = pos + length
+        return VarInt(value=length), bytes(pending[pos:pos + length])
+
+    '''
+    Returns the end of a legacy ping that starts its data at [pos], or None if it wasn't fully received
+    '''
+
+    def __legacy_ping_end(self, pos):
+        # '0xFA', length [short], 'MC|PingHost' [UTF-16BE], length of the rest [short], the rest
+        pending = self._pending
+        if len(pending) < pos + 3:
+            return None
+        pos += 3 + int.from_bytes(pending[pos + 1:pos + 3], byteorder='big') * 2
+        if len(pending) < pos + 2:
+            return None
+        pos += 2 + int.from_bytes(pending[pos:pos + 2], byteorder='big')
+        if len(pending) < pos:
+            return None
+        return pos
+
+
+class HandlerRegistry:
+    # Packet handlers, looked up by (state, side, packet ID) in one dict index
+    # A packet can have several handlers, they run in registration order.
+    # A handler gets the unpacked MCPacket, and must leave packet.raw_data as the whole (maybe changed) packet data
+    def __init__(self):
+        self._handlers = {}  # (state, side, packet ID) => [(handler, mod_name), ...]
+        self._read_only = set()  # handlers that only read the packet
+
+    '''
+    Decorator, registers a handler of (state, side, packet ID)
+    [mod_name] : the handler runs only while this mod is enabled (None => always)
+    [read_only] : the handler never changes, drops or adds packets, so the packet is still sent as received
+    '''
+
+    def register(self, state, side, packet_id, mod_name=None, read_only=False):
+        side = side.lower()
+        if side not in ['s2c', 'c2s']:
+            raise ValueError
+
+        def decorator(handler):
+            self._handlers.setdefault((state, side, packet_id), []).append((handler, mod_name))
+            if read_only:
+                self._read_only.add(handler)
+            return handler
+
+        return decorator
+
+    '''
+    Returns the handlers of (state, side, packet ID) whose mods are enabled in [game]
+    '''
+
+    def active(self, game, state, side, packet_id):
+        return self.lookup(game, state, side, packet_id)[0]
+
+    def all_read_only(self, handlers):
+        return all([handler in self._read_only for handler in handlers])
+
+    '''
+    Returns (active handlers, are they all read only?) of (state, side, packet ID) in [game]
+    Cached in the game's current ModSnapshot, so it's computed again only after a mod changed
+    '''
+
+    def lookup(self, game, state, side, packet_id):
+        key = (state, side, packet_id)
+        handlers = self._handlers.get(key)
+        if handlers is None:
+            return NO_HANDLERS
+        snapshot = game.mod_snapshot
+        entry = snapshot.active_handlers.get(key)
+        if entry is None:
+            active = tuple([handler for handler, mod_name in handlers if mod_name is None or snapshot.get(mod_name)])
+            entry = (active, self.all_read_only(active))
+            snapshot.active_handlers[key] = entry
+        return entry
+
+
+NO_HANDLERS = ((), True)
+
+
+def mod_enabled(game, mod_name):
+    try:
+        return bool(game.get_mod(mod_name))
+    except ValueError:  # mod was never set
+        return False
+
+
+HANDLERS = HandlerRegistry()
 
 
 class MCPacket:
@@ -202,7 +478,7 @@ class MCPacket:
             self.p_length = length
             self.p_data = data
             assert self.p_data.length() == length.value, "MCPacket length doesn't match given length!" + str(
-                self.p_data.to_bytes())
+                bytes(self.p_data.to_bytes()))
         elif p_ID is not None and raw_data is not None:
             self.p_ID = p_ID
             self.raw_data = raw_data
@@ -217,6 +493,8 @@ class MCPacket:
 
         self._children = []  # can be changed with self.add_child_packet(...)
         self._send_self = True  # can be changed with self.drop_packet() & self.pickup_packet()
+        self._pass_through = False  # no handler cares about this packet, send the received frame as is
+        self._compressed = None  # Future of the compressed load, see self.precompress()
 
     '''
     [with_compression] : boolean;
@@ -234,324 +512,138 @@ class MCPacket:
             self.is_compressed = self.uncompressed_load_length.value != 0  # If uncompressed_load_length is set to zero, then the packet is uncompressed;
             # otherwise it is the size of the uncompressed packet.
 
-            if self.is_compressed:  # uncompress p_data to raw_data
-                try:
-                    self.raw_data.uncompress()
-                except zlib.error:
-                    self.is_compressed = False
-                    print('Decompression error!')
+            if self.is_compressed:  # uncompress p_data to raw_data (zlib.error if it can't, see process)
+                self.raw_data = Buffer(self.game.compressor(self.side).decompress(
+                    self.raw_data.to_bytes(), self.uncompressed_load_length.value))
 
         self.p_ID = VarInt(buffer=self.raw_data)
 
-    def __str__(self):
-        return (self.side[0].upper()) + ' ' + hex(self.p_ID.value) + ' ' + str(self.raw_data.to_bytes())
+    '''
+    Reads only the packet ID, decompresses just its first bytes if needed
+    '''
 
-    def matches(self, side, packet_id):  # returns true if self matched these specifications
-        return self.side[0].lower() == side[0].lower() and self.p_ID.value == packet_id
+    def peek(self, with_compression):
+        data = self.p_data.copy()
+        if with_compression and VarInt(buffer=data).value != 0:  # compressed: decompress only the ID
+            data = Buffer(zlib.decompressobj().decompress(data.to_bytes(), 5))
+        self.p_ID = VarInt(buffer=data)
 
-    def handle(self):
-
-        #       --- IDLE STATE ---
-        if self.game.state == 0:
-            # server list ping req, Handshake
-            # switch to STATUS/LOGIN state
-            if self.matches('c2s', 0x0) and self.raw_data.length() > 0:
-                self.game.gui_obj.change_status_label(1)  # ping
-                protocol_number, ip, port, next_state = parse_types(['varint', 'string', 'ushort', 'varint'],
-                                                                    self.raw_data)
-                self.game.state = next_state.value
-                self.raw_data = Buffer(
-                    serialize_types(['varint', 'string', 'ushort', 'varint'], (protocol_number, ip, port, next_state)))
-
-
-        #       --- STATUS STATE ---
-        elif self.game.state == 1:
-            # server list ping req
-            # switch to STATUS state
-            if self.game.get_mod('CustomMOTD') and self.matches('s2c', 0x0) and self.raw_data.length() > 0:
-                json_ = parse_types('json', self.raw_data)
-                self.game.state = 0
-
-                from datetime import datetime
-                now = datetime.now()
-                current_time = now.strftime("%H:%M:%S")
-                json_['description'] = {'text': '§2§l§n' + current_time + '§r'}
-                self.raw_data = Buffer(serialize_types('json', json_))
-
-
-
-        #       --- LOGIN STATE ---
-        elif self.game.state == 2:
-            # set compression
-            if self.matches('s2c', 0x3):
-                compression_set = parse_types('varint', self.raw_data)
-                self.game.compression_size = compression_set.value
-                self.raw_data = Buffer(serialize_types('varint', compression_set))
-
-            # login start
-            elif self.matches('c2s', 0x0):
-                username = parse_types('string', self.raw_data)
-
-                if self.game.get_mod('EnableFakename'):
-                    username = self.game.get_mod('FakenameInput')
-
-                self.game.gui_obj.change_status_label(2)  # login
-                self.game.login_username = username
-                self.raw_data = Buffer(serialize_types('string', username))
-
-            # login success
-            # switch to PLAY state
-            elif self.matches('s2c', 0x02):
-                self.game.state = 3
-                self.game.gui_obj.change_status_label(3)  # play
-                self.game.set_mod('Camera', {})
-
-
-        #       --- PLAY STATE ---
-        elif self.game.state == 3:
-            # Chat Message
-            if self.matches('c2s', 0x03):
-                msg = parse_types('string', self.raw_data.copy())
-
-                if msg.startswith(b'/camera'):
-                    if 'ID' in self.game.target.keys():  # already selected an entity
-                        entity_id = self.game.target['ID']  # int
-                        if 'EntityID' in self.game.get_mod('Camera').keys() and self.game.get_mod('Camera')[
-                            'EntityID'] != self.game.pid:
-                            entity_id = int(self.game.pid)
-
-                        self.game.get_mod('Camera')['EntityID'] = entity_id
-                        camera_bytes = Buffer(serialize_types('varint', entity_id))
-                        camera_packet = MCPacket(game=self.game, p_ID=VarInt(value=0x3F), raw_data=camera_bytes,
-                                                 side='s2c')
-                        camera_packet.with_compression = self.game.with_compression
-                        self.add_child_packet(camera_packet)
+    '''
+    Unpacks self, or drops it if its payload can't be decompressed (corrupt, or over the size cap of
+    compression.Compressor): those bytes aren't a packet ID + data. Returns True if self was unpacked
+    '''
 
-                    else:
-                        error_msg_bytes = Buffer(
-                            b'\x02X{"italic":true,"color":"red","text":"Unable to switch camera. First, select an entity."}')
-                        error_msg_packet = MCPacket(game=self.game, p_ID=VarInt(value=0x50), raw_data=error_msg_bytes,
-                                                    side='s2c')
-                        error_msg_packet.with_compression = self.game.with_compression
-                        self.add_child_packet(error_msg_packet)
-                    self.drop_packet()  # don't send /camera to the server
-
-                elif msg.startswith(b'/state'):
-                    tmp = msg.split(b' ')
-                    if len(tmp) >= 3:
-                        state_bytes = Buffer(serialize_types(['ubyte', 'float'], (int(tmp[1]), float(tmp[2]))))
-                        state_packet = MCPacket(game=self.game, p_ID=VarInt(value=0x1F), raw_data=state_bytes,
-                                                side='s2c')
-                        state_packet.with_compression = self.game.with_compression
-                        self.add_child_packet(state_packet)
-                        self.drop_packet()  # don't send /state to the server
-
-                elif msg.startswith(b'/giants'):  # create giants as entities
-                    current = False
-                    try:
-                        current = self.game.get_mod("giants")
-                    except:
-                        pass
-                    self.game.set_mod("giants", not current)
-                    self.drop_packet()
-
-                self.raw_data = Buffer(serialize_types('string', msg))
-
-
-            # Join Game
-            elif self.matches('s2c', 0x26):
-                eid, gm, dim, seed, max_players, level, view, debug_info, respawn_screen = parse_types(
-                    ['int', 'ubyte', 'int', 'long', 'ubyte', 'string', 'varint', 'boolean', 'boolean'], self.raw_data)
-                self.game.pid = eid
-                self.game.gui_obj.change_status_label(3)  # play
-                self.raw_data = Buffer(serialize_types(['int', 'ubyte', 'int', 'long', 'ubyte', 'string', 'varint',
-                                                        'boolean', 'boolean'], (eid, gm, dim, seed, max_players, level,
-                                                                                view, debug_info, respawn_screen)))
-                self.add_child_packet(get_tab_header_packet(self.game))
-
-            # Rightclick detection
-            elif self.matches('c2s', 0x2d):
-                msg = "I right clicked!"
-                msg_bytes = Buffer(serialize_types('string', msg))
-                chat_packet = MCPacket(game=self.game, p_ID=VarInt(value=0x03), raw_data=msg_bytes, side='c2s')
-                chat_packet.with_compression = True
-                self.add_child_packet(chat_packet)
-
-            # Client Block placement
-            # face enum: {down_face, up_face, north_face, south_face, west_face, east_face}
-            elif self.matches('c2s', 0x2c):
-                hand, location, face, cursor, inside_block = parse_types(
-                    ['varint', 'position', 'varint', [3, 'float'], 'boolean'], self.raw_data)
-                if self.game.get_mod('BuildingRadio') == 2:
-                    for y in [0, 1, 2]:
-                        for x in [-1, 0, 1]:
-                            tmp_location = location.copy()
-                            tmp_location.x += x
-                            tmp_location.y += y
-                            msg_bytes = Buffer(
-                                serialize_types(['varint', 'position', 'varint', [3, 'float'], 'boolean'],
-                                                (hand, tmp_location, 1, cursor, inside_block)))
-                            chat_packet = MCPacket(game=self.game, p_ID=VarInt(value=0x2c), raw_data=msg_bytes,
-                                                   side='c2s')
-                            chat_packet.with_compression = True
-                            self.add_child_packet(chat_packet)
-                elif self.game.get_mod('BuildingRadio') == 1:
-                    tmp_location = location.copy()
-                    tmp_location.y += 5
-                    msg_bytes = Buffer(serialize_types(['varint', 'position', 'varint', [3, 'float'], 'boolean'],
-                                                       (hand, tmp_location, face, cursor, inside_block)))
-                    chat_packet = MCPacket(game=self.game, p_ID=VarInt(value=0x2c), raw_data=msg_bytes, side='c2s')
-                    chat_packet.with_compression = True
-                    self.add_child_packet(chat_packet)
-
-                # location.y += 0
-                self.raw_data = Buffer(serialize_types(['varint', 'position', 'varint', [3, 'float'], 'boolean'],
-                                                       (hand, location, face, cursor, inside_block)))
-
-            # Enable Flying
-            elif self.matches('s2c', 0x32):
-                flags, flying_speed, fov = parse_types(['byte', 'float', 'float'], self.raw_data)
-                self.game.set_mod("_Abilities", (flags, flying_speed, fov))
-                if self.game.get_mod("EnableFlying"):
-                    flags = flags | 6
-                self.raw_data = Buffer(serialize_types(['byte', 'float', 'float'], (flags, flying_speed, fov)))
-
-            # client movement speed
-            elif self.matches('s2c', 0x59):
-                eid, length = parse_types(['varint', 'int'], self.raw_data)
-                if eid.value == int(self.game.pid):
-                    properties = parse_types([int(length), ['string', 'double', [-1, 'uuid', 'double', 'byte']]],
-                                             self.raw_data)
-                    for p in properties:
-                        if p[0] == b'generic.movementSpeed':
-                            p[1] = self.game.get_mod("movementSpeed")
-
-                    self.raw_data = Buffer(serialize_types(
-                        ['varint', 'int', [int(length), ['string', 'double', [-1, 'uuid', 'double', 'byte']]]],
-                        (eid, length, properties)))
-                else:
-                    tmp = self.raw_data.to_bytes()
-                    self.raw_data = Buffer(serialize_types(['varint', 'int'], (eid, length)))
-                    self.raw_data.add_bytes(tmp)
-
-            # Interact Entity
-            # type_enum: {interact, attack, interact_at}
-            # hand_enum: {main_hand, off_hand}
-            elif self.matches('c2s', 0x0E):
-                entity_id, interaction_type = parse_types(['varint', 'varint'], self.raw_data)
-                target = None
-                hand = None
-                if interaction_type.value == 2:
-                    target = parse_types([3, 'float'], self.raw_data)
-                if interaction_type.value != 1:
-                    hand = parse_types('varint', self.raw_data)
-
-                metadata_array = [None] * 7
-                last_effect_metadata = self.game.last_effect_metadata[entity_id.value]
-                last_effect_metadata[1] |= 0x40  # glowing flag is on
-                metadata_array[0] = last_effect_metadata  # effect index in metadata
-                glow_data = serialize_types(['varint', 'entity_metadata'], (entity_id, [metadata_array, b'\xff']))
-                glow_bytes = Buffer(glow_data)
-                glow_packet = MCPacket(game=self.game, p_ID=VarInt(value=0x44), raw_data=glow_bytes, side='s2c')
-                glow_packet.with_compression = True
-                self.add_child_packet(glow_packet)
-                self.game.target['ID'] = entity_id
-
-                self.raw_data = Buffer(serialize_types(['varint', 'varint'], (entity_id, interaction_type)))
-                if interaction_type.value == 2:
-                    self.raw_data.add_bytes(serialize_types([3, 'float'], target))
-                if interaction_type.value != 1:
-                    self.raw_data.add_bytes(serialize_types('varint', hand))
-
-            # Entity Metadata
-            elif self.matches('s2c', 0x44):
-                entity_id, metadata = parse_types(['varint', 'entity_metadata'], self.raw_data)
-
-                if metadata[0][0] is not None:
-                    self.game.last_effect_metadata[entity_id.value] = metadata[0][0]
-                if entity_id.value in self.game.last_effect_metadata.keys() and 'ID' in self.game.target.keys() \
-                        and self.game.target['ID'].value == entity_id.value:
-                    # metadata[0][0][1] |= 0x40
-                    last_effect_metadata = self.game.last_effect_metadata[entity_id.value]
-                    last_effect_metadata[1] |= 0x40  # glowing flag is on
-                    metadata[0][0] = last_effect_metadata
-                self.raw_data = Buffer(
-                    serialize_types(['varint', 'entity_metadata'],
-                                    (entity_id, metadata)))
-
-            # Vehicle Move
-            elif self.matches('c2s', 0x15):
-                pos, ang = parse_types([[3, 'double'], [2, 'float']], self.raw_data)
-                self.raw_data = Buffer(serialize_types([[3, 'double'], [2, 'float']], (pos, ang)))
-                if self.game.get_mod('DropSteering'):
-                    self.drop_packet()
-
-            # Spawn Entity
-            elif self.matches('s2c', 0x03):
-                entity_id, obj_uuid, type_, position, ang, velocity = parse_types(
-                    ['varint', 'uuid', 'varint', [3, 'double'], [3, 'angle'], [3, 'short']],
-                    self.raw_data)
-                try:
-                    if self.game.get_mod("giants"):
-                        type_ = 30  # giant
-                except:
-                    pass
+    def unpack_or_drop(self, with_compression, state):
+        try:
+            self.unpack(with_compression)
+        except zlib.error:  # compression.DecompressionError too
+            METRICS.decompression_failed(self.side, state)
+            self.drop_packet()
+            return False
+        return True
+
+    '''
+    Unpacks and handles self, if any enabled mod cares about this packet;
+    otherwise the packet is passed through as received (no decompress/recompress)
+    '''
 
-                self.raw_data = Buffer(
-                    serialize_types(['varint', 'uuid', 'varint', [3, 'double'], [3, 'angle'], [3, 'short']],
-                                    (entity_id, obj_uuid, type_, position, ang, velocity)))
+    def process(self, with_compression):
+        state = self.game.state
+        try:
+            self.peek(with_compression)
+        except Exception:  # can't peek, let unpack deal with it
+            if self.unpack_or_drop(with_compression, state):
+                self.handle()
+            return
+
+        packet_id = self.p_ID.value
+        METRICS.packet(self.side, state, packet_id, self.p_length.value)
+        handlers, read_only = HANDLERS.lookup(self.game, state, self.side, packet_id)
+        if not handlers:
+            self.with_compression = with_compression
+            self._pass_through = True
+            return
+        if not self.unpack_or_drop(with_compression, state):
+            return
+        if self.is_compressed:
+            METRICS.decompressed(self.side, state, packet_id, self.p_length.value, self.uncompressed_load_length.value)
+
+        start = time.perf_counter()
+        self.handle(handlers)
+        METRICS.handler_time(self.side, state, packet_id, time.perf_counter() - start)
+        if read_only:  # nothing changed, send the frame as received
+            self._pass_through = True
 
-            # Entity Position
-            elif self.matches('s2c', 0x29):
-                entity_id, delta, on_ground = parse_types(['varint', [3, 'short'], 'boolean'], self.raw_data.copy())
-                if self.game.get_mod('DropEntityMovement'):
-                    self.drop_packet()
+    def __str__(self):
+        return (self.side[0].upper()) + ' ' + hex(self.p_ID.value) + ' ' + str(bytes(self.raw_data.to_bytes()))
 
-            # Entity Position and Rotation
-            elif self.matches('s2c', 0x2A):
-                entity_id, delta, yaw, pitch, on_ground = parse_types(
-                    ['varint', [3, 'short'], 'angle', 'angle', 'boolean'], self.raw_data.copy())
+    def matches(self, side, packet_id):  # returns true if self matched these specifications
+        return self.side[0].lower() == side[0].lower() and self.p_ID.value == packet_id
 
-                if self.game.get_mod('DropEntityMovement'):
-                    self.drop_packet()
+    '''
+    Runs the handlers of this packet (see HANDLERS), or the given [handlers]
+    '''
 
-            # Entity Position and Rotation
-            elif self.matches('s2c', 0x57) and False:
-                entity_id, pos, yaw, pitch, on_ground = parse_types(
-                    ['varint', [3, 'double'], 'angle', 'angle', 'boolean'], self.raw_data.copy())
-                if self.game.get_mod('DropEntityMovement'):
-                    self.drop_packet()
+    def handle(self, handlers=None):
+        if handlers is None:
+            handlers = HANDLERS.active(self.game, self.game.state, self.side, self.p_ID.value)
+        for handler in handlers:
+            handler(self)
+
+    '''
+    Starts compressing self on the compression worker pool, if self is big enough to be offloaded
+    pack() then waits for the result instead of compressing
+    '''
+
+    def precompress(self):
+        if self._send_self and not self._pass_through and self.with_compression and self._compressed is None:
+            load_data = self.p_ID.to_bytes() + self.raw_data.to_bytes()
+            if len(load_data) >= self.game.compression_size:
+                self._compressed = self.game.compressor(self.side).submit(load_data)
 
     '''
     Packs self to bytes
     '''
 
     def pack(self):
-        self_data = b''
-        if self._send_self:
-            load_data = self.p_ID.to_bytes() + self.raw_data.to_bytes()  # ID & raw_data
-            if self.with_compression:
-                uncompressed_load_length = len(load_data)
-                if uncompressed_load_length >= self.game.compression_size:  # if need compression (bigger than threshold)
-                    compressed_data = zlib.compress(load_data)
-                    load_data = VarInt(value=uncompressed_load_length).to_bytes() + compressed_data
-                else:  # no compression is needed (smaller than threshold)
-                    load_data = VarInt(value=0).to_bytes() + load_data
-
-            self_data = VarInt(value=len(load_data)).to_bytes() + load_data
-
-            # down also returns a tuple!
+        buffers = []
+        other_side_children = self.pack_into(buffers)
+        return b''.join(buffers), other_side_children
+
+    '''
+    Appends the bytes of self (and of its children of the same side) to the list [buffers], without joining them
+    Returns the children of the other side
+    '''
+
+    def pack_into(self, buffers):
+        if self._send_self and self._pass_through:
+            buffers += [self.p_length.to_bytes(), self.p_data.to_bytes()]  # the frame, as it was received
+        elif self._send_self:
+            id_data = self.p_ID.to_bytes()
+            raw_data = self.raw_data.to_bytes()
+            uncompressed_load_length = len(id_data) + len(raw_data)
+            if self.with_compression and uncompressed_load_length >= self.game.compression_size:  # need compression
+                if self._compressed is not None:  # compressed by the worker pool
+                    compressed_data = self._compressed.result()
+                else:
+                    compressed_data = self.game.compressor(self.side).compress(id_data + raw_data)
+                header = VarInt(value=uncompressed_load_length).to_bytes()
+                buffers += [VarInt(value=len(header) + len(compressed_data)).to_bytes(), header, compressed_data]
+            elif self.with_compression:  # no compression is needed (smaller than threshold)
+                buffers += [VarInt(value=uncompressed_load_length + 1).to_bytes(), b'\x00', id_data, raw_data]
+            else:
+                buffers += [VarInt(value=uncompressed_load_length).to_bytes(), id_data, raw_data]
+        else:
+            METRICS.dropped(self.side)
+
         other_side_children = []
-        my_children_data = b''
         for child in self._children:
+            METRICS.injected(child.side)
             if child.side == self.side:  # good side, pack him/her
-                child_data, other_child_child = child.pack()
-                my_children_data += child_data
-                other_side_children += other_child_child
+                other_side_children += child.pack_into(buffers)
             else:
                 other_side_children.append(child)
-
-        return self_data + my_children_data, other_side_children
+        return other_side_children
 
     '''
     Appends a 'child' packet to the current packet, that will be sent as well.
@@ -578,6 +670,484 @@ class MCPacket:
         self._send_self = True
 
 
+#       --- IDLE STATE ---
+
+# server list ping req, Handshake
+# switch to STATUS/LOGIN state
+@HANDLERS.register(0, 'c2s', 0x00)
+def on_handshake(packet):
+    if packet.raw_data.length() > 0:
+        packet.game.change_status(1)  # ping
+        protocol_number, ip, port, next_state = HANDSHAKE.parse(packet.raw_data)
+        packet.game.state = next_state.value
+        packet.raw_data = Buffer(HANDSHAKE.serialize((protocol_number, ip, port, next_state)))
+
+
+#       --- STATUS STATE ---
+
+# server list ping req
+# switch to STATUS state
+@HANDLERS.register(1, 's2c', 0x00, mod_name='CustomMOTD')
+def on_status_response(packet):
+    if packet.raw_data.length() > 0:
+        json_ = JSON.parse(packet.raw_data)
+        packet.game.state = 0
+        packet.raw_data = Buffer(JSON.serialize(custom_motd(json_)))
+
+
+# Replaces the MOTD of a Status Response JSON with the current time
+def custom_motd(json_):
+    from datetime import datetime
+    now = datetime.now()
+    current_time = now.strftime("%H:%M:%S")
+    json_['description'] = {'text': '§2§l§n' + current_time + '§r'}
+    return json_
+
+
+#       --- LOGIN STATE ---
+
+# set compression
+@HANDLERS.register(2, 's2c', 0x03)
+def on_set_compression(packet):
+    compression_set = VARINT.parse(packet.raw_data)
+    packet.game.compression_size = compression_set.value
+    packet.raw_data = Buffer(VARINT.serialize(compression_set))
+
+
+# login start
+@HANDLERS.register(2, 'c2s', 0x00)
+def on_login_start(packet):
+    username = STRING.parse(packet.raw_data)
+
+    if packet.game.get_mod('EnableFakename'):
+        username = packet.game.get_mod('FakenameInput')
+
+    packet.game.change_status(2)  # login
+    packet.game.login_username = username
+    packet.raw_data = Buffer(STRING.serialize(username))
+
+
+# login success
+# switch to PLAY state
+@HANDLERS.register(2, 's2c', 0x02)
+def on_login_success(packet):
+    packet.game.state = 3
+    packet.game.change_status(3)  # play
+    packet.game.set_mod('Camera', {})
+
+
+#       --- PLAY STATE ---
+
+# Chat Message
+@HANDLERS.register(3, 'c2s', 0x03)
+def on_chat_message(packet):
+    game = packet.game
+    msg = STRING.parse(packet.raw_data.copy())
+
+    if msg.startswith(b'/camera'):
+        if 'ID' not in game.target.keys() and mod_enabled(game, 'TrackEntities'):  # select the entity in sight
+            entity_id = game.entities.under_crosshair(exclude=game.pid)
+            if entity_id is None:
+                entity_id = game.entities.nearest_to_player(max_distance=32.0, exclude=game.pid)
+            if entity_id is not None:
+                game.target['ID'] = VarInt(value=entity_id)
+                packet.add_child_packet(get_glow_packet(game, entity_id))
+
+        if 'ID' in game.target.keys():  # already selected an entity
+            entity_id = game.target['ID']  # int
+            camera = game.get_mod('Camera')
+            if 'EntityID' in camera.keys() and camera['EntityID'] != game.pid:
+                entity_id = int(game.pid)
+
+            game.set_mod('Camera', {**camera, 'EntityID': entity_id})  # a new dict, the snapshot's one is shared
+            camera_bytes = Buffer(VARINT.serialize(entity_id))
+            camera_packet = MCPacket(game=game, p_ID=VarInt(value=0x3F), raw_data=camera_bytes, side='s2c')
+            camera_packet.with_compression = game.with_compression
+            packet.add_child_packet(camera_packet)
+
+        else:
+            error_msg_bytes = Buffer(
+                b'\x02X{"italic":true,"color":"red","text":"Unable to switch camera. First, select an entity."}')
+            error_msg_packet = MCPacket(game=game, p_ID=VarInt(value=0x50), raw_data=error_msg_bytes, side='s2c')
+            error_msg_packet.with_compression = game.with_compression
+            packet.add_child_packet(error_msg_packet)
+        packet.drop_packet()  # don't send /camera to the server
+
+    elif msg.startswith(b'/state'):
+        tmp = msg.split(b' ')
+        if len(tmp) >= 3:
+            state_bytes = Buffer(CHANGE_GAME_STATE.serialize((int(tmp[1]), float(tmp[2]))))
+            state_packet = MCPacket(game=game, p_ID=VarInt(value=0x1F), raw_data=state_bytes, side='s2c')
+            state_packet.with_compression = game.with_compression
+            packet.add_child_packet(state_packet)
+            packet.drop_packet()  # don't send /state to the server
+
+    elif msg.startswith(b'/giants'):  # create giants as entities
+        current = False
+        try:
+            current = game.get_mod("giants")
+        except:
+            pass
+        game.set_mod("giants", not current)
+        packet.drop_packet()
+
+    packet.raw_data = Buffer(STRING.serialize(msg))
+
+
+# Join Game
+@HANDLERS.register(3, 's2c', 0x26)
+def on_join_game(packet):
+    eid, gm, dim, seed, max_players, level, view, debug_info, respawn_screen = JOIN_GAME.parse(packet.raw_data)
+    packet.game.pid = eid
+    packet.game.change_status(3)  # play
+    packet.raw_data = Buffer(JOIN_GAME.serialize((eid, gm, dim, seed, max_players, level, view, debug_info,
+                                                  respawn_screen)))
+    packet.add_child_packet(get_tab_header_packet(packet.game))
+
+
+# Rightclick detection
+@HANDLERS.register(3, 'c2s', 0x2d)
+def on_use_item(packet):
+    msg = "I right clicked!"
+    msg_bytes = Buffer(STRING.serialize(msg))
+    chat_packet = MCPacket(game=packet.game, p_ID=VarInt(value=0x03), raw_data=msg_bytes, side='c2s')
+    chat_packet.with_compression = True
+    packet.add_child_packet(chat_packet)
+
+
+# Client Block placement
+# face enum: {down_face, up_face, north_face, south_face, west_face, east_face}
+@HANDLERS.register(3, 'c2s', 0x2c, mod_name='BuildingRadio')
+def on_block_placement(packet):
+    hand, location, face, cursor, inside_block = BLOCK_PLACEMENT.parse(packet.raw_data)
+    if packet.game.get_mod('BuildingRadio') == 2:
+        for y in [0, 1, 2]:
+            for x in [-1, 0, 1]:
+                tmp_location = location.copy()
+                tmp_location.x += x
+                tmp_location.y += y
+                msg_bytes = Buffer(BLOCK_PLACEMENT.serialize((hand, tmp_location, 1, cursor, inside_block)))
+                chat_packet = MCPacket(game=packet.game, p_ID=VarInt(value=0x2c), raw_data=msg_bytes, side='c2s')
+                chat_packet.with_compression = True
+                packet.add_child_packet(chat_packet)
+    elif packet.game.get_mod('BuildingRadio') == 1:
+        tmp_location = location.copy()
+        tmp_location.y += 5
+        msg_bytes = Buffer(BLOCK_PLACEMENT.serialize((hand, tmp_location, face, cursor, inside_block)))
+        chat_packet = MCPacket(game=packet.game, p_ID=VarInt(value=0x2c), raw_data=msg_bytes, side='c2s')
+        chat_packet.with_compression = True
+        packet.add_child_packet(chat_packet)
+
+    # location.y += 0
+    packet.raw_data = Buffer(BLOCK_PLACEMENT.serialize((hand, location, face, cursor, inside_block)))
+
+
+# Enable Flying
+@HANDLERS.register(3, 's2c', 0x32)
+def on_player_abilities(packet):
+    flags, flying_speed, fov = ABILITIES.parse(packet.raw_data)
+    packet.game.abilities = (flags, flying_speed, fov)
+    if packet.game.get_mod("EnableFlying"):
+        flags = flags | 6
+    packet.raw_data = Buffer(ABILITIES.serialize((flags, flying_speed, fov)))
+
+
+# client movement speed
+@HANDLERS.register(3, 's2c', 0x59)
+def on_entity_properties(packet):
+    eid, length = ENTITY_PROPERTIES.parse(packet.raw_data)
+    if eid.value == int(packet.game.pid):
+        properties = [ENTITY_PROPERTY.parse(packet.raw_data) for i in range(length)]
+        for p in properties:
+            if p[0] == b'generic.movementSpeed':
+                p[1] = packet.game.get_mod("movementSpeed")
+
+        packet.raw_data = Buffer(ENTITY_PROPERTIES.serialize((eid, length)) +
+                                 b''.join([ENTITY_PROPERTY.serialize(p) for p in properties]))
+    else:
+        tmp = packet.raw_data.to_bytes()
+        packet.raw_data = Buffer(ENTITY_PROPERTIES.serialize((eid, length)))
+        packet.raw_data.add_bytes(tmp)
+
+
+# Interact Entity
+# type_enum: {interact, attack, interact_at}
+# hand_enum: {main_hand, off_hand}
+@HANDLERS.register(3, 'c2s', 0x0E)
+def on_interact_entity(packet):
+    game = packet.game
+    entity_id, interaction_type = INTERACT_ENTITY.parse(packet.raw_data)
+    target = None
+    hand = None
+    if interaction_type.value == 2:
+        target = TARGET.parse(packet.raw_data)
+    if interaction_type.value != 1:
+        hand = VARINT.parse(packet.raw_data)
+
+    packet.add_child_packet(get_glow_packet(game, entity_id.value))
+    game.target['ID'] = entity_id
+
+    packet.raw_data = Buffer(INTERACT_ENTITY.serialize((entity_id, interaction_type)))
+    if interaction_type.value == 2:
+        packet.raw_data.add_bytes(TARGET.serialize(target))
+    if interaction_type.value != 1:
+        packet.raw_data.add_bytes(VARINT.serialize(hand))
+
+
+# Entity Metadata
+@HANDLERS.register(3, 's2c', 0x44)
+def on_entity_metadata(packet):
+    game = packet.game
+    entity_id, metadata = ENTITY_METADATA.parse(packet.raw_data)
+
+    if metadata[0][0] is not None:
+        game.entities.set_flags(entity_id.value, metadata[0][0][1])
+        if 'ID' in game.target.keys() and game.target['ID'].value == entity_id.value:
+            metadata[0][0][1] |= 0x40  # glowing flag is on
+    packet.raw_data = Buffer(ENTITY_METADATA.serialize((entity_id, metadata)))
+
+
+# Vehicle Move
+@HANDLERS.register(3, 'c2s', 0x15, mod_name='DropSteering')
+def on_vehicle_move(packet):
+    packet.drop_packet()
+
+
+# Spawn Entity
+@HANDLERS.register(3, 's2c', 0x03, mod_name='giants')
+def on_spawn_entity(packet):
+    entity_id, obj_uuid, type_, position, ang, velocity = SPAWN_ENTITY.parse(packet.raw_data)
+    type_ = 30  # giant
+    packet.raw_data = Buffer(SPAWN_ENTITY.serialize((entity_id, obj_uuid, type_, position, ang, velocity)))
+
+
+# Entity Position
+# Entity Position and Rotation
+@HANDLERS.register(3, 's2c', 0x29, mod_name='DropEntityMovement')
+@HANDLERS.register(3, 's2c', 0x2A, mod_name='DropEntityMovement')
+def on_entity_movement(packet):
+    packet.drop_packet()
+
+
+#       --- ENTITIES (see entities.EntityTable) ---
+
+# Spawn Entity
+# Spawn Mob
+@HANDLERS.register(3, 's2c', 0x00, read_only=True)
+@HANDLERS.register(3, 's2c', 0x03, read_only=True)
+def on_spawn(packet):
+    packet.game.entities.spawn_object(packet.raw_data.copy())
+
+
+# Spawn Player
+@HANDLERS.register(3, 's2c', 0x05, read_only=True)
+def on_spawn_player(packet):
+    packet.game.entities.spawn_player(packet.raw_data.copy())
+
+
+# Entity Position
+# Entity Position and Rotation
+@HANDLERS.register(3, 's2c', 0x29, mod_name='TrackEntities', read_only=True)
+@HANDLERS.register(3, 's2c', 0x2A, mod_name='TrackEntities', read_only=True)
+def on_entity_move(packet):
+    packet.game.entities.move(packet.raw_data.copy())
+
+
+# Entity Teleport
+@HANDLERS.register(3, 's2c', 0x57, mod_name='TrackEntities', read_only=True)
+def on_entity_teleport(packet):
+    packet.game.entities.teleport(packet.raw_data.copy())
+
+
+# Player Position
+@HANDLERS.register(3, 'c2s', 0x11, mod_name='TrackEntities', read_only=True)
+def on_player_position(packet):
+    packet.game.entities.player_position(packet.raw_data.copy())
+
+
+# Player Position And Rotation
+@HANDLERS.register(3, 'c2s', 0x12, mod_name='TrackEntities', read_only=True)
+def on_player_position_rotation(packet):
+    packet.game.entities.player_position_rotation(packet.raw_data.copy())
+
+
+# Player Rotation
+@HANDLERS.register(3, 'c2s', 0x13, mod_name='TrackEntities', read_only=True)
+def on_player_rotation(packet):
+    packet.game.entities.player_rotation(packet.raw_data.copy())
+
+
+# Player Position And Look (server teleport)
+@HANDLERS.register(3, 's2c', 0x36, mod_name='TrackEntities', read_only=True)
+def on_player_teleport(packet):
+    packet.game.entities.player_teleport(packet.raw_data.copy())
+
+
+# Destroy Entities
+@HANDLERS.register(3, 's2c', 0x38, read_only=True)
+def on_destroy_entities(packet):
+    packet.game.entities.destroy(packet.raw_data.copy())
+
+
+# Join Game
+# Respawn
+@HANDLERS.register(3, 's2c', 0x26, read_only=True)
+@HANDLERS.register(3, 's2c', 0x3B, read_only=True)
+def on_entities_reset(packet):
+    packet.game.entities.clear()
+
+
+#       --- MOVEMENT THROTTLE (ThrottleEntityMovement mod, see movement.MovementThrottle) ---
+
+def movement_throttle(game):
+    throttle = game.movement_throttle
+    throttle.interval = game.get_mod('EntityMoveInterval')
+    return throttle
+
+
+'''
+    Returns (entity ID) => position of the entity from the entities table, None if it isn't tracked
+'''
+
+
+def tracked_position(game):
+    if not mod_enabled(game, 'TrackEntities'):
+        return None
+    entities = game.entities
+
+    def position(entity_id):
+        record = entities.get(entity_id)
+        if record is None or record.type is None:  # spawned before the proxy saw it, the position is unknown
+            return None
+        return entities.position(entity_id)
+
+    return position
+
+
+'''
+    Returns the held moves to send now as MCPackets: all of them if a flush was requested
+    (ThrottleEntityMovement was turned off), else the ones whose interval is over
+    Called by the s2c pipeline only, after every batch & when held_movement_due() is reached
+'''
+
+
+def held_movement_packets(game):
+    if game.take_movement_flush():
+        updates = game.movement_throttle.flush(time.monotonic())
+    elif mod_enabled(game, 'ThrottleEntityMovement'):
+        updates = movement_throttle(game).due(time.monotonic())
+    else:
+        return []
+    packets = []
+    for packet_id, data in updates:
+        update = MCPacket(game=game, p_ID=VarInt(value=packet_id), raw_data=Buffer(data), side='s2c')
+        update.with_compression = game.with_compression
+        packets.append(update)
+    return packets
+
+
+'''
+    Returns the time.monotonic() the next held move is due, or None if there is none
+'''
+
+
+def held_movement_due(game):
+    if not mod_enabled(game, 'ThrottleEntityMovement'):
+        return None
+    return game.movement_throttle.next_due()
+
+
+def add_movement_updates(packet, updates):
+    game = packet.game
+    for packet_id, data in updates:
+        update = MCPacket(game=game, p_ID=VarInt(value=packet_id), raw_data=Buffer(data), side='s2c')
+        update.with_compression = game.with_compression
+        packet.add_child_packet(update)
+
+
+# Entity Position
+# Entity Position and Rotation
+# Entity Rotation
+@HANDLERS.register(3, 's2c', 0x29, mod_name='ThrottleEntityMovement')
+@HANDLERS.register(3, 's2c', 0x2A, mod_name='ThrottleEntityMovement')
+@HANDLERS.register(3, 's2c', 0x2B, mod_name='ThrottleEntityMovement')
+def on_throttled_movement(packet):
+    game = packet.game
+    if mod_enabled(game, 'DropEntityMovement'):  # dropped anyway
+        return
+    updates = movement_throttle(game).move(packet.p_ID.value, packet.raw_data.copy(), time.monotonic(),
+                                           tracked_position(game))
+    packet.drop_packet()
+    add_movement_updates(packet, updates)
+
+
+# Entity Teleport
+@HANDLERS.register(3, 's2c', 0x57, mod_name='ThrottleEntityMovement')
+def on_throttled_teleport(packet):
+    now = time.monotonic()
+    throttle = movement_throttle(packet.game)
+    throttle.teleported(packet.raw_data.copy(), now)
+    add_movement_updates(packet, throttle.due(now))
+
+
+# Spawn Entity
+# Spawn Mob
+# Spawn Player
+@HANDLERS.register(3, 's2c', 0x00, mod_name='ThrottleEntityMovement', read_only=True)
+@HANDLERS.register(3, 's2c', 0x03, mod_name='ThrottleEntityMovement', read_only=True)
+@HANDLERS.register(3, 's2c', 0x05, mod_name='ThrottleEntityMovement', read_only=True)
+def on_throttled_spawn(packet):
+    movement_throttle(packet.game).spawned(packet.p_ID.value, packet.raw_data.copy())
+
+
+# Destroy Entities
+@HANDLERS.register(3, 's2c', 0x38, mod_name='ThrottleEntityMovement', read_only=True)
+def on_throttled_destroy(packet):
+    movement_throttle(packet.game).destroyed(packet.raw_data.copy())
+
+
+# Join Game
+# Respawn
+@HANDLERS.register(3, 's2c', 0x26, mod_name='ThrottleEntityMovement', read_only=True)
+@HANDLERS.register(3, 's2c', 0x3B, mod_name='ThrottleEntityMovement', read_only=True)
+def on_throttle_reset(packet):
+    movement_throttle(packet.game).clear()
+
+
+#       --- BLOCKS (TrackBlocks mod, see chunks.World) ---
+
+# Join Game
+# Respawn
+@HANDLERS.register(3, 's2c', 0x26, mod_name='TrackBlocks', read_only=True)
+@HANDLERS.register(3, 's2c', 0x3B, mod_name='TrackBlocks', read_only=True)
+def on_world_change(packet):
+    packet.game.world.clear()
+
+
+# Chunk Data
+@HANDLERS.register(3, 's2c', 0x22, mod_name='TrackBlocks', read_only=True)
+def on_chunk_data(packet):
+    packet.game.world.load_chunk(packet.raw_data.copy())
+
+
+# Unload Chunk
+@HANDLERS.register(3, 's2c', 0x1E, mod_name='TrackBlocks', read_only=True)
+def on_unload_chunk(packet):
+    packet.game.world.unload_chunk(packet.raw_data.copy())
+
+
+# Block Change
+@HANDLERS.register(3, 's2c', 0x0C, mod_name='TrackBlocks', read_only=True)
+def on_block_change(packet):
+    packet.game.world.block_change(packet.raw_data.copy())
+
+
+# Multi Block Change
+@HANDLERS.register(3, 's2c', 0x10, mod_name='TrackBlocks', read_only=True)
+def on_multi_block_change(packet):
+    packet.game.world.multi_block_change(packet.raw_data.copy())
+
+
 class StopMessage:
     pass
 
@@ -593,109 +1163,180 @@ class PreferenceUpdateMessage:
             self.payload.append(get_tab_header_packet(game))
 
         elif self.mod_name == 'EnableFlying':
-            tmp = list(game.get_mod("_Abilities"))
+            if game.abilities is None:  # not received yet
+                raise ValueError
+            tmp = list(game.abilities)
             if game.get_mod("EnableFlying"):
                 tmp[0] = tmp[0] | 6
                 tmp[1] = 1
-            abilities_bytes = Buffer(serialize_types(['byte', 'float', 'float'], tmp))
+            abilities_bytes = Buffer(ABILITIES.serialize(tmp))
             abilities_packet = MCPacket(game=game, p_ID=VarInt(value=0x32), raw_data=abilities_bytes, side='s2c')
             abilities_packet.with_compression = game.with_compression
             self.payload.append(abilities_packet)
 
+        elif self.mod_name == 'ThrottleEntityMovement':
+            # the moves aren't held anymore: what's held is sent by the s2c pipeline (see held_movement_packets),
+            # the throttle is only used by it and this message may be handled on the c2s one
+            if not game.get_mod('ThrottleEntityMovement'):
+                game.request_movement_flush()
+
         elif self.mod_name == 'movementSpeed':
             tmp = [[b'generic.movementSpeed', game.get_mod("movementSpeed"), []]]
-            speed_bytes = Buffer(
-                serialize_types(['varint', 'int', [1, ['string', 'double', [-1, 'uuid', 'double', 'byte']]]],
-                                (int(game.pid), 1, tmp)))
+            speed_bytes = Buffer(ENTITY_PROPERTIES.serialize((int(game.pid), 1)) + ENTITY_PROPERTY.serialize(tmp[0]))
             speed_packet = MCPacket(game=game, p_ID=VarInt(value=0x59), raw_data=speed_bytes, side='s2c')
             speed_packet.with_compression = game.with_compression
             self.payload.append(speed_packet)
 
 
 class MCPacketQueue:
-    def __init__(self):
+    # One Condition guards the deque, and consumers wait on its predicate (not empty / closed):
+    # a notify that fires before the consumer starts waiting is never lost.
+    # Consumers take whole batches (see drain), depth() is the number of waiting items.
+    BATCH = 512  # most items one drain returns, so the first of a burst isn't held back by the whole burst
+
+    # [name] : the queue's depth is reported in the metrics under this name
+    def __init__(self, name=None):
         self._q = deque()
-        self.lock = threading.Lock()
         self.new_packet = threading.Condition()
+        self.name = name
+        self._closed = False
+        # [items appended so far, highest depth seen], a list so the metrics can keep it after the queue is gone
+        self.stats = [0, 0]
+        if name is not None:
+            METRICS.watch_queue(self)
 
     def pop_one(self):
-        with self.lock:
+        with self.new_packet:
             return self._q.popleft()
 
     def pop_all(self):
-        with self.lock:
-            items = []
-            while bool(self._q):
-                items.append(self._q.popleft())
+        with self.new_packet:
+            items = list(self._q)
+            self._q.clear()
+            return items
+
+    '''
+    Waits until there are items (or the queue is closed), and pops up to [max_items] of them
+    Returns [] if the queue was closed and is empty, or on [timeout]
+    '''
+
+    def drain(self, max_items=BATCH, timeout=None):
+        with self.new_packet:
+            self.new_packet.wait_for(lambda: self._q or self._closed, timeout)
+            if len(self._q) <= max_items:
+                items = list(self._q)
+                self._q.clear()
+            else:
+                items = [self._q.popleft() for i in range(max_items)]
             return items
 
     def append_one(self, obj):
-        with self.lock:
-            if type(obj) in [MCPacket, StopMessage]:
-                self._q.append(obj)
-                with self.new_packet:
-                    self.new_packet.notify_all()
-            elif istype(obj, PreferenceUpdateMessage):  # add payload to queue, remove the shell (PrefUpdatePacket)
+        self.append_all([obj])
 
+    def append_all(self, obj_list):
+        items = []
+        for obj in obj_list:
+            obj_type = type(obj)
+            if obj_type is MCPacket or obj_type is StopMessage:
+                items.append(obj)
+            elif obj_type is PreferenceUpdateMessage:  # add payload to queue, remove the shell (PrefUpdatePacket)
                 if obj.payload is not None:
-                    for child in obj.payload:
-                        if child is not None and istype(child, MCPacket):
-                            self._q.append(child)
+                    items += [child for child in obj.payload if type(child) is MCPacket]
                 else:
-                    self._q.append(obj)
+                    items.append(obj)
             else:
-                raise ValueError
+                raise ValueError("UNKNOWN TYPE " + str(obj_type))
 
-    def append_all(self, obj_list):
-        with self.lock:
-            for obj in obj_list:
-                if istype(obj, MCPacket) or istype(obj, StopMessage):
-                    self._q.append(obj)
-                elif istype(obj, PreferenceUpdateMessage):  # add payload to queue, remove the shell (PrefUpdatePacket)
-                    if obj.payload is not None:
-                        for child in obj.payload:
-                            if child is not None and istype(child, MCPacket):
-                                self._q.append(child)
-                    else:
-                        self._q.append(obj)
-                else:
-                    raise Exception("UNKNOWN TYPE " + type(obj))
+        if items:
             with self.new_packet:
+                self._q.extend(items)
+                stats = self.stats
+                stats[0] += len(items)
+                if len(self._q) > stats[1]:
+                    stats[1] = len(self._q)
                 self.new_packet.notify_all()
 
     def empty(self):
-        with self.lock:
-            return not bool(self._q)
+        return not self._q
+
+    def closed(self):
+        return self._closed
+
+    def depth(self):
+        return len(self._q)
+
+    '''
+    Wakes up the consumers for good: drain() returns [] once the queue is empty
+    '''
+
+    def close(self):
+        with self.new_packet:
+            self._closed = True
+            self.new_packet.notify_all()
 
     '''
-    Pops out all MCPackets and packs into bytes
-    Return a tuple:  ([bytes] send_to_client_queue,  [bytes] send_to_server_queue)
-                    Or in reverse order, depending on priority_side
+    Pops out all MCPackets and packs them (see pack_packets)
     '''
 
     def pack_all(self, priority_side='c2s'):
-        all_packets = self.pop_all()
-        send_data = b''
-        other_packets = []
-        stop_flag = False
-        for packet in all_packets:
-            if istype(packet, MCPacket):
-                if packet.side.startswith(priority_side):
-                    packet_data, packet_other_packets = packet.pack()
-                    send_data += packet_data
-                    other_packets += packet_other_packets
-                else:
-                    other_packets.append(packet)
-            elif type(packet) == StopMessage:
-                stop_flag = True
-            else:
-                raise Exception("UNKNOWN PACKET TYPE")
-        return send_data, other_packets, stop_flag
+        return pack_packets(self.pop_all(), priority_side)
 
     def send_stop_signal(self):
         self.append_one(StopMessage())
 
 
+'''
+    Packs a list of MCPackets into a list of buffers (to be sent one after another, see send_buffers)
+    Return a tuple:  ([list] send_buffers,  [list] other_side_packets,  [bool] stop_flag)
+'''
+
+
+def pack_packets(all_packets, priority_side='c2s'):
+    send_buffers = []
+    other_packets = []
+    stop_flag = False
+    for packet in all_packets:  # big payloads are compressed in parallel, while the rest are packed
+        if istype(packet, MCPacket) and packet.side.startswith(priority_side):
+            packet.precompress()
+    for packet in all_packets:
+        if istype(packet, MCPacket):
+            if packet.side.startswith(priority_side):
+                other_packets += packet.pack_into(send_buffers)
+            else:
+                other_packets.append(packet)
+        elif type(packet) == StopMessage:
+            stop_flag = True
+        else:
+            raise Exception("UNKNOWN PACKET TYPE")
+    if send_buffers:
+        METRICS.sent(priority_side, sum(map(len, send_buffers)))
+    return send_buffers, other_packets, stop_flag
+
+
+SENDMSG_MAX_BUFFERS = 1024  # IOV_MAX on Linux
+
+'''
+    Sends the list of [buffers] to the (blocking) socket [sock] with scatter-gather sendmsg,
+    and keeps sending the rest after partial writes
+'''
+
+
+def send_buffers(sock, buffers):
+    if not hasattr(sock, 'sendmsg'):  # no sendmsg (Windows)
+        sock.sendall(b''.join(buffers))
+        return
+
+    buffers = deque([memoryview(buffer) for buffer in buffers if len(buffer) > 0])
+    while buffers:
+        sent = sock.sendmsg(list(itertools.islice(buffers, SENDMSG_MAX_BUFFERS)))
+        while sent > 0:  # drop what was sent
+            if sent >= len(buffers[0]):
+                sent -= len(buffers.popleft())
+            else:  # partially sent buffer
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+
 class Process(threading.Thread):
     def __init__(self, in_queue, out_queue, side, game):
         threading.Thread.__init__(self)
@@ -707,41 +1348,98 @@ class Process(threading.Thread):
 
     def run(self):
         while not self.__stop:
-            with self.in_queue.new_packet:  # Wait for new packets
-                self.in_queue.new_packet.wait()
-            packets = self.in_queue.pop_all()
+            packets = self.in_queue.drain(timeout=self.__wait_timeout())  # Wait for new packets
+            if not packets and self.in_queue.closed():
+                break
 
             for p in packets:
-                if istype(p, MCPacket):
-                    p.unpack(self.game.with_compression)
-                    p.handle()
-                elif type(p) == StopMessage:
+                if type(p) is MCPacket:
+                    p.process(self.game.with_compression)
+                elif type(p) is StopMessage:
                     self.__stop = True
-                elif istype(p, PreferenceUpdateMessage):
+                elif type(p) is PreferenceUpdateMessage:
                     p.handle(self.game)
                 else:
                     raise Exception(f"UNKNOWN TYPE {type(p)} IN QUEUE")
+            self.game.flush_entity_moves()
+            if self.side == 's2c':  # also wakes up (with no packets) when a held move is due
+                packets += held_movement_packets(self.game)
 
             self.out_queue.append_all(packets)
 
+    # Seconds until the next held entity move is due (s2c), None: wait for packets only
+    def __wait_timeout(self):
+        if self.side != 's2c':
+            return None
+        due = held_movement_due(self.game)
+        return None if due is None else max(0.0, due - time.monotonic())
+
+
+class ModSnapshot(Mapping):
+    # An immutable version of the mods of a Game. Readers take the current snapshot without locking,
+    # writers build a new snapshot and swap the reference (see Game.set_mod).
+    # [active_handlers] caches HANDLERS.active() for this snapshot, it is dropped with it
+    __slots__ = ['_mods', 'active_handlers', 'sources']
+
+    def __init__(self, mods=None, sources=None):
+        self._mods = dict(mods) if mods is not None else {}
+        self.active_handlers = {}  # (state, side, packet ID) => (handlers, all read only?)
+        self.sources = sources  # the snapshots this one was merged from (Session)
+
+    def __getitem__(self, mod_name):
+        return self._mods[mod_name]
+
+    def __contains__(self, mod_name):
+        return mod_name in self._mods
+
+    def __iter__(self):
+        return iter(self._mods)
+
+    def __len__(self):
+        return len(self._mods)
+
+    def get(self, mod_name, default=None):
+        return self._mods.get(mod_name, default)
+
+    '''
+    Returns a new snapshot with [changes] (dict) applied
+    '''
+
+    def updated(self, changes):
+        mods = dict(self._mods)
+        mods.update(changes)
+        return ModSnapshot(mods)
+
+
+_MISSING = object()
+
 
 class Game:
     # states: 0 = idle? ; 1 = status ; 2 = login ; 3 = play
+    # The mods are an immutable ModSnapshot, replaced as a whole on every change, so reading them takes no lock.
+    # The protocol state (state, compression, pid, target...) is only written by the connection's own pipeline,
+    # and every value is a single reference (swapped atomically), so it is read & written without a lock too.
+    # The lock serializes the mods' writers and the lazy creation of the entities & world.
     def __init__(self, fake_username=None):
         self.__lock = threading.Lock()
         self._game_stop = threading.Condition()
 
         self._gui_obj = None
 
-        self._mods = {}
+        self._mods = ModSnapshot()
         self._state = 0
         self._player_id = 0
         self.set_mod('EnableFakename', False)  # is enabled?
         self.set_mod('FakenameInput', 'Pr0xyUs3r')  # fake name
-        self._compression = [False, 0]  # is enabled?   compression size
+        self._compression = (False, 0)  # is enabled?   compression size
+        self._compressors = {'c2s': Compressor(), 's2c': Compressor()}  # see compression.compressors_from_preferences
 
-        self._last_effect_metadata = {}  # for glowing effect after an interaction
+        self._entities = None  # entities.EntityTable, created on first use (it needs NumPy)
         self._target = {}
+        self._abilities = None  # last Player Abilities (flags, flying speed, fov) from the server
+        self._world = None  # chunks.World, created on first use (NumPy is imported only if blocks are tracked)
+        self._movement_throttle = None  # movement.MovementThrottle, created on first use
+        self._movement_flush = False  # the s2c pipeline should send the held moves (see request_movement_flush)
 
         self.preference_update_queue = MCPacketQueue()  # tmp one
         self.set_mod('EnableFakename', fake_username is not None)
@@ -752,120 +1450,267 @@ class Game:
     # CONNECTION-GAME STATE PROPERTY
     @property
     def state(self):
-        with self.__lock:
-            return self._state
+        return self._state
 
     @state.setter
     def state(self, new_state):
-        with self.__lock:
-            self._state = new_state
+        self._state = new_state
 
     # GUI OBJECT PROPERTY
     @property
     def gui_obj(self):
-        with self.__lock:
-            return self._gui_obj
+        return self._gui_obj
 
     @gui_obj.setter
     def gui_obj(self, gui_obj):
-        with self.__lock:
-            self._gui_obj = gui_obj
+        self._gui_obj = gui_obj
 
     # ACTUAL LOGIN USERNAME PROPERTY
     @property
     def login_username(self):
-        with self.__lock:
-            return self._login_username
+        return self._login_username
 
     @login_username.setter
     def login_username(self, login_username):
-        with self.__lock:
-            if type(login_username) == str:
-                self._login_username = login_username
-            else:
-                self._login_username = login_username.decode()
+        if type(login_username) == str:
+            self._login_username = login_username
+        else:
+            self._login_username = login_username.decode()
 
     # COMPRESSION PROPERTY
     @property
     def with_compression(self):
-        with self.__lock:
-            return self._compression[0]
+        return self._compression[0]
 
     @with_compression.setter
     def with_compression(self, with_compression):
-        with self.__lock:
-            if type(with_compression) == bool:
-                self._compression[0] = with_compression
-            else:
-                raise ValueError
+        if type(with_compression) == bool:
+            self._compression = (with_compression, self._compression[1])
+        else:
+            raise ValueError
 
     @property
     def compression_size(self):
-        with self.__lock:
-            return self._compression[1]
+        return self._compression[1]
 
     @compression_size.setter
     def compression_size(self, compression_size):
-        with self.__lock:
-            if type(compression_size) == np.int32 and compression_size >= 0:
-                self._compression[1] = compression_size
-                self._compression[0] = compression_size > 0
-            else:
-                raise ValueError
+        if type(compression_size) == int and compression_size >= 0:
+            self._compression = (compression_size > 0, compression_size)
+        else:
+            raise ValueError
+
+    # COMPRESSORS PROPERTY
+    @property
+    def compressors(self):
+        return dict(self._compressors)
+
+    @compressors.setter
+    def compressors(self, compressors):
+        if set(compressors.keys()) == {'c2s', 's2c'}:
+            self._compressors = dict(compressors)
+        else:
+            raise ValueError
+
+    # Returns the Compressor of the packets of [side]
+    def compressor(self, side):
+        return self._compressors[side]
 
     # GAME STOP PROPERTY
     @property
     def game_stop(self):
-        with self.__lock:
-            return self._game_stop
+        return self._game_stop
 
     # PLAYER_ID PROPERTY
     @property
     def pid(self):
-        with self.__lock:
-            return self._player_id
+        return self._player_id
 
     @pid.setter
     def pid(self, pid):
-        with self.__lock:
-            if type(pid) == np.int32 and pid >= 0:
-                self._player_id = pid
-            else:
-                raise ValueError
+        if type(pid) == int and pid >= 0:
+            self._player_id = pid
+        else:
+            raise ValueError
 
-    # LAST EFFECT METADATA PROPERTY
+    # ENTITIES PROPERTY
     @property
-    def last_effect_metadata(self):
-        with self.__lock:
-            return self._last_effect_metadata
+    def entities(self):
+        entities = self._entities
+        if entities is None:
+            with self.__lock:
+                if self._entities is None:
+                    from entities import EntityTable
+                    self._entities = EntityTable()
+                entities = self._entities
+        return entities
+
+    # Applies the entity moves queued while processing a batch of packets
+    def flush_entity_moves(self):
+        entities = self._entities
+        if entities is not None:
+            entities.flush_moves()
 
     # TARGET PROPERTY
     @property
     def target(self):
-        with self.__lock:
-            return self._target
+        return self._target
+
+    # PLAYER ABILITIES PROPERTY
+    @property
+    def abilities(self):
+        return self._abilities
+
+    @abilities.setter
+    def abilities(self, abilities):
+        self._abilities = tuple(abilities)
+
+    # BLOCKS AROUND THE PLAYER PROPERTY
+    @property
+    def world(self):
+        world = self._world
+        if world is None:
+            with self.__lock:
+                if self._world is None:
+                    from chunks import World
+                    self._world = World()
+                world = self._world
+        return world
+
+    # ENTITY MOVEMENT THROTTLE PROPERTY (the held moves of the connection's entities)
+    @property
+    def movement_throttle(self):
+        throttle = self._movement_throttle
+        if throttle is None:
+            with self.__lock:
+                if self._movement_throttle is None:
+                    from movement import MovementThrottle
+                    self._movement_throttle = MovementThrottle()
+                throttle = self._movement_throttle
+        return throttle
+
+    # Asks the s2c pipeline to send the held entity moves: the throttle is used only by it (no lock),
+    # while the PreferenceUpdateMessage that turns it off may be handled by the c2s pipeline
+    def request_movement_flush(self):
+        self._movement_flush = True
+
+    # Was a flush of the held entity moves requested? (the request is cleared)
+    def take_movement_flush(self):
+        requested = self._movement_flush
+        self._movement_flush = False
+        return requested
+
+    # Returns the block state ID at (x, y, z), or None if it isn't known (see the TrackBlocks mod)
+    def block_at(self, x, y, z):
+        return self.world.block_at(x, y, z)
 
     def set_mod(self, mod_name, value):
-        with self.__lock:
-            if type(mod_name) == str:
-                if mod_name == 'FakenameInput':
-                    if type(value) == str and len(value) > 1:
-                        self._mods[mod_name] = value
-                else:
-                    self._mods[mod_name] = value
-            else:
+        self.set_mods({mod_name: value})
+
+    # Sets several mods at once (a single new snapshot)
+    def set_mods(self, mods):
+        changes = {}
+        for mod_name, value in mods.items():
+            if type(mod_name) != str:
                 raise ValueError
+            if mod_name == 'FakenameInput' and not (type(value) == str and len(value) > 1):
+                continue
+            changes[mod_name] = value
+        with self.__lock:
+            self._mods = self._mods.updated(changes)
 
     def get_mod(self, mod_name):
-        with self.__lock:
-            if type(mod_name) == str and mod_name in self._mods.keys():
-                return self._mods[mod_name]
+        value = self._mods.get(mod_name, _MISSING)
+        if value is _MISSING or type(mod_name) != str:
             raise ValueError
+        return value
+
+    # ALL THE MODS (the current ModSnapshot, immutable)
+    def mods(self):
+        return self._mods
+
+    # CURRENT MODS SNAPSHOT PROPERTY (what the packet handlers see)
+    @property
+    def mod_snapshot(self):
+        return self._mods
 
     # GET IP & PORTS OF SERVER & CLIENT
     def sockets_info(self):
         return [self.get_mod(x) for x in ['clientIP', 'clientPort', 'serverIP', 'serverPort']]
 
+    # Reports the status to the controller (GUI / headless), if there is one attached
+    def change_status(self, status):
+        gui_obj = self.gui_obj
+        if gui_obj is not None:
+            gui_obj.change_status_label(status)
+
+
+class Session(Game):
+    # Per-connection game state (used by the asyncio engine)
+    # protocol state (state, compression, pid, target...) belongs to the connection,
+    # mods that the connection didn't set itself are read from the shared settings Game
+    def __init__(self, settings, session_id):
+        super().__init__()
+        self._mods = ModSnapshot()  # drop Game's defaults, the shared settings hold them
+        self._merged = ModSnapshot()
+        self._settings = settings
+        self.session_id = session_id
+        self.gui_obj = settings.gui_obj
+
+    def get_mod(self, mod_name):
+        try:
+            return super().get_mod(mod_name)
+        except ValueError:
+            return self._settings.get_mod(mod_name)
+
+    # The settings' mods overridden by the connection's own, merged again only after one of them changed
+    @property
+    def mod_snapshot(self):
+        settings_mods = self._settings.mod_snapshot
+        merged = self._merged
+        sources = merged.sources
+        if sources is None or sources[0] is not settings_mods or sources[1] is not self._mods:
+            merged = ModSnapshot({**settings_mods, **self._mods}, (settings_mods, self._mods))
+            self._merged = merged
+        return merged
+
+    def mods(self):
+        return self.mod_snapshot
+
+    def compressor(self, side):
+        return self._settings.compressor(side)
+
+
+# Values used when a preference is missing from the preferences file (same as the GUI defaults)
+DEFAULT_PREFERENCES = {'clientIP': 'localhost', 'clientPort': 25566, 'serverIP': 'localhost', 'serverPort': 25565,
+                       'CustomMOTD': False, 'CustomHeader': False, 'EnableFakename': False,
+                       'FakenameInput': 'Pr0xyUs3r', 'EnableFlying': False, 'movementSpeed': 0.7,
+                       'BuildingRadio': 0, 'DropSteering': False, 'DropEntityMovement': False,
+                       'EnableCamera': False, 'TrackBlocks': False, 'TrackEntities': True,
+                       'ThrottleEntityMovement': False, 'EntityMoveInterval': 0.2,
+                       'CompressionLevelC2S': DEFAULT_LEVEL, 'CompressionLevelS2C': DEFAULT_LEVEL,
+                       'LANCompression': False, 'CompressionWorkers': 0,
+                       'MetricsPort': 0, 'MetricsFile': '', 'MetricsInterval': 10, 'CaptureFile': '',
+                       'StatusCacheTTL': 5, 'BackendPoolSize': 2, 'Routes': {},
+                       'BalanceStrategy': 'least_connections', 'SocketOptionsClient': {}, 'SocketOptionsServer': {}}
+
+
+'''
+    Loads the preferences JSON (as saved by the GUI) into game
+'''
+
+
+def load_preferences(game, path='gui/preferences.gui'):
+    preferences = dict(DEFAULT_PREFERENCES)
+    try:
+        with open(path) as json_file:
+            preferences.update(json.load(json_file))
+    except FileNotFoundError:
+        pass
+    game.set_mods(preferences)
+    game.compressors = compressors_from_preferences(game)
+    return preferences
+
 
 '''
     Returns the tab header packet
@@ -881,21 +1726,89 @@ def get_tab_header_packet(game):
                             {'bold': True, 'italic': True, 'color': 'dark_red', 'text': 'Proxy'},
                             {'bold': True, 'obfuscated': True, 'color': 'gold', 'text': ' p\n'}], 'text': ''}
     footer = {"translate": ""}
-    tab_list_info_bytes = Buffer(serialize_types(['chat', 'chat'], (header, footer)))
+    tab_list_info_bytes = Buffer(TAB_HEADER.serialize((header, footer)))
     tab_list_packet = MCPacket(game=game, p_ID=VarInt(value=0x54), raw_data=tab_list_info_bytes, side='s2c')
     tab_list_packet.with_compression = game.with_compression
     return tab_list_packet
 
 
-def start_proxy(gui_obj):
-    gui_obj.change_status_label(-2)
+'''
+    Returns an Entity Metadata packet that turns the glowing flag of [entity_id] on
+'''
+
+
+def get_glow_packet(game, entity_id):
+    metadata_array = [None] * 7
+    entity = game.entities.get(entity_id)
+    flags = entity.flags if entity is not None else 0  # an entity the proxy didn't see yet has no flags
+    metadata_array[0] = [VarInt(value=0), flags | 0x40]  # effect index in metadata (byte), glowing flag is on
+    glow_bytes = Buffer(ENTITY_METADATA.serialize((VarInt(value=entity_id), [metadata_array, b'\xff'])))
+    glow_packet = MCPacket(game=game, p_ID=VarInt(value=0x44), raw_data=glow_bytes, side='s2c')
+    glow_packet.with_compression = game.with_compression
+    return glow_packet
+
+
+# Texts of the statuses reported to ProxyController.change_status_label
+STATUS_TEXTS = {-2: "Not running", -1: "Can't connect to server", 0: "Waiting for a client connection",
+                1: "Sending pong to client", 2: "Logging in...", 3: "Playing"}
+RETRY_DELAY = 1.0  # seconds between attempts while the original server is offline
+FIRST_FRAME_TIMEOUT = 10.0  # seconds a new client has to send its handshake
+
+
+class ProxyController:
+    # What start_proxy & Proxy need from the one who runs them (the GUI has the same attributes & methods):
+    # [game] the Game holding the preferences, [run_proxy] keep restarting the proxy, [proxy_obj] the running Proxy
+    def __init__(self, game):
+        self.game = game
+        self.run_proxy = False
+        self.proxy_obj = None
+
+    '''
+    Called on every status change:
+    -2 = proxy offline, -1 = server offline, 0 = waiting for a client, 1 = ping, 2 = login, 3 = play
+    '''
+
+    def change_status_label(self, status):
+        pass
+
+    '''
+    Moves the preferences to the Game of a new connection
+    '''
+
+    def change_game_obj(self, new_game_obj):
+        new_game_obj.set_mods(self.game.mods())  # one new snapshot, never half of the preferences
+        new_game_obj.compressors = self.game.compressors
+        self.game = new_game_obj
+        self.game.gui_obj = self
+
+    '''
+    Stops the proxy (from any thread), like the GUI's 'stop proxy' button
+    '''
+
+    def stop(self):
+        self.run_proxy = False
+        with self.game.game_stop:
+            proxy_obj = self.proxy_obj
+            if proxy_obj is not None and proxy_obj.c2s_send_queue is None:  # still waiting for a client
+                try:
+                    proxy_obj.s.close()
+                except AttributeError:
+                    pass
+            self.game.game_stop.notify_all()
+
+
+def start_proxy(controller):
+    controller.change_status_label(-2)
+    start_metrics(controller.game)
 
-    while gui_obj.run_proxy:
-        proxy_obj = Proxy(gui_obj, *gui_obj.game.sockets_info())
-        gui_obj.proxy_obj = proxy_obj
+    while controller.run_proxy:
+        proxy_obj = Proxy(controller, *controller.game.sockets_info())
+        controller.proxy_obj = proxy_obj
         print(f"\n<== Starting PROXY ==>")
         proxy_obj.run()
         print("~=~ Stopped PROXY ~=~")
-        gui_obj.change_status_label(-2)  # proxy offline
-        gui_obj.proxy_obj = None
-    gui_obj.change_status_label(-2)  # proxy offline
+        controller.change_status_label(-2)  # proxy offline
+        controller.proxy_obj = None
+        if proxy_obj.server_offline and controller.run_proxy:  # don't spin while the server is offline
+            time.sleep(RETRY_DELAY)
+    controller.change_status_label(-2)  # proxy offline
@@ -0,0 +1,336 @@
+#######################################
+#		Created by Gilad Savoray
+#               May 2021
+#######################################
+
+# Counters & histograms of what the proxy does, per (direction, state, packet ID)
+# Served in the Prometheus text format on http://127.0.0.1:<MetricsPort>/metrics,
+# and / or written to <MetricsFile> every <MetricsInterval> seconds.
+# Recording costs one lock and a couple of dict lookups per packet.
+import os
+import threading
+import weakref
+from bisect import bisect_left
+from collections import deque
+
+# Upper bounds (seconds) of the handler time histogram buckets
+HANDLER_TIME_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005, 0.025)
+
+
+class Metrics:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self._packets = {}  # (direction, state, packet ID) => [packets, wire bytes]
+        self._decompressed = {}  # (direction, state, packet ID) => [compressed bytes, uncompressed bytes]
+        self._handler_times = {}  # (direction, state, packet ID) => [bucket counts..., +Inf count, sum]
+        self._sent = {}  # direction => [writes, bytes]
+        self._dropped = {}  # direction => packets
+        self._injected = {}  # direction => child packets
+        self._decompression_failures = {}  # (direction, state) => packets
+        self._queues = weakref.WeakSet()  # named MCPacketQueues
+        self._dead_queues = deque()  # (name, stats) of the queues that were garbage collected, see watch_queue
+        self._retired_items = {}  # queue name => items appended to the queues that are gone
+
+    def packet(self, direction, state, packet_id, size):
+        key = (direction, state, packet_id)
+        with self.__lock:
+            entry = self._packets.get(key)
+            if entry is None:
+                entry = self._packets[key] = [0, 0]
+            entry[0] += 1
+            entry[1] += size
+
+    def decompressed(self, direction, state, packet_id, compressed_size, size):
+        key = (direction, state, packet_id)
+        with self.__lock:
+            entry = self._decompressed.get(key)
+            if entry is None:
+                entry = self._decompressed[key] = [0, 0]
+            entry[0] += compressed_size
+            entry[1] += size
+
+    def handler_time(self, direction, state, packet_id, seconds):
+        key = (direction, state, packet_id)
+        bucket = bisect_left(HANDLER_TIME_BUCKETS, seconds)
+        with self.__lock:
+            entry = self._handler_times.get(key)
+            if entry is None:
+                entry = self._handler_times[key] = [0] * (len(HANDLER_TIME_BUCKETS) + 1) + [0.0]
+            entry[bucket] += 1
+            entry[-1] += seconds
+
+    def sent(self, direction, size):
+        with self.__lock:
+            entry = self._sent.get(direction)
+            if entry is None:
+                entry = self._sent[direction] = [0, 0]
+            entry[0] += 1
+            entry[1] += size
+
+    def dropped(self, direction, count=1):
+        with self.__lock:
+            self._dropped[direction] = self._dropped.get(direction, 0) + count
+
+    def injected(self, direction, count=1):
+        with self.__lock:
+            self._injected[direction] = self._injected.get(direction, 0) + count
+
+    # A packet that couldn't be decompressed (and was dropped)
+    def decompression_failed(self, direction, state):
+        key = (direction, state)
+        with self.__lock:
+            self._decompression_failures[key] = self._decompression_failures.get(key, 0) + 1
+
+    '''
+    Reports the depth of [queue] (an MCPacketQueue with a name) for as long as it exists,
+    its appended items stay counted after it's gone (mcproxy_queue_items_total is a counter)
+    '''
+
+    def watch_queue(self, queue):
+        with self.__lock:
+            self._queues.add(queue)
+        # the finalizer may run in the garbage collector while this thread holds the lock: deque.append needs none
+        weakref.finalize(queue, self._dead_queues.append, (queue.name, queue.stats))
+
+    def clear(self):
+        with self.__lock:
+            for table in [self._packets, self._decompressed, self._handler_times, self._sent, self._dropped,
+                          self._injected, self._decompression_failures, self._retired_items]:
+                table.clear()
+
+    '''
+    Returns a copy of all the metrics (plain dicts & lists, can be pickled & merged with merge_snapshots)
+    '''
+
+    def snapshot(self):
+        with self.__lock:
+            snapshot = {'packets': {key: list(entry) for key, entry in self._packets.items()},
+                        'decompressed': {key: list(entry) for key, entry in self._decompressed.items()},
+                        'handler_times': {key: list(entry) for key, entry in self._handler_times.items()},
+                        'sent': {key: list(entry) for key, entry in self._sent.items()},
+                        'dropped': dict(self._dropped),
+                        'injected': dict(self._injected),
+                        'decompression_failures': dict(self._decompression_failures)}
+            queues = list(self._queues)  # first: these can't be collected anymore, the others are in _dead_queues
+            while self._dead_queues:
+                name, stats = self._dead_queues.popleft()
+                self._retired_items[name] = self._retired_items.get(name, 0) + stats[0]
+            retired_items = dict(self._retired_items)
+
+        depths = {name: [0, 0, items] for name, items in retired_items.items()}  # name => [depth, high water, total]
+        for queue in queues:
+            entry = depths.setdefault(queue.name, [0, 0, 0])
+            entry[0] += queue.depth()
+            entry[1] = max(entry[1], queue.stats[1])
+            entry[2] += queue.stats[0]
+        snapshot['queues'] = depths
+        return snapshot
+
+    '''
+    Returns all the metrics in the Prometheus text exposition format
+    '''
+
+    def render(self):
+        snapshot = self.snapshot()
+        packets = snapshot['packets']
+        decompressed = snapshot['decompressed']
+        handler_times = snapshot['handler_times']
+        sent = snapshot['sent']
+        dropped = snapshot['dropped']
+        injected = snapshot['injected']
+        decompression_failures = snapshot['decompression_failures']
+        depths = snapshot['queues']
+
+        lines = []
+
+        def family(name, type_, help_):
+            lines.append(f'# HELP {name} {help_}')
+            lines.append(f'# TYPE {name} {type_}')
+
+        family('mcproxy_packets_total', 'counter', 'Received packets')
+        for key, entry in sorted(packets.items()):
+            lines.append(f'mcproxy_packets_total{{{_labels(key)}}} {entry[0]}')
+        family('mcproxy_received_bytes_total', 'counter', 'Received bytes (as on the wire)')
+        for key, entry in sorted(packets.items()):
+            lines.append(f'mcproxy_received_bytes_total{{{_labels(key)}}} {entry[1]}')
+
+        family('mcproxy_compressed_bytes_total', 'counter', 'Compressed size of the decompressed packets')
+        for key, entry in sorted(decompressed.items()):
+            lines.append(f'mcproxy_compressed_bytes_total{{{_labels(key)}}} {entry[0]}')
+        family('mcproxy_uncompressed_bytes_total', 'counter', 'Uncompressed size of the decompressed packets')
+        for key, entry in sorted(decompressed.items()):
+            lines.append(f'mcproxy_uncompressed_bytes_total{{{_labels(key)}}} {entry[1]}')
+
+        family('mcproxy_handler_seconds', 'histogram', 'Time spent in the packet handlers')
+        for key, entry in sorted(handler_times.items()):
+            labels = _labels(key)
+            cumulative = 0
+            for bound, count in zip(HANDLER_TIME_BUCKETS, entry):
+                cumulative += count
+                lines.append(f'mcproxy_handler_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            cumulative += entry[len(HANDLER_TIME_BUCKETS)]
+            lines.append(f'mcproxy_handler_seconds_bucket{{{labels},le="+Inf"}} {cumulative}')
+            lines.append(f'mcproxy_handler_seconds_sum{{{labels}}} {entry[-1]}')
+            lines.append(f'mcproxy_handler_seconds_count{{{labels}}} {cumulative}')
+
+        family('mcproxy_sent_bytes_total', 'counter', 'Sent bytes')
+        for direction, entry in sorted(sent.items()):
+            lines.append(f'mcproxy_sent_bytes_total{{direction="{direction}"}} {entry[1]}')
+        family('mcproxy_send_batches_total', 'counter', 'Batches of packets written to a socket')
+        for direction, entry in sorted(sent.items()):
+            lines.append(f'mcproxy_send_batches_total{{direction="{direction}"}} {entry[0]}')
+
+        family('mcproxy_dropped_packets_total', 'counter', 'Packets dropped by handlers')
+        for direction, count in sorted(dropped.items()):
+            lines.append(f'mcproxy_dropped_packets_total{{direction="{direction}"}} {count}')
+        family('mcproxy_injected_packets_total', 'counter', 'Child packets added by handlers')
+        for direction, count in sorted(injected.items()):
+            lines.append(f'mcproxy_injected_packets_total{{direction="{direction}"}} {count}')
+
+        family('mcproxy_decompression_failures_total', 'counter',
+               "Packets dropped because they couldn't be decompressed (corrupt, or over the size cap)")
+        for (direction, state), count in sorted(decompression_failures.items()):
+            lines.append(f'mcproxy_decompression_failures_total{{direction="{direction}",state="{state}"}} {count}')
+
+        family('mcproxy_queue_depth', 'gauge', 'Items waiting in the packet queues')
+        for name, entry in sorted(depths.items()):
+            lines.append(f'mcproxy_queue_depth{{queue="{name}"}} {entry[0]}')
+        family('mcproxy_queue_high_water', 'gauge', 'Highest depth of the packet queues')
+        for name, entry in sorted(depths.items()):
+            lines.append(f'mcproxy_queue_high_water{{queue="{name}"}} {entry[1]}')
+        family('mcproxy_queue_items_total', 'counter', 'Items appended to the packet queues')
+        for name, entry in sorted(depths.items()):
+            lines.append(f'mcproxy_queue_items_total{{queue="{name}"}} {entry[2]}')
+
+        return '\n'.join(lines) + '\n'
+
+    '''
+    Writes render() to [path] (replaced atomically, a reader never sees half a file)
+    '''
+
+    def dump(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(tmp_path, path)
+
+
+'''
+    Sums snapshots of several Metrics (e.g. of worker processes) into one, the queues' high water is the max
+'''
+
+
+def merge_snapshots(snapshots):
+    merged = {'packets': {}, 'decompressed': {}, 'handler_times': {}, 'sent': {}, 'dropped': {}, 'injected': {},
+              'decompression_failures': {}, 'queues': {}}
+    for snapshot in snapshots:
+        for table in ['packets', 'decompressed', 'handler_times', 'sent', 'queues']:
+            merged_table = merged[table]
+            for key, entry in snapshot.get(table, {}).items():
+                merged_entry = merged_table.get(key)
+                if merged_entry is None:
+                    merged_table[key] = list(entry)
+                elif table == 'queues':
+                    merged_table[key] = [merged_entry[0] + entry[0], max(merged_entry[1], entry[1]),
+                                         merged_entry[2] + entry[2]]
+                else:
+                    merged_table[key] = [a + b for a, b in zip(merged_entry, entry)]
+        for table in ['dropped', 'injected', 'decompression_failures']:
+            merged_table = merged[table]
+            for key, count in snapshot.get(table, {}).items():
+                merged_table[key] = merged_table.get(key, 0) + count
+    return merged
+
+
+def _labels(key):
+    direction, state, packet_id = key
+    return f'direction="{direction}",state="{state}",packet_id="{hex(packet_id)}"'
+
+
+METRICS = Metrics()
+
+
+def _request_handler(metrics):
+    from http.server import BaseHTTPRequestHandler  # http.server is only imported if metrics are served
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # no line per scrape
+            pass
+
+    return MetricsRequestHandler
+
+
+class MetricsServer(threading.Thread):
+    # Serves /metrics on [ip]:[port] (localhost only by default)
+    def __init__(self, port, ip='127.0.0.1', metrics=METRICS):
+        super().__init__(daemon=True)
+        from http.server import ThreadingHTTPServer
+        self.server = ThreadingHTTPServer((ip, port), _request_handler(metrics))
+        self.server.daemon_threads = True
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsDumper(threading.Thread):
+    # Writes the metrics to [path] every [interval] seconds
+    def __init__(self, path, interval=10.0, metrics=METRICS):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.metrics = metrics
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.metrics.dump(self.path)
+        self.metrics.dump(self.path)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+_exporters = []
+
+'''
+    Starts the metrics endpoint / file dumps of [metrics] configured by the preferences of [game] (once per process):
+    MetricsPort : port of the local HTTP endpoint (0 = off)
+    MetricsFile : file to dump the metrics to ('' = off), every MetricsInterval seconds
+'''
+
+
+def start_metrics(game, metrics=METRICS):
+    if _exporters:
+        return _exporters
+
+    def preference(name, default):
+        try:
+            return game.get_mod(name)
+        except ValueError:
+            return default
+
+    port = preference('MetricsPort', 0)
+    if port:
+        _exporters.append(MetricsServer(port, metrics=metrics))
+        print(f"Metrics on http://127.0.0.1:{port}/metrics")
+    path = preference('MetricsFile', '')
+    if path:
+        _exporters.append(MetricsDumper(path, preference('MetricsInterval', 10.0), metrics))
+    for exporter in _exporters:
+        exporter.start()
+    return _exporters
@@ -0,0 +1,226 @@
+#######################################
+#		Created by Gilad Savoray
+#               May 2021
+#######################################
+
+# Entity movement throttling (ThrottleEntityMovement mod): instead of sending every relative move of every entity
+# (up to 20 per second each), the deltas of an entity are added up and sent as one move at most once per
+# <EntityMoveInterval> seconds. Mobs keep moving to the right places, in fewer & bigger steps.
+# A sum that doesn't fit a move (a short, 8 blocks) is sent as an Entity Teleport to the entity's position
+# (known from the entities.EntityTable of the TrackEntities mod).
+# Deltas that are still held when no more moves of their entity come are sent once their interval is over,
+# after the s2c batch being handled then, or by a timer if no packets come (see next_due).
+# One MovementThrottle per connection, used only by its s2c pipeline (no lock).
+import heapq
+
+from dataTypes import *
+
+ENTITY_POSITION = compile_types(['varint', [3, 'short'], 'boolean'])  # Entity Position (0x29)
+ENTITY_POSITION_ROTATION = compile_types(['varint', [3, 'short'], 'angle', 'angle', 'boolean'])  # 0x2A
+ENTITY_ROTATION = compile_types(['varint', 'angle', 'angle', 'boolean'])  # Entity Rotation (0x2B)
+ENTITY_TELEPORT = compile_types(['varint', [3, 'double'], 'angle', 'angle', 'boolean'])  # Entity Teleport (0x57)
+SPAWN_MOB = compile_types(['varint', 'uuid', 'varint', [3, 'double'], 'angle', 'angle'])  # Spawn Mob (0x03)
+SPAWN_PLAYER = compile_types(['varint', 'uuid', [3, 'double'], 'angle', 'angle'])  # Spawn Player (0x05)
+
+ENTITY_POSITION_ID = 0x29
+ENTITY_POSITION_ROTATION_ID = 0x2A
+ENTITY_ROTATION_ID = 0x2B
+ENTITY_TELEPORT_ID = 0x57
+SPAWN_MOB_ID = 0x03
+SPAWN_PLAYER_ID = 0x05
+
+MIN_DELTA = -32768  # a relative move is a short per axis, in 1/4096 of a block
+MAX_DELTA = 32767
+
+
+class EntityMotion:
+    __slots__ = ['delta', 'yaw', 'pitch', 'rotated', 'on_ground', 'pending', 'last_sent']
+
+    def __init__(self):
+        self.delta = (0, 0, 0)  # not sent yet
+        self.yaw = None  # last angles (AngleT), None until known
+        self.pitch = None
+        self.rotated = False  # the angles changed since the last update
+        self.on_ground = False
+        self.pending = False  # something is held, and it's in MovementThrottle._due
+        self.last_sent = float('-inf')  # time of the last update the client got
+
+
+class MovementThrottle:
+    def __init__(self, interval=0.2):
+        self.interval = interval  # seconds between the updates of an entity
+        self.motions = {}  # entity ID => EntityMotion
+        self._due = []  # heap of (time, entity ID): when the held deltas of an entity may be sent
+        self.received = 0  # moves from the server
+        self.sent = 0  # moves & teleports to the client
+
+    def __motion(self, entity_id):
+        motion = self.motions.get(entity_id)
+        if motion is None:
+            motion = self.motions[entity_id] = EntityMotion()
+        return motion
+
+    '''
+    Reads an Entity Position / Position and Rotation / Rotation packet ([packet_id], without the ID) from buff
+    [position] : (entity ID) => the entity's (x, y, z) after this move, or None if it isn't known
+    Returns the packets to send instead of the move, [(packet ID, data)] (the move itself is dropped)
+    '''
+
+    def move(self, packet_id, buff, now, position=None):
+        if packet_id == ENTITY_POSITION_ID:
+            entity_id, delta, on_ground = ENTITY_POSITION.parse(buff)
+            angles = None
+        elif packet_id == ENTITY_POSITION_ROTATION_ID:
+            entity_id, delta, yaw, pitch, on_ground = ENTITY_POSITION_ROTATION.parse(buff)
+            angles = (yaw, pitch)
+        else:
+            entity_id, yaw, pitch, on_ground = ENTITY_ROTATION.parse(buff)
+            delta, angles = (0, 0, 0), (yaw, pitch)
+        return self.add_move(entity_id.value, delta, on_ground, angles, now, position)
+
+    '''
+    Holds a relative move of [entity_id], [delta] : (dx, dy, dz), [angles] : (yaw, pitch) or None
+    Returns the packets to send now, [(packet ID, data)]
+    '''
+
+    def add_move(self, entity_id, delta, on_ground, angles, now, position=None):
+        self.received += 1
+        motion = self.__motion(entity_id)
+        updates = []
+        total = tuple(held + new for held, new in zip(motion.delta, delta))
+        if not all(MIN_DELTA <= value <= MAX_DELTA for value in total):  # too far for a relative move
+            motion.on_ground = on_ground
+            if angles is not None:
+                motion.yaw, motion.pitch = angles
+            teleport = self.__teleport(entity_id, motion, position, now)
+            if teleport is not None:
+                return [teleport] + self.due(now)
+            if motion.pending:  # the position isn't known: send what's held, then hold this move
+                updates.append(self.__update(entity_id, motion, now))
+            total = tuple(delta)
+
+        motion.delta = total
+        motion.on_ground = on_ground
+        if angles is not None:
+            motion.yaw, motion.pitch = angles
+            motion.rotated = True
+        if motion.last_sent + self.interval <= now:
+            updates.append(self.__update(entity_id, motion, now))
+        elif not motion.pending:
+            motion.pending = True
+            heapq.heappush(self._due, (motion.last_sent + self.interval, entity_id))
+        return updates + self.due(now)
+
+    '''
+    Reads an Entity Teleport (without the packet ID) from buff, it's sent as is: what was held is outdated
+    '''
+
+    def teleported(self, buff, now):
+        entity_id, position, yaw, pitch, on_ground = ENTITY_TELEPORT.parse(buff)
+        motion = self.__motion(entity_id.value)
+        motion.delta = (0, 0, 0)
+        motion.yaw, motion.pitch = yaw, pitch
+        motion.on_ground = on_ground
+        motion.rotated = False
+        motion.pending = False
+        motion.last_sent = now
+
+    '''
+    Reads a spawn packet ([packet_id], without the ID) from buff, the angles are known for mobs & players
+    '''
+
+    def spawned(self, packet_id, buff):
+        if packet_id == SPAWN_MOB_ID:
+            entity_id, uuid, type_, position, yaw, pitch = SPAWN_MOB.parse(buff)
+        elif packet_id == SPAWN_PLAYER_ID:
+            entity_id, uuid, position, yaw, pitch = SPAWN_PLAYER.parse(buff)
+        else:
+            entity_id, yaw, pitch = VARINT.parse(buff), None, None
+        motion = self.motions[entity_id.value] = EntityMotion()
+        motion.yaw, motion.pitch = yaw, pitch
+
+    '''
+    Reads a Destroy Entities packet (without the packet ID) from buff
+    '''
+
+    def destroyed(self, buff):
+        for i in range(VARINT.parse(buff).value):
+            self.motions.pop(VARINT.parse(buff).value, None)
+
+    def clear(self):
+        self.motions.clear()
+        self._due = []
+
+    '''
+    Returns the updates of everything held (the throttling is turned off), [(packet ID, data)]
+    '''
+
+    def flush(self, now):
+        updates = [self.__update(entity_id, motion, now) for entity_id, motion in list(self.motions.items())
+                   if motion.pending]
+        self._due = []
+        return updates
+
+    '''
+    Returns the updates of the entities whose held deltas waited their interval, [(packet ID, data)]
+    '''
+
+    def due(self, now):
+        updates = []
+        due = self._due
+        while due and due[0][0] <= now:
+            entity_id = heapq.heappop(due)[1]
+            motion = self.motions.get(entity_id)
+            if motion is None or not motion.pending:  # destroyed, or sent by a later move
+                continue
+            if motion.last_sent + self.interval > now:  # sent & held again since this entry was added
+                heapq.heappush(due, (motion.last_sent + self.interval, entity_id))
+                continue
+            updates.append(self.__update(entity_id, motion, now))
+        return updates
+
+    '''
+    Returns the time (like [now] of due) the next held deltas may be sent, or None if nothing is held
+    '''
+
+    def next_due(self):
+        return self._due[0][0] if self._due else None
+
+    '''
+    Returns the one packet that moves the client's copy of the entity by everything held
+    '''
+
+    def __update(self, entity_id, motion, now):
+        delta = list(motion.delta)
+        if motion.rotated and delta == [0, 0, 0]:
+            update = (ENTITY_ROTATION_ID, ENTITY_ROTATION.serialize((entity_id, motion.yaw, motion.pitch,
+                                                                       motion.on_ground)))
+        elif motion.rotated:
+            update = (ENTITY_POSITION_ROTATION_ID, ENTITY_POSITION_ROTATION.serialize(
+                (entity_id, delta, motion.yaw, motion.pitch, motion.on_ground)))
+        else:
+            update = (ENTITY_POSITION_ID, ENTITY_POSITION.serialize((entity_id, delta, motion.on_ground)))
+        motion.delta = (0, 0, 0)
+        motion.rotated = False
+        motion.pending = False
+        motion.last_sent = now
+        self.sent += 1
+        return update
+
+    '''
+    Returns an Entity Teleport to where the entity is, or None if its position or angles aren't known
+    '''
+
+    def __teleport(self, entity_id, motion, position, now):
+        if position is None or motion.yaw is None:
+            return None
+        xyz = position(entity_id)
+        if xyz is None:
+            return None
+        motion.delta = (0, 0, 0)
+        motion.rotated = False
+        motion.pending = False
+        motion.last_sent = now
+        self.sent += 1
+        return ENTITY_TELEPORT_ID, ENTITY_TELEPORT.serialize((entity_id, list(xyz), motion.yaw, motion.pitch,
+                                                              motion.on_ground))
@@ -0,0 +1,232 @@
+#######################################
+#		Created by Gilad Savoray
+#               May 2021
+#######################################
+
+# Picks the backend of a new client by the hostname it dialed (the Handshake's server address), like virtual hosts,
+# and balances the clients of a route among its backends.
+# Preferences:
+#   Routes : {hostname: [backend, ...]}, backend = "host:port" or {"address": "host:port", "weight": 2}
+#            hostname may be "*.example.com" (any subdomain) or "*" (anything else).
+#            Hostnames without a route go to serverIP:serverPort, like without routing ({} = no routing).
+#   BalanceStrategy : "least_connections" (per weight) or "weighted" (smooth weighted round-robin)
+# Health checks are passive: a backend that refused a connection is skipped for FAIL_TIMEOUT seconds
+# (unless all the backends of the route are down, then they are all tried).
+import socket
+import threading
+import time
+
+from dataTypes import *
+
+FAIL_TIMEOUT = 10.0  # seconds a failed backend is skipped
+DEFAULT_PORT = 25565
+HANDSHAKE = compile_types(['varint', 'string', 'ushort', 'varint'])
+
+
+class Backend:
+    __slots__ = ['ip', 'port', 'weight', 'active', 'total', 'fails', 'down_until', 'current_weight']
+
+    def __init__(self, ip, port, weight=1):
+        self.ip = ip
+        self.port = port
+        self.weight = weight
+        self.active = 0  # connected clients
+        self.total = 0
+        self.fails = 0  # connection failures in a row
+        self.down_until = 0.0  # time.monotonic() until which it's skipped
+        self.current_weight = 0  # smooth weighted round-robin state
+
+    @property
+    def address(self):
+        return self.ip, self.port
+
+    def __repr__(self):
+        return f'Backend[{self.ip}:{self.port}, weight={self.weight}, active={self.active}, fails={self.fails}]'
+
+
+'''
+    Parses a backend of the Routes preference, returns (ip, port, weight)
+'''
+
+
+def parse_backend(value):
+    weight = 1
+    if type(value) == dict:
+        weight = value.get('weight', 1)
+        value = value['address']
+    host, sep, port = value.rpartition(':')
+    if not sep:
+        host, port = value, DEFAULT_PORT
+    if type(weight) not in [int, float] or weight <= 0:
+        raise ValueError(f"Bad weight of backend {value}")
+    return host, int(port), weight
+
+
+'''
+    Returns the hostname the client dialed, from its first frame (Packet ID + Handshake), lower case,
+    without the trailing dot & the Forge marker ("host\0FML\0"), or None if it isn't a Handshake
+    Raises ValueError if the frame can't be parsed (the client should be dropped)
+'''
+
+
+def handshake_hostname(frame_data):
+    try:
+        buff = Buffer(frame_data)
+        if VARINT.parse(buff).value != 0x00:
+            return None
+        hostname = HANDSHAKE.parse(buff)[1]
+    except Exception as e:  # a truncated frame (Buffer raises a bare Exception), a bad VarInt
+        raise ValueError(f"Bad Handshake: {e}") from e
+    return hostname.split(b'\x00')[0].decode(errors='replace').rstrip('.').lower()
+
+
+class Router:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._backends = {}  # (ip, port) => Backend, kept across configurations (their connection counts)
+        self._routes = {}  # hostname => [Backend, ...]
+        self._default = []
+        self._strategy = 'least_connections'
+        self._config = None
+
+    '''
+    Applies the routing preferences, [default_address] (ip, port) : where unrouted hostnames go
+    '''
+
+    def configure(self, routes, strategy, default_address):
+        config = (routes, strategy, default_address)
+        with self._lock:
+            if config == self._config:
+                return
+            # everything is checked before anything changes: bad preferences leave the last configuration as is
+            if strategy not in ['least_connections', 'weighted']:
+                raise ValueError(f"Unknown balance strategy {strategy}")
+            parsed = {hostname.rstrip('.').lower(): [parse_backend(value) for value in values]
+                      for hostname, values in routes.items()}
+            self._routes = {hostname: [self.__backend(*backend) for backend in backends]
+                            for hostname, backends in parsed.items()}
+            self._default = [self.__backend(default_address[0], default_address[1])]
+            self._strategy = strategy
+            self._config = config
+
+    def __backend(self, ip, port, weight=1):
+        backend = self._backends.get((ip, port))
+        if backend is None:
+            backend = self._backends[(ip, port)] = Backend(ip, port, weight)
+        backend.weight = weight
+        return backend
+
+    '''
+    Returns the backends of the route of [hostname]: the exact name, then "*.parent" wildcards, then "*"
+    '''
+
+    def route(self, hostname):
+        routes = self._routes
+        if hostname:
+            if hostname in routes:
+                return routes[hostname]
+            parts = hostname.split('.')
+            for i in range(1, len(parts)):
+                wildcard = '*.' + '.'.join(parts[i:])
+                if wildcard in routes:
+                    return routes[wildcard]
+        return routes.get('*', self._default)
+
+    '''
+    Picks a backend of [hostname]'s route (not one of [exclude]), or None if there is none left to try
+    '''
+
+    def pick(self, hostname, exclude=()):
+        backends = [backend for backend in self.route(hostname) if backend not in exclude]
+        if not backends:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            healthy = [backend for backend in backends if backend.down_until <= now]
+            candidates = healthy or backends  # all down: try them anyway, one may be back
+            if self._strategy == 'weighted':
+                total = 0
+                for backend in candidates:
+                    backend.current_weight += backend.weight
+                    total += backend.weight
+                chosen = max(candidates, key=lambda backend: backend.current_weight)
+                chosen.current_weight -= total
+                return chosen
+            return min(candidates, key=lambda backend: (backend.active / backend.weight, backend.total))
+
+    '''
+    Returns the first healthy backend of [hostname]'s route (the first one if all are down), without picking it:
+    the balancing state isn't changed (e.g. the backend whose status answers server list pings)
+    '''
+
+    def primary(self, hostname):
+        backends = self.route(hostname)
+        now = time.monotonic()
+        return next((backend for backend in backends if backend.down_until <= now), backends[0])
+
+    # A client was connected to [backend]
+    def connected(self, backend):
+        with self._lock:
+            backend.active += 1
+            backend.total += 1
+            backend.fails = 0
+            backend.down_until = 0.0
+
+    # [backend] refused / timed out a connection
+    def failed(self, backend):
+        with self._lock:
+            backend.fails += 1
+            backend.down_until = time.monotonic() + FAIL_TIMEOUT
+        print(f"Backend {backend.ip}:{backend.port} is down ({backend.fails} failures)")
+
+    # A client of [backend] disconnected
+    def released(self, backend):
+        with self._lock:
+            backend.active = max(0, backend.active - 1)
+
+    def backends(self):
+        with self._lock:
+            return list(self._backends.values())
+
+    '''
+    Connects a client of [hostname] to a backend of its route (blocking), [connect] : (ip, port) => socket
+    Returns (Backend, socket), raises OSError if no backend of the route could be reached
+    '''
+
+    def connect(self, hostname, connect=None):
+        if connect is None:
+            connect = socket.create_connection
+        tried = []
+        error = OSError(f"No backend for {hostname}")
+        while True:
+            backend = self.pick(hostname, tried)
+            if backend is None:
+                raise error
+            try:
+                sock = connect(backend.address)
+            except OSError as e:
+                self.failed(backend)
+                tried.append(backend)
+                error = e
+                continue
+            self.connected(backend)
+            return backend, sock
+
+
+ROUTER = Router()
+
+'''
+    Returns the Router, configured by the preferences of [settings] (unrouted hostnames go to server_ip:server_port)
+'''
+
+
+def get_router(settings, server_ip, server_port):
+    def preference(name, default):
+        try:
+            return settings.get_mod(name)
+        except ValueError:
+            return default
+
+    ROUTER.configure(preference('Routes', {}), preference('BalanceStrategy', 'least_connections'),
+                     (server_ip, server_port))
+    return ROUTER
@@ -0,0 +1,136 @@
+#######################################
+#		Created by Gilad Savoray
+#               May 2021
+#######################################
+
+# Socket options & write coalescing, per leg of the proxy ('client': proxy <-> game, 'server': proxy <-> backend).
+# Preferences SocketOptionsClient / SocketOptionsServer : a dict that overrides any of LEG_DEFAULTS:
+#   NoDelay        : TCP_NODELAY, no Nagle delay (the proxy coalesces writes itself, see FlushPolicy)
+#   QuickAck       : TCP_QUICKACK (Linux), ACK every read at once instead of delaying it (set again after each read)
+#   KeepAlive      : SO_KEEPALIVE, with KeepIdle / KeepInterval seconds & KeepCount probes where the OS has them
+#   SendBuffer / ReceiveBuffer : SO_SNDBUF / SO_RCVBUF bytes (0 = the OS default, which auto-tunes)
+#   CoalesceMicros : microseconds a small write may wait for more packets (0 = write at once)
+#   CoalesceBytes  : a write this big is sent at once (about one TCP segment)
+# An option the OS doesn't have is skipped.
+import socket
+import time
+
+LEG_DEFAULTS = {'NoDelay': True, 'QuickAck': False, 'KeepAlive': True, 'KeepIdle': 60, 'KeepInterval': 10,
+                'KeepCount': 5, 'SendBuffer': 0, 'ReceiveBuffer': 0, 'CoalesceMicros': 200, 'CoalesceBytes': 1400}
+LEG_PREFERENCES = {'client': 'SocketOptionsClient', 'server': 'SocketOptionsServer'}
+
+# Latency sensitive packets (play state) are never held back: keep alive & movement
+URGENT_PACKETS = {'c2s': frozenset([0x0F,  # Keep Alive
+                                    0x11, 0x12, 0x13,  # Player Position / Position and Rotation / Rotation
+                                    0x14,  # Player Movement
+                                    0x15]),  # Vehicle Move
+                  's2c': frozenset([0x21,  # Keep Alive
+                                    0x29, 0x2A, 0x2B,  # Entity Position / Position and Rotation / Rotation
+                                    0x2C,  # Vehicle Move
+                                    0x36,  # Player Position And Look
+                                    0x3C,  # Entity Head Look
+                                    0x57])}  # Entity Teleport
+
+'''
+    Returns the options of [leg] ('client' / 'server'): LEG_DEFAULTS overridden by the preferences of [settings]
+'''
+
+
+def leg_options(settings, leg):
+    try:
+        overrides = settings.get_mod(LEG_PREFERENCES[leg])
+    except ValueError:
+        overrides = None
+    return {**LEG_DEFAULTS, **(overrides or {})}
+
+
+def _set_option(sock, level, name, value):
+    option = getattr(socket, name, None)
+    if option is None:  # the OS doesn't have it
+        return False
+    try:
+        sock.setsockopt(level, option, value)
+    except OSError:
+        return False
+    return True
+
+
+'''
+    Applies [options] (see leg_options) to the TCP socket [sock]
+'''
+
+
+def tune_socket(sock, options):
+    _set_option(sock, socket.IPPROTO_TCP, 'TCP_NODELAY', int(bool(options['NoDelay'])))
+    if options['KeepAlive']:
+        _set_option(sock, socket.SOL_SOCKET, 'SO_KEEPALIVE', 1)
+        _set_option(sock, socket.IPPROTO_TCP, 'TCP_KEEPIDLE', int(options['KeepIdle']))
+        _set_option(sock, socket.IPPROTO_TCP, 'TCP_KEEPINTVL', int(options['KeepInterval']))
+        _set_option(sock, socket.IPPROTO_TCP, 'TCP_KEEPCNT', int(options['KeepCount']))
+    else:
+        _set_option(sock, socket.SOL_SOCKET, 'SO_KEEPALIVE', 0)
+    if options['SendBuffer']:
+        _set_option(sock, socket.SOL_SOCKET, 'SO_SNDBUF', int(options['SendBuffer']))
+    if options['ReceiveBuffer']:
+        _set_option(sock, socket.SOL_SOCKET, 'SO_RCVBUF', int(options['ReceiveBuffer']))
+    quick_ack(sock, options)
+
+
+# Linux turns TCP_QUICKACK off by itself, so it's set again after every read
+def quick_ack(sock, options):
+    if options['QuickAck']:
+        _set_option(sock, socket.IPPROTO_TCP, 'TCP_QUICKACK', 1)
+
+
+'''
+    Is [packet] (an MCPacket of [side]) one that shouldn't wait for coalescing?
+'''
+
+
+def is_urgent(packet, side):
+    if packet.game.state != 3:  # handshake, status & login packets are few and each is awaited by the other side
+        return True
+    p_id = getattr(packet, 'p_ID', None)
+    return p_id is None or p_id.value in URGENT_PACKETS[side]
+
+
+class FlushPolicy:
+    # Decides whether a small write is held back for up to [budget] seconds, to be sent with the packets after it
+    # (fewer syscalls & TCP segments). It adapts: while holding rarely gains another packet (quiet connection),
+    # writes go out at once, and holding is tried again every PROBE_EVERY writes.
+    ALPHA = 0.1  # weight of the last hold in the success rate
+    MIN_SUCCESS = 0.2  # below this success rate holding is paused
+    PROBE_EVERY = 32
+
+    def __init__(self, budget=0.0, min_bytes=1400):
+        self.budget = budget
+        self.min_bytes = min_bytes
+        self.success = 1.0  # moving average of holds that gained more packets
+        self._skipped = 0
+        self.holds = 0
+
+    @classmethod
+    def for_leg(cls, options):
+        return cls(options['CoalesceMicros'] / 1000000, options['CoalesceBytes'])
+
+    '''
+    Should a write of [size] bytes wait for more? ([urgent] : it has a latency sensitive packet)
+    '''
+
+    def hold(self, size, urgent):
+        if self.budget <= 0 or urgent or size >= self.min_bytes:
+            return False
+        if self.success < self.MIN_SUCCESS:
+            self._skipped += 1
+            if self._skipped < self.PROBE_EVERY:
+                return False
+            self._skipped = 0
+        self.holds += 1
+        return True
+
+    # A hold ended, [gained] : more packets were added to the write
+    def held(self, gained):
+        self.success += self.ALPHA * ((1.0 if gained else 0.0) - self.success)
+
+    def deadline(self):
+        return time.monotonic() + self.budget
@@ -0,0 +1,151 @@
+#######################################
+#		Created by Gilad Savoray
+#               May 2021
+#######################################
+
+# Server list pings answered by the proxy itself: Handshake (next state 1) -> Status Request -> Ping.
+# The backend's Status Response is fetched at most once per <StatusCacheTTL> seconds (0 = off, every ping goes to
+# the backend like before). A stale response is still served while a background thread fetches a new one,
+# and the CustomMOTD rewrite is applied once per fetch, not once per ping.
+import socket
+import threading
+import time
+
+from dataTypes import *
+
+FETCH_TIMEOUT = 3.0  # seconds
+PROTOCOL_VERSION = 578
+HANDSHAKE = compile_types(['varint', 'string', 'ushort', 'varint'])
+JSON = compile_types('json')
+STATUS_REQUEST = b'\x00'  # Packet ID 0x00, no fields
+PING_ID = 0x01
+
+
+class StatusCache:
+    # The Status Response of one backend, [settings] : the Game holding the preferences (CustomMOTD)
+    def __init__(self, settings, server_ip, server_port, ttl=5.0):
+        self.settings = settings
+        self.server_ip = server_ip
+        self.server_port = server_port
+        self.ttl = ttl
+        self._lock = threading.Lock()  # one fetch at a time
+        self._response = None  # the Status Response frame (length VarInt + data), ready to send
+        self._fetched = 0.0  # time.monotonic() of the last successful fetch
+        self._refreshing = False
+
+    '''
+    Returns the Status Response data (Packet ID + JSON) from the backend, raises OSError if it can't
+    '''
+
+    def fetch(self):
+        from mc_proxy import FrameReader
+        with socket.create_connection((self.server_ip, self.server_port), timeout=FETCH_TIMEOUT) as sock:
+            handshake = varint_bytes(0x00) + HANDSHAKE.serialize((PROTOCOL_VERSION, self.server_ip,
+                                                                  self.server_port, 1))
+            sock.sendall(varint_bytes(len(handshake)) + handshake + varint_bytes(1) + STATUS_REQUEST)
+            frames = FrameReader()
+            frame = frames.next_frame()
+            while frame is None:
+                if not frames.recv_from(sock):
+                    raise OSError("The server closed the connection")
+                frame = frames.next_frame()
+        return frame[1]
+
+    '''
+    Fetches a new response (applies CustomMOTD to it), keeps the old one if the backend can't be reached
+    '''
+
+    def refresh(self):
+        from mc_proxy import mod_enabled, custom_motd
+        try:
+            data = self.fetch()
+            buff = Buffer(data)
+            if VARINT.parse(buff).value != 0x00:
+                raise OSError("Not a Status Response")
+            status = JSON.parse(buff)  # a garbled response isn't cached
+            if mod_enabled(self.settings, 'CustomMOTD'):
+                data = varint_bytes(0x00) + JSON.serialize(custom_motd(status))
+        except Exception as e:  # unreachable, or a garbled response (Buffer raises a bare Exception)
+            print(f"Status cache: can't fetch the status of {self.server_ip}:{self.server_port} ({e})")
+            return
+        finally:
+            self._refreshing = False
+        self._response = varint_bytes(len(data)) + data
+        self._fetched = time.monotonic()
+
+    def _background_refresh(self):
+        with self._lock:
+            self.refresh()
+
+    # Is there a response to serve without fetching first?
+    def ready(self):
+        return self._response is not None
+
+    '''
+    Returns the Status Response frame, or None if there is none (the backend is offline)
+    A missing response is fetched now (blocking), an expired one is served while it is fetched in the background
+    '''
+
+    def response(self):
+        if self._response is None:
+            with self._lock:
+                if self._response is None:
+                    self.refresh()
+            return self._response
+        if time.monotonic() - self._fetched > self.ttl and not self._refreshing:
+            self._refreshing = True
+            threading.Thread(target=self._background_refresh, daemon=True).start()
+        return self._response
+
+
+_caches = {}  # (server ip, server port) => StatusCache
+_caches_lock = threading.Lock()
+
+'''
+    Returns the StatusCache of the backend at (server_ip, server_port),
+    or None if the preference StatusCacheTTL of [settings] is 0 (answer pings through the backend)
+'''
+
+
+def get_status_cache(settings, server_ip, server_port):
+    try:
+        ttl = settings.get_mod('StatusCacheTTL')
+    except ValueError:
+        return None
+    if not ttl or ttl <= 0:
+        return None
+    with _caches_lock:
+        cache = _caches.get((server_ip, server_port))
+        if cache is None:
+            cache = _caches[(server_ip, server_port)] = StatusCache(settings, server_ip, server_port, ttl)
+        cache.ttl = ttl
+        cache.settings = settings
+        return cache
+
+
+'''
+    Is [frame_data] (the first frame of a client, Packet ID + Data) a Handshake to the STATUS state?
+'''
+
+
+def is_status_handshake(frame_data):
+    try:
+        buff = Buffer(frame_data)
+        if VARINT.parse(buff).value != 0x00:
+            return False
+        return HANDSHAKE.parse(buff)[3].value == 1
+    except Exception:  # a malformed Handshake isn't answered from the cache
+        return False
+
+
+'''
+    The answer to a client frame in the STATUS state, as (bytes to send or None, is the ping over?)
+'''
+
+
+def status_reply(cache, frame_data):
+    if frame_data == STATUS_REQUEST:
+        return cache.response(), False
+    if frame_data[:1] == bytes([PING_ID]):  # Pong: the same payload
+        return varint_bytes(len(frame_data)) + frame_data, True
+    return None, True
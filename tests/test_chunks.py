@@ -0,0 +1,74 @@
+import random
+import struct
+
+import numpy as np
+
+from chunks import *
+
+
+def varint(value):
+    return bytes(VarInt(value=value).to_bytes())
+
+
+# Packs the 4096 entries of [indices] with [bits] bits each, the 1.15.2 way (an entry may span two longs)
+def pack_longs(indices, bits):
+    packed = 0
+    for n, index in enumerate(indices):
+        packed |= index << (n * bits)
+    count = (SECTION_VOLUME * bits + 63) // 64
+    return [(packed >> (64 * k)) & ((1 << 64) - 1) for k in range(count)]
+
+
+def section_bytes(bits, longs, palette=None):
+    data = struct.pack('>hB', SECTION_VOLUME, bits)
+    if palette is not None:
+        data += varint(len(palette)) + b''.join(varint(block_id) for block_id in palette)
+    return data + varint(len(longs)) + b''.join(struct.pack('>Q', value) for value in longs)
+
+
+def test_unpack_bits_known_section():
+    # 4 bits per entry, the palette indices 0 1 2 3 0 1 2 3 ... (16 entries per long, the first one in the LSBs)
+    longs = np.array([0x3210321032103210] * 256, dtype=np.uint64).view(np.int64)
+    assert unpack_bits(longs, 4).tolist() == [0, 1, 2, 3] * 1024
+
+    section = read_section(Buffer(section_bytes(4, [0x3210321032103210] * 256, [0, 1, 9, 33])))
+    assert section.shape == (16, 16, 16)
+    assert section[0, 0, :4].tolist() == [0, 1, 9, 33]  # [y, z, x]
+    assert section[15, 15, 15] == 33
+
+
+def test_read_section_spanning_entries():
+    random.seed(1)
+    # 5 & 14 bits don't divide 64: entries continue in the next long
+    palette = list(range(100, 120))
+    indices = [random.randrange(len(palette)) for i in range(SECTION_VOLUME)]
+    section = read_section(Buffer(section_bytes(5, pack_longs(indices, 5), palette)))
+    assert section.reshape(-1).tolist() == [palette[index] for index in indices]
+
+    block_ids = [random.randrange(1 << GLOBAL_BITS) for i in range(SECTION_VOLUME)]
+    section = read_section(Buffer(section_bytes(GLOBAL_BITS, pack_longs(block_ids, GLOBAL_BITS))))
+    assert section.reshape(-1).tolist() == block_ids
+
+
+def test_small_palette_uses_four_bits():
+    # a palette of 2 says 1 bit per block, but 1.15.2 always sends at least 4
+    indices = [n % 2 for n in range(SECTION_VOLUME)]
+    section = read_section(Buffer(section_bytes(1, pack_longs(indices, 4), [7, 8])))
+    assert section.reshape(-1).tolist() == [7, 8] * 2048
+
+
+def test_world_block_at():
+    indices = [n % 4 for n in range(SECTION_VOLUME)]
+    sections = section_bytes(4, pack_longs(indices, 4), [0, 1, 9, 33])
+    heightmaps = b'\x0a\x00\x00' + b'\x0c\x00\x0fMOTION_BLOCKING' + struct.pack('>i', 36) + b'\x00' * 288 + b'\x00'
+    chunk_data = (struct.pack('>iiB', 3, -2, 1) + varint(1 << 2) + heightmaps + b'\x00' * 4096
+                  + varint(len(sections)) + sections + varint(0))
+    world = World()
+    world.load_chunk(Buffer(chunk_data))
+
+    assert world.block_at(3 * 16 + 1, 2 * 16, -2 * 16) == 1  # section 2, entry 1
+    assert world.block_at(3 * 16 + 3, 2 * 16 + 15, -2 * 16 + 15) == 33
+    assert world.block_at(3 * 16, 0, -2 * 16) == 0  # empty section
+    assert world.block_at(0, 0, 0) is None  # not loaded
+    world.set_block(3 * 16 + 1, 2 * 16, -2 * 16, 77)
+    assert world.block_at(3 * 16 + 1, 2 * 16, -2 * 16) == 77
@@ -0,0 +1,134 @@
+import struct
+
+import pytest
+
+from dataTypes import *
+
+
+def varint(value):
+    return bytes(VarInt(value=value).to_bytes())
+
+
+def string(value):
+    return varint(len(value)) + value
+
+
+def position(x, y, z):
+    return struct.pack('>Q', ((x & 0x3FFFFFF) << 38) | ((z & 0x3FFFFFF) << 12) | (y & 0xFFF))
+
+
+# (type descriptor, wire bytes built by hand) of packets the proxy parses
+SCHEMAS = [
+    ('varint', varint(300)),
+    ('varint', varint(-1)),
+    (['varint', 'string', 'ushort', 'varint'],
+     varint(578) + string(b'localhost') + struct.pack('>H', 25565) + varint(2)),
+    (['int', 'ubyte', 'int', 'long', 'ubyte', 'string', 'varint', 'boolean', 'boolean'],
+     struct.pack('>iBiqB', 7, 1, -1, -123456789, 10) + string(b'default') + varint(8) + b'\x00\x01'),
+    (['varint', 'position', 'varint', [3, 'float'], 'boolean'],
+     varint(0) + position(-12, 33, 70) + varint(1) + struct.pack('>fff', 0.5, 0.25, 1.0) + b'\x00'),
+    (['varint', 'uuid', 'varint', [3, 'double'], 'angle', 'angle'],
+     varint(9) + struct.pack('>dd', 1.0, 2.0) + varint(30) + struct.pack('>ddd', 1, 2, 3) + bytes([10, 200])),
+    (['varint', [3, 'short'], 'angle', 'angle', 'boolean'],
+     varint(9) + struct.pack('>hhh', -100, 0, 4000) + b'\x01\x02\x01'),
+    (['long', 'short', 'ushort', 'double', 'byte'], struct.pack('>qhHdb', -5, -2, 65535, 2.5, -1)),
+    (['chat', 'chat'], string(b'{"a": 1}') + string(b'{"translate": ""}')),
+    ([-1, 'varint'], varint(3) + varint(1) + varint(2) + varint(300)),
+    ('opt|varint', b'\x01' + varint(5)),
+    ('opt|varint', b'\x00'),
+    (['varint', 'entity_metadata'],
+     varint(55) + b'\x00' + varint(0) + b'\x21' + b'\x02' + varint(5) + b'\x00' + b'\xff'),
+]
+
+
+@pytest.mark.parametrize('schema, data', SCHEMAS)
+def test_compiled_codec_round_trip(schema, data):
+    buff = Buffer(data)
+    value = compile_types(schema).parse(buff)
+    assert buff.length() == 0  # read exactly the packet
+    assert bytes(compile_types(schema).serialize(value)) == data
+    # parse_types / serialize_types are the same codecs
+    assert bytes(serialize_types(schema, parse_types(schema, Buffer(data)))) == data
+
+
+def test_compiled_codec_values():
+    data = SCHEMAS[2][1]
+    protocol, hostname, port, next_state = compile_types(['varint', 'string', 'ushort', 'varint']).parse(Buffer(data))
+    assert (protocol.value, hostname, port, next_state.value) == (578, b'localhost', 25565, 2)
+
+    entity_id, location, kind, xyz, on_ground = compile_types(SCHEMAS[4][0]).parse(Buffer(SCHEMAS[4][1]))
+    assert (location.x, location.y, location.z) == (-12, 33, 70)
+    assert list(xyz) == [0.5, 0.25, 1.0]
+    assert compile_types('opt|varint').parse(Buffer(b'\x00')) is None
+
+
+def test_compile_types_is_cached():
+    assert compile_types(['varint', [3, 'short']]) is compile_types(['varint', [3, 'short']])
+    schema = ['varint', 'string']
+    parse_types(schema, Buffer(varint(1) + string(b'a')))
+    assert schema == ['varint', 'string']  # the descriptor isn't changed by compiling it
+
+
+def test_nested_array():
+    # Entity Properties: an array of (key, value, array of modifiers)
+    properties = (varint(5) + struct.pack('>i', 2) + string(b'generic.movementSpeed') + struct.pack('>d', 0.1)
+                  + varint(1) + struct.pack('>ddd', 1.5, 2.5, 0.3) + b'\x01'
+                  + string(b'generic.maxHealth') + struct.pack('>d', 20) + varint(0))
+    buff = Buffer(properties)
+    entity_id, count = parse_types(['varint', 'int'], buff)
+    records = parse_types([count, ['string', 'double', [-1, 'uuid', 'double', 'byte']]], buff)
+    assert buff.length() == 0
+    assert [record[0] for record in records] == [b'generic.movementSpeed', b'generic.maxHealth']
+    schema = ['varint', 'int', [count, ['string', 'double', [-1, 'uuid', 'double', 'byte']]]]
+    assert bytes(serialize_types(schema, (entity_id, count, records))) == properties
+
+
+def test_fixed_width_records():
+    schema = [-1, ['short', 'position']]
+    data = varint(2) + struct.pack('>h', -3) + position(1, 2, 3) + struct.pack('>h', 4) + position(-5, 6, -7)
+    records = compile_types(schema).parse(Buffer(data))
+    assert [(short, xyz.x, xyz.y, xyz.z) for short, xyz in records] == [(-3, 1, 2, 3), (4, -5, 6, -7)]
+    assert bytes(compile_types(schema).serialize(records)) == data
+    # the count comes from the wire: checked against the data left before anything is read
+    with pytest.raises(Exception, match='No bytes left'):
+        compile_types([-1, 'short']).parse(Buffer(varint(2 ** 31 - 1) + b'\x00\x01'))
+
+
+def test_codec_is_abstract():
+    with pytest.raises(TypeError):
+        Codec()
+
+
+# long arrays are decoded with NumPy (read_array), the result must match the values of the scalar codecs
+@pytest.mark.parametrize('type_str', ['varint', 'short', 'int', 'long', 'double', 'ubyte', 'position'])
+def test_array_round_trip(type_str):
+    values = {'varint': [0, 1, 127, 128, 300, -1, 2 ** 31 - 1, -2 ** 31],
+              'short': [-2 ** 15, -1, 0, 2 ** 15 - 1],
+              'int': [-2 ** 31, -1, 0, 2 ** 31 - 1],
+              'long': [-2 ** 63, -1, 0, 2 ** 63 - 1],
+              'double': [-1.5, 0.0, 0.1, 1e300],
+              'ubyte': [0, 1, 255],
+              'position': [(-2 ** 25, -2048, 2 ** 25 - 1), (0, 0, 0), (-12, 33, 70)]}[type_str]
+    scalar = compile_types(type_str)
+    data = b''.join(position(*value) if type_str == 'position' else bytes(scalar.serialize(value)) for value in values)
+
+    buff = Buffer(data + b'tail')
+    array = read_array(buff, type_str, len(values))
+    assert buff.length() == 4
+    parsed = array_to_list(type_str, array)
+    if type_str == 'varint':
+        parsed = [value.value for value in parsed]
+    elif type_str == 'position':
+        parsed = [(value.x, value.y, value.z) for value in parsed]
+    assert parsed == values
+    assert bytes(write_array(type_str, array)) == data
+    # a prefixed array of the same type goes through read_array too
+    assert bytes(serialize_types([-1, type_str], parse_types([-1, type_str], Buffer(varint(len(values)) + data)))) \
+        == varint(len(values)) + data
+
+
+def test_primitives_are_plain_python_numbers():
+    entity_id, delta, on_ground = compile_types(['varint', [3, 'short'], 'boolean']).parse(
+        Buffer(varint(9) + struct.pack('>hhh', -1, 2, -3) + b'\x01'))
+    assert type(entity_id) is VarInt and type(entity_id.value) is int
+    assert [type(value) for value in delta] == [int, int, int] and on_ground == 1
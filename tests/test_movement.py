@@ -0,0 +1,134 @@
+import time
+
+from movement import *
+
+
+def spawn(throttle, entity_id, yaw=3, pitch=4):
+    throttle.spawned(SPAWN_MOB_ID, Buffer(SPAWN_MOB.serialize(
+        (entity_id, (1.0, 2.0), 5, [0.0, 64.0, 0.0], AngleT(angle=yaw), AngleT(angle=pitch)))))
+
+
+def position_move(entity_id, delta):
+    return ENTITY_POSITION_ID, Buffer(ENTITY_POSITION.serialize((entity_id, list(delta), True)))
+
+
+def parse(update):
+    packet_id, data = update
+    if packet_id == ENTITY_POSITION_ID:
+        entity_id, delta, on_ground = ENTITY_POSITION.parse(Buffer(data))
+        return packet_id, entity_id.value, tuple(delta)
+    if packet_id == ENTITY_TELEPORT_ID:
+        entity_id, xyz, yaw, pitch, on_ground = ENTITY_TELEPORT.parse(Buffer(data))
+        return packet_id, entity_id.value, tuple(xyz)
+    if packet_id == ENTITY_POSITION_ROTATION_ID:
+        entity_id, delta, yaw, pitch, on_ground = ENTITY_POSITION_ROTATION.parse(Buffer(data))
+        return packet_id, entity_id.value, tuple(delta)
+    entity_id, yaw, pitch, on_ground = ENTITY_ROTATION.parse(Buffer(data))
+    return packet_id, entity_id.value, None
+
+
+def test_deltas_are_summed():
+    throttle = MovementThrottle(0.2)
+    spawn(throttle, 7)
+    assert [parse(update) for update in throttle.move(*position_move(7, (10, 0, -5)), 0.0)] == \
+        [(ENTITY_POSITION_ID, 7, (10, 0, -5))]  # the first move goes at once
+    assert throttle.move(*position_move(7, (100, 1, 5)), 0.05) == []  # held
+    assert throttle.move(*position_move(7, (-30, 2, 5)), 0.10) == []
+    assert throttle.due(0.19) == []
+    assert [parse(update) for update in throttle.due(0.2)] == [(ENTITY_POSITION_ID, 7, (70, 3, 10))]
+    assert throttle.due(10.0) == []  # nothing is sent twice
+    assert (throttle.received, throttle.sent) == (3, 2)
+
+
+def test_rotation_is_kept():
+    throttle = MovementThrottle(0.2)
+    spawn(throttle, 7)
+    throttle.move(*position_move(7, (1, 0, 0)), 0.0)
+    rotation = ENTITY_ROTATION.serialize((7, AngleT(angle=9), AngleT(angle=10), True))
+    assert throttle.move(ENTITY_ROTATION_ID, Buffer(rotation), 0.05) == []
+    throttle.move(*position_move(7, (2, 0, 0)), 0.1)
+    assert [parse(update) for update in throttle.due(0.2)] == [(ENTITY_POSITION_ROTATION_ID, 7, (2, 0, 0))]
+
+
+def test_overflow_sends_a_teleport():
+    throttle = MovementThrottle(0.2)
+    spawn(throttle, 7)
+    throttle.move(*position_move(7, (0, 0, 0)), 0.0)
+    assert throttle.move(*position_move(7, (30000, 0, 0)), 0.05) == []
+    # 30000 + 30000 doesn't fit a short: the client gets the entity's (tracked) position instead
+    updates = throttle.move(*position_move(7, (30000, 0, 0)), 0.1, lambda entity_id: (14.6484375, 64.0, 0.0))
+    assert [parse(update) for update in updates] == [(ENTITY_TELEPORT_ID, 7, (14.6484375, 64.0, 0.0))]
+    assert throttle.due(1.0) == []  # the teleport covers what was held
+
+
+def test_overflow_without_a_position():
+    throttle = MovementThrottle(0.2)
+    spawn(throttle, 7)
+    throttle.move(*position_move(7, (0, 0, 0)), 0.0)
+    throttle.move(*position_move(7, (30000, 0, 0)), 0.05)
+    # the position isn't known: what's held goes now, and the new move is held
+    updates = throttle.move(*position_move(7, (30000, 0, 0)), 0.1)
+    assert [parse(update) for update in updates] == [(ENTITY_POSITION_ID, 7, (30000, 0, 0))]
+    assert [parse(update) for update in throttle.due(0.4)] == [(ENTITY_POSITION_ID, 7, (30000, 0, 0))]
+
+
+def test_teleport_and_destroy_drop_what_is_held():
+    throttle = MovementThrottle(0.2)
+    spawn(throttle, 7)
+    spawn(throttle, 8)
+    for entity_id in [7, 8]:
+        throttle.move(*position_move(entity_id, (1, 0, 0)), 0.0)
+        throttle.move(*position_move(entity_id, (1, 0, 0)), 0.05)
+    throttle.teleported(Buffer(ENTITY_TELEPORT.serialize((7, [1.0, 2.0, 3.0], AngleT(angle=0), AngleT(angle=0),
+                                                          True))), 0.1)
+    throttle.destroyed(Buffer(VARINT.serialize(1) + VARINT.serialize(8)))
+    assert throttle.due(1.0) == []
+
+
+def test_flush():
+    throttle = MovementThrottle(0.2)
+    for entity_id in [7, 8]:
+        spawn(throttle, entity_id)
+        throttle.move(*position_move(entity_id, (1, 0, 0)), 0.0)
+        throttle.move(*position_move(entity_id, (2, 0, 0)), 0.05)
+    assert sorted(parse(update) for update in throttle.flush(0.1)) == \
+        [(ENTITY_POSITION_ID, 7, (2, 0, 0)), (ENTITY_POSITION_ID, 8, (2, 0, 0))]
+    assert throttle.flush(0.2) == [] and throttle.due(1.0) == []
+
+
+def test_turning_off_flushes_on_the_s2c_pipeline():
+    from mc_proxy import Game, PreferenceUpdateMessage, held_movement_packets
+    game = Game()
+    game.set_mods({'ThrottleEntityMovement': True, 'EntityMoveInterval': 0.2})
+    throttle = game.movement_throttle
+    throttle.add_move(7, (1, 0, 0), True, None, 0.0)
+    throttle.add_move(7, (2, 0, 0), True, None, 0.05)
+
+    game.set_mod('ThrottleEntityMovement', False)
+    message = PreferenceUpdateMessage('ThrottleEntityMovement')
+    message.handle(game)  # maybe on the c2s pipeline: it doesn't touch the throttle
+    assert message.payload == [] and throttle.motions[7].pending
+    packets = held_movement_packets(game)  # the s2c pipeline sends them
+    assert [(packet.p_ID.value, packet.side) for packet in packets] == [(ENTITY_POSITION_ID, 's2c')]
+    assert held_movement_packets(game) == []
+
+
+def test_due_moves_are_sent_without_packets():
+    from mc_proxy import Game, MCPacketQueue, Process, held_movement_due
+    game = Game()
+    game.set_mods({'ThrottleEntityMovement': True, 'EntityMoveInterval': 0.2})
+    now = time.monotonic()
+    game.movement_throttle.add_move(7, (1, 0, 0), True, None, now)
+    game.movement_throttle.add_move(7, (2, 0, 0), True, None, now + 0.05)  # held until now + 0.2
+    assert held_movement_due(game) == now + 0.2
+
+    in_queue, out_queue = MCPacketQueue(), MCPacketQueue()
+    process = Process(in_queue, out_queue, 's2c', game)
+    process.start()
+    try:
+        packets = out_queue.drain(timeout=2.0)  # the server sends nothing: the s2c pipeline wakes up by itself
+    finally:
+        in_queue.close()
+        process.join()
+    assert [(packet.p_ID.value, packet.side) for packet in packets] == [(ENTITY_POSITION_ID, 's2c')]
+    assert time.monotonic() - now >= 0.2 and held_movement_due(game) is None
@@ -0,0 +1,85 @@
+import pytest
+
+from routing import *
+
+
+def make_router(routes, strategy='least_connections'):
+    router = Router()
+    router.configure(routes, strategy, ('default', 25565))
+    return router
+
+
+def test_route_by_hostname():
+    router = make_router({'play.example.com': ['a:1'], '*.example.com': ['b:2'], 'other.net.': ['c']})
+    assert router.pick('play.example.com').address == ('a', 1)
+    assert router.pick('pvp.eu.example.com').address == ('b', 2)
+    assert router.pick('other.net').address == ('c', DEFAULT_PORT)
+    assert router.pick('unknown.org').address == ('default', 25565)
+    assert router.pick(None).address == ('default', 25565)
+    assert make_router({'*': ['d:4']}).pick('unknown.org').address == ('d', 4)
+
+
+def test_handshake_hostname():
+    frame = VARINT.serialize(0x00) + HANDSHAKE.serialize((578, b'Play.Example.com.\x00FML\x00', 25565, 2))
+    assert handshake_hostname(frame) == 'play.example.com'
+    assert handshake_hostname(VARINT.serialize(0x01) + b'\x00') is None
+    for truncated in [b'\x00', b'\x80', frame[:-3]]:
+        with pytest.raises(ValueError):
+            handshake_hostname(truncated)
+
+
+def test_least_connections():
+    router = make_router({'*': ['a:1', {'address': 'b:2', 'weight': 2}]})
+    picked = []
+    for i in range(6):
+        backend = router.pick('x')
+        router.connected(backend)
+        picked.append(backend.ip)
+    assert picked.count('a') == 2 and picked.count('b') == 4  # per weight
+    a = [backend for backend in router.backends() if backend.ip == 'a'][0]
+    router.released(a)
+    router.released(a)
+    assert router.pick('x') is a
+
+
+def test_weighted_round_robin():
+    router = make_router({'*': [{'address': 'a:1', 'weight': 5}, 'b:2', 'c:3']}, 'weighted')
+    picked = []
+    for i in range(7):
+        assert router.primary('x').ip == 'a'  # doesn't move the round-robin
+        picked.append(router.pick('x').ip)
+    assert picked == ['a', 'a', 'b', 'a', 'c', 'a', 'a']  # smooth: b & c aren't starved by a's bursts
+
+
+def test_failover():
+    router = make_router({'*': ['a:1', 'b:2']})
+    calls = []
+
+    def connect(address):
+        calls.append(address)
+        if address[0] == 'a':
+            raise ConnectionRefusedError
+        return 'socket'
+
+    backend, sock = router.connect('x', connect)
+    assert (backend.ip, sock) == ('b', 'socket')
+    assert calls == [('a', 1), ('b', 2)]
+    assert router.pick('x').ip == 'b'  # a is skipped for FAIL_TIMEOUT
+    assert router.primary('x').ip == 'b'
+
+    def refuse(address):
+        raise ConnectionRefusedError
+
+    with pytest.raises(OSError):
+        router.connect('x', refuse)
+    assert router.pick('x') is not None  # all down: they are all tried again
+
+
+def test_bad_configuration_keeps_the_last_one():
+    router = make_router({'*': ['a:1']}, 'weighted')
+    for routes, strategy in [({'*': ['b:2']}, 'random'), ({'*': ['b:x']}, 'weighted'),
+                             ({'*': [{'address': 'b:2', 'weight': 0}]}, 'weighted')]:
+        with pytest.raises(ValueError):
+            router.configure(routes, strategy, ('default', 25565))
+        assert router.pick('x').address == ('a', 1)
+        assert router._strategy == 'weighted'
@@ -0,0 +1,236 @@
+#######################################
+#		Created by Gilad Savoray
+#               May 2021
+#######################################
+
+# Multi-process mode: one process runs the proxy under one GIL, so decompression, parsing & recompression of all the
+# clients compete for one core. The Supervisor starts <workers> processes, each running its own AsyncProxy on the
+# same port (SO_REUSEPORT, the kernel spreads the new connections among them), restarts a worker that exited,
+# and serves the metrics of all of them (MetricsPort / MetricsFile) from one place.
+#   python headless.py --workers 4
+# Every worker has its own status cache, backend pools & router (least_connections counts its own clients only),
+# and its own capture file: <CaptureFile>.<worker index>-<pid> (each process numbers its connections from 1,
+# a restarted worker too).
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import threading
+import time
+
+from metrics import Metrics, merge_snapshots, start_metrics
+
+REPORT_INTERVAL = 1.0  # seconds between the metrics reports of a worker
+CHECK_INTERVAL = 0.5  # seconds between the supervisor's checks of its workers
+RESTART_DELAY = 1.0  # seconds before a worker that exited is started again, doubled while it keeps crashing
+MAX_RESTART_DELAY = 30.0
+STABLE_TIME = 30.0  # seconds a worker has to run before its restart delay is reset
+STOP_TIMEOUT = 5.0  # seconds a worker has to close its connections before it's killed
+
+
+class MergedMetrics(Metrics):
+    # The metrics of all the workers: the last report of every running worker, plus the totals of the exited ones
+    # (so the counters don't go back when a worker is restarted)
+    def __init__(self):
+        super().__init__()
+        self._reports_lock = threading.Lock()
+        self._reports = {}  # worker pid => last snapshot
+        self._retired = merge_snapshots([])  # the counters of the exited workers
+        self._retired_pids = set()
+        self.workers = 0  # running workers
+        self.restarts = 0
+
+    def report(self, pid, snapshot):
+        with self._reports_lock:
+            if pid not in self._retired_pids:  # a late report of an exited worker was already counted
+                self._reports[pid] = snapshot
+
+    '''
+    Moves the counters of the worker [pid] (that exited) to the retired totals
+    '''
+
+    def retire(self, pid):
+        with self._reports_lock:
+            self._retired_pids.add(pid)
+            snapshot = self._reports.pop(pid, None)
+            if snapshot is not None:
+                for entry in snapshot['queues'].values():  # its queues are gone
+                    entry[0] = 0
+                self._retired = merge_snapshots([self._retired, snapshot])
+
+    def snapshot(self):
+        with self._reports_lock:
+            return merge_snapshots([self._retired, *self._reports.values()])
+
+    def render(self):
+        lines = ['# HELP mcproxy_workers Running worker processes', '# TYPE mcproxy_workers gauge',
+                 f'mcproxy_workers {self.workers}',
+                 '# HELP mcproxy_worker_restarts_total Worker processes started again after they exited',
+                 '# TYPE mcproxy_worker_restarts_total counter', f'mcproxy_worker_restarts_total {self.restarts}']
+        return super().render() + '\n'.join(lines) + '\n'
+
+
+class MetricsReporter(threading.Thread):
+    # Sends the metrics of a worker to the supervisor every [interval] seconds,
+    # and stops [proxy] if the supervisor is gone (the worker was orphaned)
+    # (the worker's parent is the fork server, which lives as long as its children, so the supervisor is probed)
+    def __init__(self, reports, proxy, supervisor_pid, interval=REPORT_INTERVAL):
+        super().__init__(daemon=True)
+        self.reports = reports
+        self.proxy = proxy
+        self.supervisor_pid = supervisor_pid
+        self.interval = interval
+
+    def run(self):
+        from metrics import METRICS
+        pid = os.getpid()
+        while True:
+            time.sleep(self.interval)
+            try:
+                os.kill(self.supervisor_pid, 0)  # signal 0: only checks that the process exists
+            except ProcessLookupError:
+                self.proxy.stop()
+                return
+            self.reports.put((pid, METRICS.snapshot()))
+
+
+'''
+    A worker process: an AsyncProxy on the shared port, [preferences] : the mods of the supervisor's settings
+    The supervisor stops it with SIGTERM (Ctrl+C is the supervisor's to handle)
+'''
+
+
+def run_worker(index, preferences, reports, supervisor_pid, quiet=False):
+    from mc_proxy import Game, compressors_from_preferences
+    from async_proxy import AsyncProxy
+    from headless import HeadlessController, print_status
+    from capture import close_capture
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    settings = Game()
+    capture_file = preferences.get('CaptureFile')
+    settings.set_mods({**preferences, 'MetricsPort': 0, 'MetricsFile': '',  # the supervisor exports the metrics
+                       'CaptureFile': f'{capture_file}.{index}-{os.getpid()}' if capture_file else ''})
+    settings.compressors = compressors_from_preferences(settings)
+    on_status = (lambda status, text: None) if quiet else (
+        lambda status, text: print_status(status, f"Worker {index}: {text}"))
+    settings.gui_obj = HeadlessController(settings, on_status)
+
+    proxy = AsyncProxy(settings, *settings.sockets_info(), reuse_port=True)
+    signal.signal(signal.SIGTERM, lambda signum, frame: proxy.stop())
+    MetricsReporter(reports, proxy, supervisor_pid).start()
+    try:
+        proxy.run()
+    finally:
+        close_capture()  # the process ends with os._exit(), which wouldn't write the file's buffer
+
+
+class Worker:
+    # The supervisor's view of one worker process
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.started = 0.0  # time.monotonic() of the last start
+        self.restart_delay = RESTART_DELAY
+        self.restart_at = None  # time.monotonic() of the next start, while it's down
+
+
+class Supervisor:
+    # [settings] : the Game holding the preferences, [workers] : number of worker processes (default: one per core)
+    def __init__(self, settings, workers=None, quiet=False):
+        self.settings = settings
+        self.quiet = quiet
+        self.workers = [Worker(index) for index in range(workers or os.cpu_count() or 1)]
+        self.metrics = MergedMetrics()
+        # forkserver: the workers are forked from a clean single-threaded process, not from this multi-threaded one
+        methods = multiprocessing.get_all_start_methods()
+        self._context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        self._reports = self._context.Queue()
+        self._stop_event = threading.Event()
+
+    def _start(self, worker):
+        preferences = dict(self.settings.mods())
+        worker.process = self._context.Process(target=run_worker, name=f'mcproxy-worker-{worker.index}',
+                                                args=(worker.index, preferences, self._reports, os.getpid(),
+                                                      self.quiet), daemon=True)
+        worker.process.start()
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        print(f"Worker {worker.index} started (PID {worker.process.pid})")
+
+    '''
+    A worker exited: schedules its restart, the delay grows while it keeps crashing soon after it starts
+    '''
+
+    def _exited(self, worker, now):
+        process = worker.process
+        self.metrics.retire(process.pid)
+        if now - worker.started >= STABLE_TIME:
+            worker.restart_delay = RESTART_DELAY
+        print(f"Worker {worker.index} (PID {process.pid}) exited with code {process.exitcode}, "
+              f"restarting in {worker.restart_delay:g}s")
+        worker.restart_at = now + worker.restart_delay
+        worker.restart_delay = min(worker.restart_delay * 2, MAX_RESTART_DELAY)
+        worker.process = None
+
+    def _collect_reports(self):
+        while not self._stop_event.is_set():
+            try:
+                pid, snapshot = self._reports.get(timeout=CHECK_INTERVAL)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                return
+            self.metrics.report(pid, snapshot)
+
+    '''
+    Runs the workers until stop() (or Ctrl+C), restarting the ones that exit
+    '''
+
+    def run(self):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise OSError("Worker processes need SO_REUSEPORT (Linux / BSD)")
+        start_metrics(self.settings, self.metrics)
+        threading.Thread(target=self._collect_reports, daemon=True).start()
+        proxy_ip, proxy_port, server_ip, server_port = self.settings.sockets_info()
+        print(f"Supervisor: {len(self.workers)} workers on {proxy_ip}:{proxy_port} -> {server_ip}:{server_port}")
+        for worker in self.workers:
+            self._start(worker)
+        try:
+            while not self._stop_event.wait(CHECK_INTERVAL):
+                now = time.monotonic()
+                for worker in self.workers:
+                    if worker.process is not None and not worker.process.is_alive():
+                        self._exited(worker, now)
+                    if worker.process is None and now >= worker.restart_at:
+                        self.metrics.restarts += 1
+                        self._start(worker)
+                self.metrics.workers = sum(worker.process is not None and worker.process.is_alive()
+                                           for worker in self.workers)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stop_event.set()
+            self._stop_workers()
+
+    def _stop_workers(self):
+        processes = [worker.process for worker in self.workers if worker.process is not None]
+        for process in processes:
+            if process.is_alive():
+                process.terminate()  # SIGTERM: the worker closes its connections
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for process in processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+                process.join()
+        self.metrics.workers = 0
+        print("Supervisor: all workers stopped")
+
+    '''
+    Stops the workers (from any thread)
+    '''
+
+    def stop(self):
+        self._stop_event.set()